@@ -1,7 +1,10 @@
 import io
+import time
+import asyncio
 import json
 import mimetypes
 import os
+import signal
 from pathlib import Path
 from typing import AsyncGenerator
 
@@ -22,8 +25,37 @@ from quart_cors import cors
 from llm import chat as chatgpt
 from config import config, az, logger
 from utils import filename_to_id
+from utils.admission import AdmissionController, Overloaded
+from utils.answer_cache import AnswerCache
+from utils.content_registry import content_hash
+from utils.autoscaler import AciContainerGroups, Autoscaler, ScalingPolicy
+from utils.job_scheduler import (
+    DEFAULT_TENANT,
+    LargeJobSlots,
+    estimate_pages,
+    job_body,
+    lane_for,
+)
+from utils.job_status import (
+    FINAL_STATES,
+    JOB_ID,
+    JobStatusStore,
+    new_job_id,
+    queued_status,
+)
+from utils.rate_limiter import INTERACTIVE
+from utils.telemetry import metrics_response
+from utils.streaming import MIMETYPES, NDJSON, SSE, encode, encode_stream
+
+AUTOSCALER_LEASE = "autoscaler/leader-"
 
 
+admission = AdmissionController(
+    max_active=config.MAX_ACTIVE_STREAMS,
+    max_queued=config.MAX_QUEUED_REQUESTS,
+    queue_timeout=config.QUEUE_TIMEOUT,
+)
+
 ERROR_MESSAGE = """The app encountered an error processing your request.
 If you are an administrator of the app, view the full error in the logs. See aka.ms/appservice-logs for more information.
 Error type: {error_type}
@@ -64,9 +96,17 @@ async def fonts(path):
 
 @bp.route("/health")
 async def health():
+    if admission.draining:
+        return "Draining", 503
     return "Healthy", 200
 
 
+@bp.route("/metrics")
+async def metrics():
+    body, content_type = metrics_response()
+    return body, 200, {"Content-Type": content_type}
+
+
 # ! Blob storage request
 @bp.route("/content/<path>")
 async def content_file(path: str):
@@ -125,6 +165,16 @@ async def chat():
         return jsonify({"error": "request must be json"}), 415
     request_json = await request.get_json()
     context = request_json.get("context", {})
+    try:
+        await admission.acquire()
+    except Overloaded as error:
+        logger.warning(f"Rejected /chat: {error} {admission.stats()}")
+        return (
+            jsonify({"error": str(error)}),
+            503,
+            {"Retry-After": str(error.retry_after)},
+        )
+    streaming = False
     try:
         result = await chatgpt.run(
             request_json["messages"],
@@ -134,12 +184,24 @@ async def chat():
         if isinstance(result, dict):
             return jsonify(result)
         else:
-            response = await make_response(format_as_ndjson(result))
+            transport = stream_transport(request_json)
+            response = await make_response(
+                format_stream(admission.admitted(result), transport)
+            )
+            streaming = True
             response.timeout = None  # type: ignore
+            response.mimetype = MIMETYPES[transport]
+            if transport == SSE:
+                response.headers["Cache-Control"] = "no-cache"
+                response.headers["X-Accel-Buffering"] = "no"
             return response
     except Exception as error:
         logger.exception(f"Exception in /chat: {error}")
         return jsonify(error_dict(error)), 500
+    finally:
+        # Streamed responses release their slot when the stream ends
+        if not streaming:
+            admission.release()
 
 
 @bp.route("/upload_documents", methods=["POST"])
@@ -147,6 +209,10 @@ async def upload_documents():
     files = await request.files
     if not files:
         return jsonify({"error": "request must be in formData"}), 400
+    form = await request.form
+    # Bulk loads ask for the bulk lanes, so they do not hold up files a user is waiting for
+    priority = form.get("priority", INTERACTIVE)
+    tenant = request.headers.get("X-Tenant-Id") or form.get("tenant") or DEFAULT_TENANT
     results = []
     for _, file in files.items():
         try:
@@ -160,44 +226,142 @@ async def upload_documents():
             else:
                 v_scan = False
             file_id = filename_to_id(file.filename)
+            data = file.read()
+            # The worker reuses the ingestion result of identical content (see utils/content_registry.py)
+            sha256 = content_hash(data)
             az.blob_container.upload_blob(
                 f"sourcefiles/{file.filename}",
-                data=file.read(),
+                data=data,
                 overwrite=True,
-                metadata={"id": file_id, "vscan": str(int(v_scan))},
+                metadata={"id": file_id, "vscan": str(int(v_scan)), "sha256": sha256},
+            )
+            # 2. Send message to the queue of its lane
+            pages = estimate_pages(data)
+            lane = lane_for(priority, pages, config.JOB_LARGE_PAGES)
+            queue = az.lane_queues[lane] if config.JOB_LANES else az.queue
+            # The status is there before the worker can pick the job up (see /jobs/<id>)
+            job_id = new_job_id()
+            JobStatusStore.put(
+                az.blob_container, queued_status(job_id, file.filename, lane, pages)
+            )
+            logger.info(
+                f"Sending message to the {lane} queue for file '{file.filename}'"
             )
-            # 2. Send message to the queue
-            logger.info(f"Sending message to the queue for file '{file.filename}'")
-            az.queue.send_message(
+            queue.send_message(
                 json.dumps(
-                    {
-                        "filename": file.filename,
-                        "sourcefile": f"sourcefiles/{file.filename}",
-                        "id": file_id,
-                        "v-scan": v_scan,
-                    }
+                    job_body(
+                        file.filename,
+                        file_id,
+                        v_scan,
+                        sha256,
+                        pages,
+                        lane,
+                        tenant,
+                        job_id,
+                    )
                 )
             )
-            results.append({"filename": file.filename, "success": True})
+            results.append(
+                {
+                    "filename": file.filename,
+                    "success": True,
+                    "lane": lane,
+                    "job_id": job_id,
+                }
+            )
         except Exception as error:
             logger.error(f"Exception in /upload_document: {error}")
             results.append({"filename": file.filename, "error": str(error)})
     return jsonify(results)
 
 
-async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
+@bp.route("/jobs/<job_id>", methods=["GET"])
+async def job_status(job_id: str):
+    if not JOB_ID.fullmatch(job_id):
+        return jsonify({"error": "unknown job"}), 404
+    try:
+        status, _ = await asyncio.to_thread(
+            JobStatusStore.get, az.blob_container, job_id
+        )
+    except ResourceNotFoundError:
+        return jsonify({"error": "unknown job"}), 404
+    return jsonify(status)
+
+
+@bp.route("/jobs/<job_id>/events", methods=["GET"])
+async def job_events(job_id: str):
+    """Server-Sent Events with the status of the job whenever it changes, until it succeeds or fails"""
+    if not JOB_ID.fullmatch(job_id):
+        return jsonify({"error": "unknown job"}), 404
+    try:
+        status, etag = await asyncio.to_thread(
+            JobStatusStore.get, az.blob_container, job_id
+        )
+    except ResourceNotFoundError:
+        return jsonify({"error": "unknown job"}), 404
+
+    async def events(status, etag) -> AsyncGenerator[str, None]:
+        started = sent = time.monotonic()
+        yield encode(status, SSE)
+        while status["state"] not in FINAL_STATES:
+            if time.monotonic() - started > config.JOB_EVENTS_TIMEOUT:
+                break
+            await asyncio.sleep(config.JOB_EVENTS_POLL_INTERVAL)
+            # A conditional read: unchanged statuses are not downloaded again
+            changed, etag = await asyncio.to_thread(
+                JobStatusStore.get, az.blob_container, job_id, etag
+            )
+            if changed is not None:
+                status = changed
+                sent = time.monotonic()
+                yield encode(status, SSE)
+            elif time.monotonic() - sent > config.JOB_EVENTS_HEARTBEAT:
+                sent = time.monotonic()
+                yield ": keep-alive\n\n"
+
+    response = await make_response(events(status, etag))
+    response.timeout = None  # type: ignore
+    response.mimetype = MIMETYPES[SSE]
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+def stream_transport(request_json: dict) -> str:
+    """SSE when asked for in the body or the Accept header, NDJSON otherwise"""
+    transport = request_json.get("stream_format")
+    if transport is None and "text/event-stream" in request.headers.get("Accept", ""):
+        transport = SSE
+    transport = transport or config.STREAM_TRANSPORT
+    return transport if transport in MIMETYPES else NDJSON
+
+
+async def format_stream(
+    r: AsyncGenerator[dict, None], transport: str = NDJSON
+) -> AsyncGenerator[str, None]:
     """Used to format response for streaming"""
     try:
-        async for event in r:
-            if not isinstance(event, dict):
-                event = dict(event)
-                event["choices"] = [dict(c) for c in event["choices"]]
-                for choice in event["choices"]:
-                    choice["delta"] = dict(choice["delta"])
-            yield json.dumps(event, ensure_ascii=False) + "\n"
+        async for line in encode_stream(
+            r,
+            transport=transport,
+            coalesce_ms=config.STREAM_COALESCE_MS,
+            coalesce_bytes=config.STREAM_COALESCE_BYTES,
+        ):
+            yield line
     except Exception as e:
         logger.exception(f"Exception while generating response stream: {e}")
-        yield json.dumps(error_dict(e))
+        yield encode(error_dict(e), transport)
+
+
+def invalidate_answers(filename: str):
+    """Drops the cached answers grounded on the file, in this worker and (through a blob) in the others"""
+    if chatgpt.answer_cache is None:
+        return
+    chatgpt.answer_cache.invalidate(filename)
+    try:
+        AnswerCache.publish_invalidation(az.blob_container, filename)
+    except Exception as error:
+        logger.warning(f"Failed to publish the answer cache invalidation: {error}")
 
 
 # ! No-LLM API Endpoints
@@ -241,6 +405,7 @@ async def delete_documents():
 
         logger.info(f"Deleting documents from file: {filename}")
         await az.search_client.index_documents(batch)
+        invalidate_answers(filename)
 
         # Validating
         results = await az.search_client.search(
@@ -270,10 +435,85 @@ def auth_setup():
     )
 
 
+@bp.after_app_request
+async def count_request(response):
+    admission.count_request()
+    return response
+
+
+def start_draining(signum, frame):
+    """
+    Stops admitting /chat requests as soon as the worker is told to stop. Uvicorn handles the same signal through
+    the event loop, and only runs the lifespan shutdown (`drain` below) once the open connections have closed.
+    """
+    if not admission.draining:
+        logger.info(f"Received signal {signum}, draining: {admission.stats()}")
+    admission.draining = True
+
+
 @bp.before_app_serving
 async def configure():
+    # Uvicorn's loop signal handlers still run: the event loop is woken up by the signal either way
+    try:
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, start_draining)
+    except ValueError:
+        # Not served from the main thread (tests)
+        pass
+    admission.max_requests = int(os.getenv("WORKER_MAX_REQUESTS", 0))
     az.configure_clients()
     az.create_search_index()
+    if config.AUTOSCALE:
+        current_app.autoscaler = asyncio.ensure_future(autoscale())
+
+
+async def autoscale():
+    """
+    Sizes the task worker pool every AUTOSCALE_INTERVAL seconds (see utils/autoscaler.py),
+    in the one process of the web tier that holds the leader lease
+    """
+    leases = LargeJobSlots(az.blob_container, 1, prefix=AUTOSCALER_LEASE)
+    leader, scaler = None, None
+    while True:
+        try:
+            if leader is None or not leader.held:
+                leader = await asyncio.to_thread(leases.acquire)
+            if leader is not None:
+                if scaler is None:
+                    scaler = Autoscaler(
+                        {**az.lane_queues, "default": az.queue},
+                        az.blob_container,
+                        AciContainerGroups(
+                            az.credential,
+                            az.SUBSCRIPTION_ID,
+                            az.RESOURCE_GROUP,
+                            az.TASKS_CONTAINER_GROUP,
+                        ),
+                        ScalingPolicy(
+                            min_workers=config.AUTOSCALE_MIN_WORKERS,
+                            max_workers=config.AUTOSCALE_MAX_WORKERS,
+                            jobs_per_worker=config.AUTOSCALE_JOBS_PER_WORKER,
+                            max_age=config.AUTOSCALE_MAX_AGE,
+                            up_cooldown=config.AUTOSCALE_UP_COOLDOWN,
+                            down_delay=config.AUTOSCALE_DOWN_DELAY,
+                        ),
+                        heartbeat_timeout=3 * config.AUTOSCALE_HEARTBEAT_INTERVAL,
+                    )
+                result = await asyncio.to_thread(scaler.tick)
+                if result["started"] or result["stopped"]:
+                    logger.info(f"Autoscaler: {json.dumps(result)}")
+        except Exception as ex:
+            logger.warning(f"Autoscaler failed: {ex}")
+        await asyncio.sleep(config.AUTOSCALE_INTERVAL)
+
+
+@bp.after_app_serving
+async def drain():
+    if autoscaler := getattr(current_app, "autoscaler", None):
+        autoscaler.cancel()
+    logger.info(f"Draining in-flight streams: {admission.stats()}")
+    if not await admission.drain(config.DRAIN_TIMEOUT):
+        logger.warning(f"Drain timed out with streams in flight: {admission.stats()}")
 
 
 def create_app():
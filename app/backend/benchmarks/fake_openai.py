@@ -0,0 +1,190 @@
+"""
+A local stand-in for the OpenAI API used by the benchmarks.
+Serves /v1/chat/completions (streamed and not) and /v1/embeddings with configurable latency,
+so the app can be load tested by pointing OPENAI_BASE_URL at it.
+
+    python -m benchmarks.fake_openai --port 8001 --latency-ms 300 --token-ms 20
+"""
+import time
+import json
+import asyncio
+import hashlib
+import argparse
+from aiohttp import web
+
+ANSWER = (
+    "The revenue in 2023 was 12.5 million dollars [report-page3.txt], "
+    "up from 10.1 million in 2022 [report-page2.txt]. "
+)
+FOLLOWUPS = "<<What drove the growth?>> <<What is the 2024 forecast?>> <<Who are the main customers?>>"
+
+
+def fake_embedding(text: str, dimensions: int = 1536):
+    seed = hashlib.sha256(text.encode("utf-8")).digest()
+    return [((seed[i % len(seed)] + i) % 255) / 255 - 0.5 for i in range(dimensions)]
+
+
+def tokens_of(text: str):
+    words = text.split(" ")
+    return [w + " " for w in words[:-1]] + [words[-1]]
+
+
+def chunk(model: str, delta: dict, finish_reason=None):
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def create_fake_openai_app(
+    latency: float = 0.3,
+    token_latency: float = 0.02,
+    answer_tokens: int = 0,
+    rpm: int = 0,
+) -> web.Application:
+    """
+    `latency` is applied before the first byte of every response,
+    `token_latency` between streamed chunks. `answer_tokens` > 0 pads the answer to that many tokens.
+    `rpm` > 0 enforces a requests-per-minute limit per model, reported in `x-ratelimit-*` headers and
+    answered with 429 when exceeded.
+    """
+    answer = ANSWER
+    if answer_tokens:
+        words = (ANSWER * (answer_tokens // len(ANSWER.split()) + 1)).split()
+        answer = " ".join(words[:answer_tokens]) + " "
+    stats = {"chat": 0, "embeddings": 0, "rate_limited": 0}
+    requests = {}
+
+    def rate_limit(model: str):
+        """Headers for a request on `model`, and whether it exceeds the limit"""
+        if not rpm:
+            return {}, False
+        now = time.monotonic()
+        recent = [t for t in requests.get(model, []) if now - t < 60]
+        limited = len(recent) >= rpm
+        if not limited:
+            recent.append(now)
+        requests[model] = recent
+        reset = 60 - (now - recent[0]) if recent else 0
+        headers = {
+            "x-ratelimit-limit-requests": str(rpm),
+            "x-ratelimit-remaining-requests": str(rpm - len(recent)),
+            "x-ratelimit-reset-requests": f"{reset:.3f}s",
+        }
+        if limited:
+            stats["rate_limited"] += 1
+            headers["retry-after"] = f"{reset:.3f}"
+        return headers, limited
+
+    def rate_limited_response(headers):
+        return web.json_response(
+            {"error": {"message": "Rate limit reached", "type": "requests"}},
+            status=429,
+            headers=headers,
+        )
+
+    async def chat_completions(request: web.Request):
+        body = await request.json()
+        stats["chat"] += 1
+        model = body.get("model", "gpt-fake")
+        headers, limited = rate_limit(model)
+        if limited:
+            return rate_limited_response(headers)
+        await asyncio.sleep(latency)
+        if not body.get("stream"):
+            return web.json_response(
+                {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": "revenue in 2023",
+                            },
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": {
+                        "prompt_tokens": 100,
+                        "completion_tokens": 4,
+                        "total_tokens": 104,
+                    },
+                },
+                headers=headers,
+            )
+        response = web.StreamResponse(
+            headers={"Content-Type": "text/event-stream", **headers}
+        )
+        await response.prepare(request)
+        await response.write(
+            f"data: {json.dumps(chunk(model, {'role': 'assistant', 'content': ''}))}\n\n".encode()
+        )
+        for token in tokens_of(answer + FOLLOWUPS):
+            await asyncio.sleep(token_latency)
+            await response.write(
+                f"data: {json.dumps(chunk(model, {'content': token}))}\n\n".encode()
+            )
+        await response.write(
+            f"data: {json.dumps(chunk(model, {}, 'stop'))}\n\n".encode()
+        )
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def embeddings(request: web.Request):
+        body = await request.json()
+        stats["embeddings"] += 1
+        headers, limited = rate_limit(body.get("model", "text-embedding-ada-002"))
+        if limited:
+            return rate_limited_response(headers)
+        await asyncio.sleep(latency / 3)
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        return web.json_response(
+            {
+                "object": "list",
+                "model": body.get("model", "text-embedding-ada-002"),
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": fake_embedding(t)}
+                    for i, t in enumerate(inputs)
+                ],
+                "usage": {"prompt_tokens": 8, "total_tokens": 8},
+            },
+            headers=headers,
+        )
+
+    async def get_stats(request: web.Request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_post("/v1/embeddings", embeddings)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--token-ms", type=float, default=20)
+    parser.add_argument("--answer-tokens", type=int, default=0)
+    parser.add_argument("--rpm", type=int, default=0)
+    args = parser.parse_args()
+    web.run_app(
+        create_fake_openai_app(
+            args.latency_ms / 1000,
+            args.token_ms / 1000,
+            args.answer_tokens,
+            args.rpm,
+        ),
+        host="127.0.0.1",
+        port=args.port,
+        print=None,
+    )
@@ -0,0 +1,80 @@
+"""
+Import-time budget of the web tier. `from app import create_app` runs in fresh interpreters with -X importtime;
+the check fails when the import takes longer than the budget, or when it loads a module of the ingestion
+dependency set, which only the task worker needs.
+
+    python -m benchmarks.imports --budget-ms 2500
+"""
+import os
+import sys
+import argparse
+import subprocess
+from typing import Set, Tuple
+from benchmarks.serving_profiles import FAKE_ENV
+
+WEB_TIER = "from app import create_app"
+INGESTION_MODULES = (
+    "fitz",
+    "tenacity",
+    "azure.ai.formrecognizer",
+    "llm.singlefileupload",
+    "llm.singlefilescanupload",
+    "llm.backfill",
+)
+
+
+def import_profile(statement: str = WEB_TIER) -> Tuple[float, Set[str]]:
+    """Milliseconds spent importing in `statement` and the modules it loaded"""
+    env = {**FAKE_ENV, **os.environ}
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        env=env,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+    total, modules = 0, set()
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        modules.add(name.strip())
+        # Top level imports carry the time of everything they import
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+    return total / 1000, modules
+
+
+def ingestion_modules(modules: Set[str]) -> Set[str]:
+    return {name for name in INGESTION_MODULES if name in modules}
+
+
+def check(runs: int = 3) -> Tuple[float, Set[str]]:
+    """Best import time over `runs` and the ingestion modules loaded by the web tier"""
+    profiles = [import_profile() for _ in range(runs)]
+    best = min(ms for ms, _ in profiles)
+    return best, ingestion_modules(profiles[0][1])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--budget-ms", type=float, default=2500)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    import_ms, loaded = check(args.runs)
+    print(f"{WEB_TIER}: {import_ms:.0f} ms (budget {args.budget_ms:.0f} ms)")
+    failed = import_ms > args.budget_ms
+    if loaded:
+        print(f"Ingestion modules loaded by the web tier: {', '.join(sorted(loaded))}")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
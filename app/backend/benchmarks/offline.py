@@ -0,0 +1,579 @@
+"""
+Offline benchmark suite. Replays the recorded fixtures through the stand-ins in benchmarks/stubs.py and measures
+- chat: /chat throughput and p50/p99 latency under concurrency (in-process, through the Quart test client)
+- ingest: pages per minute of SingleFileUpload ("layout"), SingleFileScanUpload ("scan") and of the backfill mode
+  (half layout, half scan documents, through the local Batch API stand-in). Scan documents are mixed decks,
+  every other page a scanned image without a text layer.
+- micro: split_text, get_document_text, table_to_html, MessageBuilder, and the size and parse time of the search
+  response of /chat with the projected fields (against all fields and the embedding, as an unprojected query returns)
+- memory: peak memory of SingleFileUpload.index_document for a large synthetic document (--sections sections)
+- imports: time of `from app import create_app` and ingestion modules it loads (see benchmarks/imports.py)
+- scheduler: p95 queue wait per ingestion lane of a bulk load followed by users' uploads, on one simulated worker,
+  through the lanes of utils/job_scheduler.py and through the single FIFO queue (`scheduler.fifo.*`)
+- autoscale: completion time and container minutes of a backfill burst on a simulated clock, with the task worker
+  pool sized by utils/autoscaler.py and with fixed pools of AUTOSCALE_MIN_WORKERS and AUTOSCALE_MAX_WORKERS workers
+
+Save the results of one commit and compare another one against them; the run exits with 1 when any metric
+got worse by more than --threshold.
+
+    python -m benchmarks.offline --output baseline.json
+    python -m benchmarks.offline --baseline baseline.json --threshold 0.1
+
+tiktoken has to find its encodings offline, e.g. through TIKTOKEN_CACHE_DIR.
+"""
+import os
+import sys
+import json
+import time
+import timeit
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List
+from benchmarks.serving_profiles import CHAT_REQUEST, FAKE_ENV, percentile
+
+for key, value in {**FAKE_ENV, "MAX_ACTIVE_STREAMS": "0"}.items():
+    os.environ.setdefault(key, value)
+
+from benchmarks.stubs import (
+    FakeContainerGroups,
+    Latency,
+    Stubs,
+    load_fixture,
+    make_pdf,
+)
+
+HIGHER, LOWER = "higher", "lower"
+
+
+def metric(value: float, unit: str, better: str) -> Dict[str, Any]:
+    return {"value": round(value, 3), "unit": unit, "better": better}
+
+
+async def bench_chat(stubs: Stubs, concurrency: int, requests: int):
+    from app import create_app
+
+    client = create_app().test_client()
+    latencies: List[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one_chat(record: bool = True):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post("/chat", json=CHAT_REQUEST)
+            body = await response.get_data()
+            if response.status_code != 200 or b'"error"' in body:
+                errors += 1
+            elif record:
+                latencies.append(time.perf_counter() - started)
+
+    # Warm up tiktoken and the app before measuring
+    await asyncio.gather(*(one_chat(record=False) for _ in range(min(requests, 4))))
+    started = time.perf_counter()
+    await asyncio.gather(*(one_chat() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+    return {
+        "chat.throughput": metric(len(latencies) / elapsed, "req/s", HIGHER),
+        "chat.p50": metric(percentile(latencies, 50) * 1000, "ms", LOWER),
+        "chat.p99": metric(percentile(latencies, 99) * 1000, "ms", LOWER),
+        "chat.errors": metric(errors, "requests", LOWER),
+    }
+
+
+async def bench_ingestion(stubs: Stubs, mode: str, documents: int, pages: int):
+    from llm import SingleFileScanUpload, SingleFileUpload
+    from utils.ingestion_metrics import IngestionMetrics
+
+    if mode == "scan":
+        upload = SingleFileScanUpload()
+        upload.temp_dir = tempfile.mkdtemp(prefix="benchmark-scan-")
+    else:
+        upload = SingleFileUpload()
+    pdf = make_pdf(pages, scanned_every=2)
+    for i in range(documents):
+        filename = f"benchmark-{mode}-{i}.pdf"
+        stubs.blob_container.upload_blob(f"sourcefiles/{filename}", pdf)
+        stubs.queue.send_message(
+            json.dumps({"filename": filename, "v-scan": mode == "scan"})
+        )
+
+    # Drains the queue through the same calls as tasks.py
+    total_pages, stages, routes = 0, {}, {}
+    started = time.perf_counter()
+    while messages := list(stubs.queue.receive_messages(max_messages=1)):
+        message = messages[0]
+        body = json.loads(message["content"])
+        metrics = IngestionMetrics(
+            body["filename"],
+            mode=mode,
+            enqueued_at=message.inserted_on,
+            dequeue_count=message.dequeue_count,
+        )
+        await upload.run(body["filename"], metrics)
+        summary = metrics.finish()
+        total_pages += summary["pages"]
+        for name, seconds in summary["stages"].items():
+            stages[name] = stages.get(name, 0.0) + seconds
+        for route, count in summary["page_routes"].items():
+            routes[route] = routes.get(route, 0) + count
+        stubs.queue.delete_message(message)
+    elapsed = time.perf_counter() - started
+
+    results = {
+        f"ingest.{mode}.pages_per_minute": metric(
+            total_pages / elapsed * 60, "pages/min", HIGHER
+        )
+    }
+    for name, seconds in stages.items():
+        results[f"ingest.{mode}.{name}_per_page"] = metric(
+            seconds / total_pages * 1000, "ms", LOWER
+        )
+    if mode == "scan":
+        results["ingest.scan.vision_pages"] = metric(
+            routes.get("vision", 0) / total_pages * 100, "%", LOWER
+        )
+    return results
+
+
+async def bench_backfill(stubs: Stubs, documents: int, pages: int):
+    from llm.backfill import Backfill, BackfillDocument
+    from utils.ingestion_metrics import IngestionMetrics
+    from utils.openai_batch import LocalBatchClient
+    from config import gpt
+
+    backfill = Backfill(LocalBatchClient(gpt.client), poll_interval=0)
+    backfill.scan_upload.temp_dir = tempfile.mkdtemp(prefix="benchmark-backfill-")
+    pdf = make_pdf(pages, scanned_every=2)
+    batch = []
+    for i in range(documents * 2):
+        filename = f"benchmark-backfill-{i}.pdf"
+        stubs.blob_container.upload_blob(f"sourcefiles/{filename}", pdf)
+        batch.append(BackfillDocument(filename, i % 2 == 1, IngestionMetrics(filename)))
+    started = time.perf_counter()
+    await backfill.run(batch)
+    elapsed = time.perf_counter() - started
+    total_pages = sum(d.metrics.pages for d in batch if d.error is None)
+    return {
+        "ingest.backfill.pages_per_minute": metric(
+            total_pages / elapsed * 60, "pages/min", HIGHER
+        ),
+        "ingest.backfill.errors": metric(
+            sum(1 for d in batch if d.error), "documents", LOWER
+        ),
+    }
+
+
+async def bench_memory(stubs: Stubs, sections: int):
+    import tracemalloc
+    from llm import SingleFileUpload
+    from llm.singlefileupload import MAX_SECTION_LENGTH
+
+    upload = SingleFileUpload()
+    text = load_fixture("layout")["content"].replace("\n", " ")
+    # split_text cuts sections of about MAX_SECTION_LENGTH characters
+    pages = 100
+    page_length = sections * MAX_SECTION_LENGTH // pages
+    page_text = (text * (page_length // len(text) + 1))[:page_length]
+    page_map = [
+        {"page_num": i, "page_offset": i * page_length, "page_text": page_text}
+        for i in range(pages)
+    ]
+    tracemalloc.start()
+    await upload.index_document(
+        "Benchmark", "Benchmark", "benchmark.pdf", "benchmark", page_map
+    )
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "memory.index_document_peak": metric(peak / 2**20, "MB", LOWER),
+        "memory.index_document_sections": metric(
+            upload.metrics.sections, "sections", LOWER
+        ),
+    }
+
+
+def scheduler_workload() -> List[tuple]:
+    """(pages, priority, tenant) of the uploads, in upload order: a bulk load lands before the users' files"""
+    jobs = [(500, "bulk", "loader")]
+    jobs += [(20, "bulk", "loader") for _ in range(30)]
+    jobs += [(80, "interactive", f"user-{i}") for i in range(2)]
+    jobs += [(2, "interactive", f"user-{i % 5}") for i in range(10)]
+    return jobs
+
+
+def bench_scheduler(stubs: Stubs, page_seconds: float = 1.0):
+    """
+    Queue wait per lane of scheduler_workload on one worker, through the lanes and through the single FIFO queue.
+    Jobs take `page_seconds` per page on a simulated clock.
+    """
+    from config import config
+    from utils.job_scheduler import JobScheduler, LANES, job_body, lane_for
+
+    def drain(scheduler: JobScheduler, queue_of) -> Dict[str, List[float]]:
+        for i, (pages, priority, tenant) in enumerate(scheduler_workload()):
+            lane = lane_for(priority, pages, config.JOB_LARGE_PAGES)
+            body = job_body(f"job-{i}.pdf", str(i), True, "", pages, lane, tenant)
+            queue_of(lane).send_message(json.dumps(body))
+        clock, waits = 0.0, {}
+        while job := scheduler.next():
+            waits.setdefault(job.body["lane"], []).append(clock)
+            clock += job.body["pages"] * page_seconds
+            JobScheduler.done(job)
+        return waits
+
+    lanes = drain(
+        JobScheduler(
+            stubs.lane_queues, config.JOB_LANE_WEIGHTS, window=config.JOB_TENANT_WINDOW
+        ),
+        lambda lane: stubs.lane_queues[lane],
+    )
+    fifo = drain(JobScheduler({"default": stubs.queue}, {}), lambda lane: stubs.queue)
+    results = {}
+    for lane in LANES:
+        if lane in lanes:
+            results[f"scheduler.{lane}.wait_p95"] = metric(
+                percentile(lanes[lane], 95), "s", LOWER
+            )
+            results[f"scheduler.fifo.{lane}.wait_p95"] = metric(
+                percentile(fifo[lane], 95), "s", LOWER
+            )
+    return results
+
+
+def bench_autoscale(
+    jobs: int = 40,
+    job_seconds: float = 60,
+    start_delay: float = 60,
+    horizon: float = 7200,
+    step: float = 10,
+):
+    """
+    A backfill burst of `jobs` jobs of `job_seconds` each on a simulated clock, through a fixed pool of
+    AUTOSCALE_MIN_WORKERS and of AUTOSCALE_MAX_WORKERS workers and through utils/autoscaler.py, which starts workers
+    that take `start_delay` seconds to come up. Measures when the last job finished and the container minutes billed
+    over `horizon` seconds.
+    """
+    from config import config
+    from utils.autoscaler import (
+        ACTIVE_STATES,
+        BUSY,
+        IDLE,
+        Autoscaler,
+        Heartbeats,
+        ScalingPolicy,
+    )
+
+    def simulate(prefix: str, fixed: int = 0):
+        stubs = Stubs(Latency()).install()
+        queue = stubs.lane_queues["bulk-small"]
+        started = datetime.now(timezone.utc)
+        for i in range(jobs):
+            queue.send_message(json.dumps({"filename": f"job-{i}.pdf"}))
+        for message in queue.messages:
+            message.inserted_on = started
+        names = ["tasks"] + [
+            f"tasks-{i}" for i in range(1, config.AUTOSCALE_MAX_WORKERS)
+        ]
+        # The fixed pools are up from the start
+        containers = FakeContainerGroups(names, 0 if fixed else start_delay)
+        for name in names[:fixed]:
+            containers.start(name)
+        scaler = Autoscaler(
+            stubs.lane_queues,
+            stubs.blob_container,
+            containers,
+            ScalingPolicy(
+                min_workers=config.AUTOSCALE_MIN_WORKERS,
+                max_workers=config.AUTOSCALE_MAX_WORKERS,
+                jobs_per_worker=config.AUTOSCALE_JOBS_PER_WORKER,
+                max_age=config.AUTOSCALE_MAX_AGE,
+                up_cooldown=config.AUTOSCALE_UP_COOLDOWN,
+                down_delay=config.AUTOSCALE_DOWN_DELAY,
+            ),
+            heartbeat_timeout=3 * config.AUTOSCALE_HEARTBEAT_INTERVAL,
+        )
+        running: Dict[str, tuple] = {}
+        finished, completion, container_seconds = 0, None, 0.0
+        clock = 0.0
+        while clock < horizon:
+            containers.clock = clock
+            now = started + timedelta(seconds=clock)
+            states = containers.states()
+            for name, state in states.items():
+                if state in ACTIVE_STATES:
+                    container_seconds += step
+                if state != "Running":
+                    # A stopped worker loses its job, which reappears after its visibility timeout
+                    running.pop(name, None)
+                    continue
+                job = running.get(name)
+                if job is not None and job[1] <= clock:
+                    queue.delete_message(job[0])
+                    del running[name]
+                    finished += 1
+                    if finished == jobs:
+                        completion = clock
+                if name not in running:
+                    received = list(
+                        queue.receive_messages(max_messages=1, visibility_timeout=3600)
+                    )
+                    if received:
+                        running[name] = (received[0], clock + job_seconds)
+                Heartbeats.write(
+                    stubs.blob_container,
+                    name,
+                    BUSY if name in running else IDLE,
+                    now=now,
+                    held=1 if name in running else 0,
+                )
+            if not fixed and clock % config.AUTOSCALE_INTERVAL < step:
+                scaler.tick(now, clock)
+            clock += step
+        return {
+            f"{prefix}.completion": metric(
+                (horizon if completion is None else completion) / 60, "min", LOWER
+            ),
+            f"{prefix}.container_minutes": metric(container_seconds / 60, "min", LOWER),
+        }
+
+    results = simulate("autoscale")
+    results.update(simulate("autoscale.fixed_min", config.AUTOSCALE_MIN_WORKERS))
+    results.update(simulate("autoscale.fixed_max", config.AUTOSCALE_MAX_WORKERS))
+    return results
+
+
+def time_call(fn: Callable[[], Any], repeat: int = 5) -> float:
+    """Best microseconds per call over `repeat` runs of an auto-ranged loop"""
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e6
+
+
+def bench_micro(pages: int):
+    from llm import SingleFileUpload
+    from azure.search.documents._generated.models import SearchDocumentsResult
+    from benchmarks.fake_openai import fake_embedding
+    from llm.retrieval import RETRIEVAL_PROFILES
+    from utils import MessageBuilder
+    from utils.context_packing import Source
+    from config import gpt, config
+
+    stubs = Stubs(Latency(), pages=pages).install()
+    upload = SingleFileUpload()
+    page_map = upload.get_document_text("benchmark.pdf", None)
+    table = stubs.form_recognizer.analyze_result(pages).tables[0]
+    history = [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": result["content"]}
+        for i, result in enumerate(stubs.search_client.results * 4)
+    ]
+
+    # REST bodies of the search call of /chat, with the recorded hits as stored in the index
+    hits = [
+        {
+            **{k: v for k, v in result.items() if k != "@search.captions"},
+            "@search.captions": [
+                vars(caption) for caption in result["@search.captions"]
+            ],
+            "embedding": fake_embedding(result["content"]),
+            "is_summary": False,
+            "is_assessment": False,
+        }
+        for result in stubs.search_client.results
+    ]
+    fields = RETRIEVAL_PROFILES[config.RETRIEVAL_PROFILE].select_fields()
+    full_payload = json.dumps({"value": hits}).encode("utf-8")
+    payload = json.dumps(
+        {
+            "value": [
+                {
+                    k: v
+                    for k, v in hit.items()
+                    if k in fields or k.startswith("@search.")
+                }
+                for hit in hits
+            ]
+        }
+    ).encode("utf-8")
+
+    def parse_search(body: bytes):
+        results = SearchDocumentsResult.deserialize(json.loads(body)).results
+        return [
+            Source(
+                r.additional_properties["sourcepage"],
+                r.additional_properties.get("content", ""),
+                r.additional_properties.get("id"),
+                r.additional_properties.get("sourcefile"),
+            )
+            for r in results
+        ]
+
+    def build_messages():
+        builder = MessageBuilder("You are a helpful assistant.", gpt.CHATGPT_MODEL)
+        for message in history:
+            builder.count_tokens_for_message(message)
+            builder.insert_message(message["role"], message["content"])
+        return builder.messages
+
+    return {
+        "micro.split_text": metric(
+            time_call(lambda: list(upload.split_text(page_map, "benchmark.pdf"))),
+            "us",
+            LOWER,
+        ),
+        "micro.get_document_text": metric(
+            time_call(lambda: upload.get_document_text("benchmark.pdf", None)),
+            "us",
+            LOWER,
+        ),
+        "micro.table_to_html": metric(
+            time_call(lambda: upload.table_to_html(table)), "us", LOWER
+        ),
+        "micro.message_builder": metric(time_call(build_messages), "us", LOWER),
+        "micro.search_payload": metric(len(payload), "bytes", LOWER),
+        "micro.search_parse": metric(
+            time_call(lambda: parse_search(payload)), "us", LOWER
+        ),
+        # Reference: the same hits with every field, the embedding included
+        "micro.search_payload_all_fields": metric(len(full_payload), "bytes", LOWER),
+        "micro.search_parse_all_fields": metric(
+            time_call(lambda: parse_search(full_payload)), "us", LOWER
+        ),
+    }
+
+
+def bench_imports():
+    from benchmarks.imports import check
+
+    import_ms, loaded = check()
+    return {
+        "imports.web_tier": metric(import_ms, "ms", LOWER),
+        "imports.web_tier_ingestion_modules": metric(len(loaded), "modules", LOWER),
+    }
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float):
+    """Prints the change of every metric and returns the names of the regressed ones"""
+    if baseline.get("settings") != current.get("settings"):
+        print("Warning: the baseline was recorded with different settings")
+    print(f"{'metric':40} {baseline['commit']:>14} {current['commit']:>14}   change")
+    regressions = []
+    for name, value in current["metrics"].items():
+        if name not in baseline["metrics"]:
+            continue
+        before, after = baseline["metrics"][name]["value"], value["value"]
+        if before:
+            change = (after - before) / before
+        else:
+            change = float("inf") if after > before else 0.0
+        worse = -change if value["better"] == HIGHER else change
+        flag = ""
+        if worse > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name:40} {before:>14} {after:>14} {change:>+8.1%} {value['unit']}{flag}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--suites", nargs="+", default=["chat", "ingest", "micro"])
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--documents", type=int, default=3)
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--sections", type=int, default=5000)
+    parser.add_argument("--openai-ms", type=float, default=50)
+    parser.add_argument("--token-ms", type=float, default=5)
+    parser.add_argument("--search-ms", type=float, default=20)
+    parser.add_argument("--storage-ms", type=float, default=5)
+    parser.add_argument("--form-recognizer-ms", type=float, default=50)
+    parser.add_argument("--output", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Compare against results saved earlier")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args()
+
+    latency = Latency(
+        openai=args.openai_ms / 1000,
+        token=args.token_ms / 1000,
+        search=args.search_ms / 1000,
+        storage=args.storage_ms / 1000,
+        form_recognizer=args.form_recognizer_ms / 1000,
+    )
+    metrics = {}
+    if "chat" in args.suites:
+        stubs = Stubs(latency).install()
+        metrics.update(asyncio.run(bench_chat(stubs, args.concurrency, args.requests)))
+    if "ingest" in args.suites:
+        for mode in ("layout", "scan"):
+            stubs = Stubs(latency, pages=args.pages).install()
+            metrics.update(
+                asyncio.run(bench_ingestion(stubs, mode, args.documents, args.pages))
+            )
+        stubs = Stubs(latency, pages=args.pages).install()
+        metrics.update(asyncio.run(bench_backfill(stubs, args.documents, args.pages)))
+    if "micro" in args.suites:
+        metrics.update(bench_micro(args.pages))
+    if "memory" in args.suites:
+        stubs = Stubs(Latency(), pages=args.pages).install()
+        metrics.update(asyncio.run(bench_memory(stubs, args.sections)))
+    if "imports" in args.suites:
+        metrics.update(bench_imports())
+    if "scheduler" in args.suites:
+        metrics.update(bench_scheduler(Stubs(Latency()).install()))
+    if "autoscale" in args.suites:
+        metrics.update(bench_autoscale())
+
+    results = {
+        "commit": git_commit(),
+        "created": datetime.now(timezone.utc).isoformat(),
+        "settings": {
+            "latency": latency.to_dict(),
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "documents": args.documents,
+            "pages": args.pages,
+            "sections": args.sections,
+        },
+        "metrics": metrics,
+    }
+    for name, value in metrics.items():
+        print(f"{name:40} {value['value']:>14} {value['unit']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        if compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Records the fixtures replayed by benchmarks/stubs.py from the live services configured in the environment.
+Runs one /chat turn and extracts, scans and summarizes one PDF, capturing the raw responses on the way.
+Embedding vectors are dropped, the stubs derive them from the input.
+
+    python -m benchmarks.record --pdf sample.pdf --question "What was the revenue in 2023?"
+"""
+import os
+import json
+import asyncio
+import argparse
+from types import SimpleNamespace
+from typing import Any, Dict, List
+from benchmarks.stubs import FIXTURES_DIR
+
+
+def save(name: str, record: Any):
+    with open(os.path.join(FIXTURES_DIR, f"{name}.json"), "w") as f:
+        json.dump(record, f, indent=1, default=str)
+    print(f"Recorded {name}.json")
+
+
+def capture_async(resource, records: Dict[str, Any]):
+    """Wraps `resource.create` to keep the first response and any streamed chunks"""
+    create = resource.create
+
+    async def wrapper(*args, **kwargs):
+        result = await create(*args, **kwargs)
+        if not kwargs.get("stream"):
+            records.setdefault("response", result.model_dump())
+            return result
+        chunks = records.setdefault("chunks", [])
+
+        async def stream():
+            async for chunk in result:
+                chunks.append(chunk.model_dump())
+                yield chunk
+
+        return stream()
+
+    resource.create = wrapper
+
+
+def capture_search(search_client, documents: List[dict]):
+    search = search_client.search
+
+    async def wrapper(*args, **kwargs):
+        results = await search(*args, **kwargs)
+
+        async def iterate():
+            async for document in results:
+                documents.append(
+                    {
+                        **document,
+                        "@search.captions": [
+                            {"text": c.text, "highlights": c.highlights}
+                            for c in document.get("@search.captions") or []
+                        ],
+                    }
+                )
+                yield document
+
+        return iterate()
+
+    search_client.search = wrapper
+
+
+async def record_chat(question: str):
+    from llm import chat
+    from config import az, gpt
+
+    completions, embeddings, documents = {}, {}, []
+    capture_async(gpt.aclient.chat.completions, completions)
+    capture_async(gpt.aclient.embeddings, embeddings)
+    capture_search(az.search_client, documents)
+    stream = await chat.run(
+        [{"role": "user", "content": question}],
+        context={"overrides": {"suggest_followup_questions": True}},
+    )
+    async for _ in stream:
+        pass
+    embedding = embeddings["response"]
+    for item in embedding["data"]:
+        item["embedding"] = None
+    save("chat_completion", completions["response"])
+    save("chat_stream", completions["chunks"])
+    save("embedding", embedding)
+    save("search_results", documents)
+
+
+def record_ingestion(pdf: str):
+    from config import az, gpt
+    from llm import SingleFileUpload, SingleFileScanUpload
+
+    filename = os.path.basename(pdf)
+    upload = SingleFileUpload()
+    analyze = az.form_recognizer.begin_analyze_document
+    layouts = []
+
+    def capture_layout(*args, **kwargs):
+        result = analyze(*args, **kwargs).result()
+        layouts.append(result.to_dict())
+        return SimpleNamespace(result=lambda: result)
+
+    az.form_recognizer.begin_analyze_document = capture_layout
+    with open(pdf, "rb") as f:
+        page_map = upload.get_document_text(filename, f)
+    save("layout", layouts[0])
+    summary = upload.run_openai_assistant(filename, page_map)
+    save("assistant_summary", {"text": str(summary)})
+
+    scan = SingleFileScanUpload()
+    with open(pdf, "rb") as f:
+        images = scan.split_pdf_into_images(filename, f)
+    vision = {}
+    create = gpt.client.chat.completions.create
+
+    def capture(*args, **kwargs):
+        response = create(*args, **kwargs)
+        vision.setdefault("response", response.model_dump())
+        return response
+
+    gpt.client.chat.completions.create = capture
+    scan.scan_page_image(images[0]["image_file"])
+    save("vision", vision["response"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pdf", required=True)
+    parser.add_argument("--question", default="What was the revenue in 2023?")
+    args = parser.parse_args()
+
+    from config import az
+
+    az.configure_clients()
+    asyncio.run(record_chat(args.question))
+    record_ingestion(args.pdf)
+
+
+if __name__ == "__main__":
+    main()
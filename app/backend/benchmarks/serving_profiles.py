@@ -0,0 +1,250 @@
+"""
+Compares gunicorn serving profiles (see gunicorn.conf.py) under concurrent /chat streams.
+For every profile it starts gunicorn against the local OpenAI stand-in and the local search backend,
+runs the load, and reports p50/p99 latency, time to first byte, rejections and resident memory per stream.
+Linux only (memory is read from /proc).
+
+    python -m benchmarks.serving_profiles --profiles streaming classic --concurrency 100 --requests 400
+"""
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import aiohttp
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FAKE_ENV = {
+    "AZURE_ENV_NAME": "benchmark",
+    "AZURE_SUBSCRIPTION_ID": "benchmark",
+    "AZURE_RESOURCE_GROUP": "benchmark",
+    "AZURE_STORAGE_ACCOUNT": "benchmark",
+    "AZURE_STORAGE_CONTAINER": "benchmark",
+    "AZURE_STORAGE_QUEUE": "benchmark",
+    "AZURE_SEARCH_INDEX": "benchmark",
+    "AZURE_SEARCH_SERVICE": "benchmark",
+    "AZURE_FORMRECOGNIZER_SERVICE": "benchmark",
+    "OPENAI_API_KEY": "sk-benchmark",
+    "OPENAI_ORG_ID": "benchmark",
+    "EMB_MODEL_NAME": "text-embedding-ada-002",
+    "CHATGPT_MODEL": "gpt-4",
+    "CHATGPT_VISION_MODEL": "gpt-4-vision-preview",
+}
+CHAT_REQUEST = {
+    "messages": [{"role": "user", "content": "What was the revenue in 2023?"}],
+    "context": {"overrides": {"suggest_followup_questions": True}},
+    "session_state": None,
+}
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def process_tree(pid):
+    """pid and all its descendants, read from /proc"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+    return tree
+
+
+def rss_bytes(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+async def wait_until_healthy(url, timeout=60):
+    started = time.monotonic()
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() - started < timeout:
+            try:
+                async with session.get(f"{url}/health") as r:
+                    if r.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.25)
+    raise TimeoutError(f"{url} did not become healthy in {timeout}s")
+
+
+async def one_chat(session, url, results):
+    started = time.perf_counter()
+    first_byte = None
+    try:
+        async with session.post(f"{url}/chat", json=CHAT_REQUEST) as r:
+            if r.status != 200:
+                results["rejected" if r.status == 503 else "errors"] += 1
+                await r.read()
+                return
+            last_chunk = b""
+            async for last_chunk in r.content.iter_any():
+                if first_byte is None:
+                    first_byte = time.perf_counter()
+    except aiohttp.ClientError:
+        results["errors"] += 1
+        return
+    if b'"error"' in last_chunk:
+        # Errors raised while streaming arrive as the last line of a 200 response
+        results["errors"] += 1
+        return
+    finished = time.perf_counter()
+    results["latency"].append(finished - started)
+    results["ttfb"].append((first_byte or finished) - started)
+
+
+async def run_load(url, concurrency, requests, pids):
+    results = {"latency": [], "ttfb": [], "rejected": 0, "errors": 0}
+    peak_rss, baseline_rss = 0, rss_bytes(pids)
+    semaphore = asyncio.Semaphore(concurrency)
+    done = asyncio.Event()
+
+    async def sample_memory():
+        nonlocal peak_rss
+        while not done.is_set():
+            peak_rss = max(peak_rss, rss_bytes(pids))
+            await asyncio.sleep(0.2)
+
+    async def bounded(session):
+        async with semaphore:
+            await one_chat(session, url, results)
+
+    sampler = asyncio.create_task(sample_memory())
+    timeout = aiohttp.ClientTimeout(total=600)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    started = time.perf_counter()
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        await asyncio.gather(*(bounded(session) for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await sampler
+    return results, elapsed, baseline_rss, peak_rss
+
+
+def run_profile(profile, args, env):
+    port = args.port
+    url = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "main:app",
+            "-c",
+            "gunicorn.conf.py",
+            "--bind",
+            f"127.0.0.1:{port}",
+        ],
+        cwd=BACKEND_DIR,
+        env={**env, "SERVING_PROFILE": profile},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        asyncio.run(wait_until_healthy(url))
+        time.sleep(1)  # let every worker finish booting
+        pids = process_tree(server.pid)
+        results, elapsed, baseline, peak = asyncio.run(
+            run_load(url, args.concurrency, args.requests, pids)
+        )
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(timeout=60)
+    completed = len(results["latency"])
+    return {
+        "profile": profile,
+        "workers": len(pids) - 1,
+        "completed": completed,
+        "rejected": results["rejected"],
+        "errors": results["errors"],
+        "throughput_rps": round(completed / elapsed, 2),
+        "p50_ms": round(percentile(results["latency"], 50) * 1000, 1),
+        "p99_ms": round(percentile(results["latency"], 99) * 1000, 1),
+        "ttfb_p50_ms": round(percentile(results["ttfb"], 50) * 1000, 1),
+        "ttfb_p99_ms": round(percentile(results["ttfb"], 99) * 1000, 1),
+        "baseline_rss_mb": round(baseline / 2**20, 1),
+        "peak_rss_mb": round(peak / 2**20, 1),
+        "mb_per_stream": round((peak - baseline) / 2**20 / args.concurrency, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--profiles", nargs="+", default=["streaming", "classic"])
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--port", type=int, default=8050)
+    parser.add_argument("--openai-port", type=int, default=8051)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--token-ms", type=float, default=20)
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    env = {**FAKE_ENV, **os.environ}
+    env.update(
+        {
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{args.openai_port}/v1",
+            "SEARCH_BACKEND": "local",
+            "LOCAL_SEARCH_DIR": tempfile.mkdtemp(prefix="benchmark-search-"),
+            "MAX_ACTIVE_STREAMS": env.get("MAX_ACTIVE_STREAMS", "0"),
+        }
+    )
+    fake_openai = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.fake_openai",
+            "--port",
+            str(args.openai_port),
+            "--latency-ms",
+            str(args.latency_ms),
+            "--token-ms",
+            str(args.token_ms),
+        ],
+        cwd=BACKEND_DIR,
+    )
+    try:
+        time.sleep(1)
+        report = [run_profile(profile, args, env) for profile in args.profiles]
+    finally:
+        fake_openai.terminate()
+        fake_openai.wait()
+
+    columns = list(report[0].keys())
+    print(" | ".join(columns))
+    for row in report:
+        print(" | ".join(str(row[c]) for c in columns))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
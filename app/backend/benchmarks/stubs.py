@@ -0,0 +1,676 @@
+"""
+In-process stand-ins for gpt.client, gpt.aclient, az.search_client, az.blob_container, az.queue, az.lane_queues,
+az.form_recognizer and the worker container groups. They replay the recorded responses in benchmarks/fixtures
+(see benchmarks/record.py) after a configurable latency, so /chat and the ingestion pipeline can be benchmarked
+without Azure or OpenAI.
+
+    stubs = Stubs(Latency(openai=0.3, token=0.02))
+    stubs.install()
+"""
+import io
+import os
+import re
+import json
+import time
+import asyncio
+import itertools
+from copy import copy, deepcopy
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+from openai.types import CreateEmbeddingResponse
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from azure.ai.formrecognizer import AnalyzeResult
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    ResourceExistsError,
+    ResourceModifiedError,
+    ResourceNotFoundError,
+    ResourceNotModifiedError,
+)
+from azure.storage.queue import QueueMessage
+from benchmarks.fake_openai import fake_embedding
+from utils.job_scheduler import LANES
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def load_fixture(name: str):
+    with open(os.path.join(FIXTURES_DIR, f"{name}.json")) as f:
+        return json.load(f)
+
+
+class Latency:
+    """
+    Seconds added to every stubbed call.
+    `openai` before each OpenAI response, `token` between streamed chunks, `search` per search or upload,
+    `storage` per blob and queue call, `form_recognizer` per analyzed page.
+    """
+
+    def __init__(
+        self,
+        openai: float = 0.0,
+        token: float = 0.0,
+        search: float = 0.0,
+        storage: float = 0.0,
+        form_recognizer: float = 0.0,
+    ):
+        self.openai = openai
+        self.token = token
+        self.search = search
+        self.storage = storage
+        self.form_recognizer = form_recognizer
+
+    def to_dict(self) -> Dict[str, float]:
+        return dict(vars(self))
+
+
+def sleep(seconds: float):
+    if seconds > 0:
+        time.sleep(seconds)
+
+
+async def async_sleep(seconds: float):
+    if seconds > 0:
+        await asyncio.sleep(seconds)
+
+
+def embedding_response(inputs) -> CreateEmbeddingResponse:
+    record = load_fixture("embedding")
+    inputs = inputs if isinstance(inputs, list) else [inputs]
+    # Vectors are not recorded, a deterministic one is derived from the input instead
+    record["data"] = [
+        {"object": "embedding", "index": i, "embedding": fake_embedding(str(text))}
+        for i, text in enumerate(inputs)
+    ]
+    return CreateEmbeddingResponse(**record)
+
+
+class FakeOpenAI:
+    """Synchronous client, as used by the ingestion classes and llm/assistants.py"""
+
+    def __init__(self, latency: Latency, vision_model: str = ""):
+        self.latency = latency
+        self.vision_model = vision_model
+        self.completion = load_fixture("chat_completion")
+        self.vision = load_fixture("vision")
+        self.summary = load_fixture("assistant_summary")["text"]
+        self.calls: Dict[str, int] = {}
+        self.chat = SimpleNamespace(
+            completions=SimpleNamespace(create=self.create_chat_completion)
+        )
+        self.embeddings = SimpleNamespace(create=self.create_embedding)
+        self.beta = SimpleNamespace(
+            assistants=SimpleNamespace(
+                list=self.list_assistants, create=self.create_assistant
+            ),
+            threads=SimpleNamespace(
+                create=self.create_thread,
+                delete=self.count("threads.delete"),
+                messages=SimpleNamespace(
+                    create=self.count("messages.create"), list=self.list_messages
+                ),
+                runs=SimpleNamespace(create=self.run, retrieve=self.run),
+            ),
+        )
+
+    def count(self, name: str, result: Any = None):
+        def call(*args, **kwargs):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            return result
+
+        return call
+
+    def create_chat_completion(self, model: str, **kwargs) -> ChatCompletion:
+        self.count("chat.completions")()
+        sleep(self.latency.openai)
+        record = self.vision if model == self.vision_model else self.completion
+        return ChatCompletion(**record)
+
+    def create_embedding(self, model: str, input, **kwargs):
+        self.count("embeddings")()
+        sleep(self.latency.openai / 3)
+        return embedding_response(input)
+
+    def list_assistants(self, **kwargs):
+        return [
+            SimpleNamespace(id="asst_recorded", name="pedantic-geek-" + name)
+            for name in ("document-summarization", "page-scanning")
+        ]
+
+    def create_assistant(self, name: str, **kwargs):
+        return SimpleNamespace(id="asst_recorded", name=name)
+
+    def create_thread(self, **kwargs):
+        self.count("threads.create")()
+        return SimpleNamespace(id="thread_recorded")
+
+    def run(self, thread_id: str, **kwargs):
+        self.count("runs")()
+        # The summarization run completes after one OpenAI round trip
+        sleep(self.latency.openai)
+        return SimpleNamespace(id="run_recorded", status="completed")
+
+    def list_messages(self, thread_id: str, **kwargs):
+        self.count("messages.list")()
+        text = SimpleNamespace(value=self.summary)
+        message = SimpleNamespace(content=[SimpleNamespace(text=text)])
+        return SimpleNamespace(data=[message])
+
+
+class FakeChatStream:
+    def __init__(self, chunks: List[dict], token_latency: float):
+        self.chunks = chunks
+        self.token_latency = token_latency
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            await async_sleep(self.token_latency)
+            yield ChatCompletionChunk(**chunk)
+
+
+class FakeAsyncOpenAI:
+    """Asynchronous client, as used by llm/chat.py"""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.completion = load_fixture("chat_completion")
+        self.stream = load_fixture("chat_stream")
+        self.chat = SimpleNamespace(
+            completions=SimpleNamespace(create=self.create_chat_completion)
+        )
+        self.embeddings = SimpleNamespace(create=self.create_embedding)
+
+    async def create_chat_completion(self, stream: bool = False, **kwargs):
+        await async_sleep(self.latency.openai)
+        if stream:
+            return FakeChatStream(self.stream, self.latency.token)
+        return ChatCompletion(**self.completion)
+
+    async def create_embedding(self, model: str, input, **kwargs):
+        await async_sleep(self.latency.openai / 3)
+        return embedding_response(input)
+
+
+class FakeSearchResults:
+    def __init__(self, documents: List[dict]):
+        self.documents = documents
+
+    async def __aiter__(self):
+        for document in self.documents:
+            yield document
+
+
+class FakeSearchClient:
+    """Replays the recorded search results and accepts uploads"""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.results = load_fixture("search_results")
+        for result in self.results:
+            result["@search.captions"] = [
+                SimpleNamespace(**caption) for caption in result["@search.captions"]
+            ]
+        self.uploaded = 0
+
+    async def search(
+        self,
+        search_text=None,
+        top: Optional[int] = None,
+        select: Optional[str | List[str]] = None,
+        **kwargs,
+    ):
+        await async_sleep(self.latency.search)
+        results = self.results[:top] if top else self.results
+        if isinstance(select, str):
+            select = [field.strip() for field in select.split(",")]
+        return FakeSearchResults(
+            [
+                {
+                    key: value
+                    for key, value in result.items()
+                    if select is None or key in select or key.startswith("@search.")
+                }
+                for result in results
+            ]
+        )
+
+    async def upload_documents(self, documents: List[dict]):
+        await async_sleep(self.latency.search)
+        self.uploaded += len(documents)
+        return [
+            SimpleNamespace(key=d["id"], succeeded=True, status_code=201)
+            for d in documents
+        ]
+
+    merge_or_upload_documents = upload_documents
+
+    async def close(self):
+        pass
+
+
+class FakeBlob:
+    def __init__(self, data: bytes, etag: str = ""):
+        self.data = data
+        self.properties = {
+            "size": len(data),
+            "etag": etag,
+            "content_settings": {"content_type": "application/octet-stream"},
+        }
+
+    def readall(self) -> bytes:
+        return self.data
+
+    def read(self) -> bytes:
+        return self.data
+
+    def readinto(self, stream: io.IOBase) -> int:
+        return stream.write(self.data)
+
+
+class FakeLease:
+    def __init__(self, container: "FakeBlobContainer", name: str, duration: int):
+        self.container = container
+        self.name = name
+        self.duration = duration
+
+    def renew(self):
+        self.container.leases[self.name] = time.monotonic() + self.duration
+
+    def release(self):
+        self.container.leases.pop(self.name, None)
+
+
+class FakeBlobClient:
+    def __init__(self, container: "FakeBlobContainer", name: str):
+        self.container = container
+        self.name = name
+
+    def download_blob(self, etag: Optional[str] = None, match_condition=None):
+        return self.container.download_blob(self.name, etag, match_condition)
+
+    def acquire_lease(self, lease_duration: int = -1) -> FakeLease:
+        return self.container.acquire_lease(self.name, lease_duration)
+
+
+class FakeBlobContainer:
+    """An in-memory blob container"""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.blobs: Dict[str, bytes] = {}
+        self.metadata: Dict[str, dict] = {}
+        self.modified: Dict[str, datetime] = {}
+        self.etags: Dict[str, str] = {}
+        self.versions = itertools.count()
+        # Lease expiry (time.monotonic()) per leased blob
+        self.leases: Dict[str, float] = {}
+
+    def upload_blob(self, name: str, data, overwrite: bool = False, metadata=None):
+        sleep(self.latency.storage)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        elif hasattr(data, "read"):
+            data = data.read()
+        self.blobs[name] = data
+        self.etags[name] = f'"{next(self.versions)}"'
+        self.metadata[name] = metadata or {}
+        self.modified[name] = datetime.now(timezone.utc)
+
+    def download_blob(
+        self, name: str, etag: Optional[str] = None, match_condition=None
+    ) -> FakeBlob:
+        sleep(self.latency.storage)
+        if name not in self.blobs:
+            raise ResourceNotFoundError(f"The specified blob does not exist: {name}")
+        if match_condition == MatchConditions.IfModified and etag == self.etags[name]:
+            raise ResourceNotModifiedError("The condition specified was not met")
+        return FakeBlob(self.blobs[name], self.etags[name])
+
+    def get_blob_client(self, name: str):
+        return FakeBlobClient(self, name)
+
+    def acquire_lease(self, name: str, lease_duration: int) -> "FakeLease":
+        sleep(self.latency.storage)
+        if name not in self.blobs:
+            raise ResourceNotFoundError(f"The specified blob does not exist: {name}")
+        now = time.monotonic()
+        if self.leases.get(name, 0) > now:
+            raise ResourceExistsError(f"There is already a lease present: {name}")
+        self.leases[name] = now + lease_duration
+        return FakeLease(self, name, lease_duration)
+
+    def list_blobs(self, name_starts_with: str = ""):
+        sleep(self.latency.storage)
+        return [
+            SimpleNamespace(name=name, last_modified=modified, etag=self.etags[name])
+            for name, modified in list(self.modified.items())
+            if name.startswith(name_starts_with)
+        ]
+
+    def delete_blob(self, name: str, etag: Optional[str] = None, match_condition=None):
+        sleep(self.latency.storage)
+        if name not in self.blobs:
+            raise ResourceNotFoundError(f"The specified blob does not exist: {name}")
+        if (
+            match_condition == MatchConditions.IfNotModified
+            and etag != self.etags[name]
+        ):
+            raise ResourceModifiedError("The condition specified was not met")
+        for blobs in (self.blobs, self.metadata, self.modified, self.etags):
+            blobs.pop(name, None)
+
+
+class FakeQueue:
+    """
+    An in-memory storage queue. Received messages are hidden for their visibility timeout (30 s by default).
+    Like the service, every receive and update hands out a new pop receipt, and only the latest one can
+    update or delete the message.
+    """
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.messages: List[QueueMessage] = []
+        self.ids = itertools.count()
+        self.receipts = itertools.count()
+
+    def send_message(self, content: str):
+        sleep(self.latency.storage)
+        message = QueueMessage(content=content)
+        message.id = str(next(self.ids))
+        message.inserted_on = datetime.now(timezone.utc)
+        message.next_visible_on = message.inserted_on
+        message.dequeue_count = 0
+        self.messages.append(message)
+        return message
+
+    def receive_messages(
+        self,
+        max_messages: int = 1,
+        visibility_timeout: Optional[int] = None,
+        **kwargs,
+    ):
+        sleep(self.latency.storage)
+        now = datetime.now(timezone.utc)
+        received = [m for m in self.messages if m.next_visible_on <= now]
+        received = received[:max_messages]
+        for message in received:
+            message.dequeue_count += 1
+            message.next_visible_on = now + timedelta(
+                seconds=30 if visibility_timeout is None else visibility_timeout
+            )
+            message.pop_receipt = str(next(self.receipts))
+        return iter([copy(message) for message in received])
+
+    def peek_messages(self, max_messages: int = 1):
+        sleep(self.latency.storage)
+        now = datetime.now(timezone.utc)
+        return [m for m in self.messages if m.next_visible_on <= now][:max_messages]
+
+    def find(self, message: QueueMessage) -> QueueMessage:
+        """The stored message, if `message` holds its latest pop receipt"""
+        for stored in self.messages:
+            if stored.id == message.id and stored.pop_receipt == message.pop_receipt:
+                return stored
+        raise ResourceNotFoundError("The specified message does not exist.")
+
+    def update_message(self, message: QueueMessage, visibility_timeout: int = 0):
+        sleep(self.latency.storage)
+        stored = self.find(message)
+        stored.next_visible_on = datetime.now(timezone.utc) + timedelta(
+            seconds=visibility_timeout
+        )
+        stored.pop_receipt = str(next(self.receipts))
+        # Like the service, only the id, the new pop receipt and the visibility come back
+        receipt = QueueMessage(content=None)
+        receipt.id = stored.id
+        receipt.pop_receipt = stored.pop_receipt
+        receipt.next_visible_on = stored.next_visible_on
+        return receipt
+
+    def delete_message(self, message: QueueMessage):
+        sleep(self.latency.storage)
+        stored = self.find(message)
+        self.messages.remove(stored)
+
+    def get_queue_properties(self):
+        sleep(self.latency.storage)
+        # Like the service, the count includes the messages that are currently invisible
+        return SimpleNamespace(approximate_message_count=len(self.messages))
+
+
+class FakeContainerGroups:
+    """
+    A pool of container groups for utils/autoscaler.py, on a simulated clock (`clock`, in seconds):
+    a started group is "Starting" for `start_delay` seconds, then "Running".
+    """
+
+    def __init__(self, names: List[str], start_delay: float = 0.0):
+        self.names = names
+        self.start_delay = start_delay
+        self.clock = 0.0
+        self.started_at: Dict[str, Optional[float]] = {name: None for name in names}
+
+    def states(self) -> Dict[str, str]:
+        states = {}
+        for name, started_at in self.started_at.items():
+            if started_at is None:
+                states[name] = "Stopped"
+            elif self.clock - started_at < self.start_delay:
+                states[name] = "Starting"
+            else:
+                states[name] = "Running"
+        return states
+
+    def start(self, name: str):
+        if self.started_at[name] is None:
+            self.started_at[name] = self.clock
+
+    def stop(self, name: str):
+        self.started_at[name] = None
+
+
+# Invisible page numbers written by `make_pdf`, so the fake Form Recognizer knows which pages a part of a PDF has
+PAGE_MARKER = "[page {}]"
+PAGE_MARKER_PATTERN = re.compile(r"\[page (\d+)\]")
+
+
+def pdf_page_numbers(document) -> Optional[List[int]]:
+    """The page numbers `make_pdf` marked the pages of `document` with, None for other documents"""
+    import fitz
+
+    if not isinstance(document, bytes) or not document.startswith(b"%PDF"):
+        return None
+    with fitz.open("pdf", document) as doc:
+        numbers = [PAGE_MARKER_PATTERN.search(page.get_text()) for page in doc]
+    if not numbers or not all(numbers):
+        return None
+    return [int(number.group(1)) for number in numbers]
+
+
+class FakeFormRecognizer:
+    """
+    Replays the recorded prebuilt-layout result, repeated until it has `pages` pages
+    (the recorded page count when None), so documents of any size can be ingested.
+    A PDF of `make_pdf` that has only some of those pages (a part cut from a longer one) gets the result
+    of just these pages, numbered from 1 like the service numbers them.
+    """
+
+    def __init__(self, latency: Latency, pages: Optional[int] = None):
+        self.latency = latency
+        self.layout = load_fixture("layout")
+        self.pages = pages
+        self.results: Dict[Any, AnalyzeResult] = {}
+        self.calls = 0
+
+    def analyze_result(self, pages: Optional[int] = None) -> AnalyzeResult:
+        pages = pages or len(self.layout["pages"])
+        if pages not in self.results:
+            self.results[pages] = AnalyzeResult.from_dict(
+                repeat_layout(self.layout, pages)
+            )
+        return self.results[pages]
+
+    def range_result(self, pages: int, first: int, last: int) -> AnalyzeResult:
+        """The result of analyzing pages `first` to `last` only, as the service returns it for `pages="first-last"`"""
+        key = (pages, first, last)
+        if key not in self.results:
+            self.results[key] = AnalyzeResult.from_dict(
+                slice_layout(repeat_layout(self.layout, pages), first, last)
+            )
+        return self.results[key]
+
+    def part_result(self, pages: int, first: int, last: int) -> AnalyzeResult:
+        """The result of analyzing a PDF of pages `first` to `last` only"""
+        key = ("part", pages, first, last)
+        if key not in self.results:
+            self.results[key] = AnalyzeResult.from_dict(
+                renumber_layout(
+                    slice_layout(repeat_layout(self.layout, pages), first, last),
+                    first,
+                )
+            )
+        return self.results[key]
+
+    def begin_analyze_document(
+        self, model_id: str, document=None, pages: Optional[str] = None, **kwargs
+    ):
+        self.calls += 1
+        total = self.pages or len(self.layout["pages"])
+        numbers = pdf_page_numbers(document)
+        if pages:
+            first, last = (int(page) for page in pages.split("-"))
+            result = self.range_result(total, first, last)
+        elif numbers and (numbers[0] != 1 or len(numbers) < total):
+            result = self.part_result(total, numbers[0], numbers[-1])
+        else:
+            result = self.analyze_result(self.pages)
+        sleep(self.latency.form_recognizer * len(result.pages))
+        return SimpleNamespace(result=lambda: result)
+
+
+def repeat_layout(layout: Dict[str, Any], pages: int) -> Dict[str, Any]:
+    """Concatenates copies of a layout result, shifting offsets and page numbers"""
+    recorded_pages = len(layout["pages"])
+    repeated = deepcopy(layout)
+    repeated["content"], repeated["pages"], repeated["tables"] = "", [], []
+    for copy in range((pages + recorded_pages - 1) // recorded_pages):
+        offset = len(repeated["content"])
+        first_page = copy * recorded_pages
+        repeated["content"] += layout["content"]
+        for page in deepcopy(layout["pages"]):
+            if len(repeated["pages"]) == pages:
+                break
+            page["page_number"] += first_page
+            for span in page["spans"]:
+                span["offset"] += offset
+            repeated["pages"].append(page)
+        for table in deepcopy(layout["tables"]):
+            for region in table["bounding_regions"] + [
+                r for cell in table["cells"] for r in cell["bounding_regions"]
+            ]:
+                region["page_number"] += first_page
+            for span in table["spans"] + [
+                s for cell in table["cells"] for s in cell["spans"]
+            ]:
+                span["offset"] += offset
+            if table["bounding_regions"][0]["page_number"] <= pages:
+                repeated["tables"].append(table)
+    return repeated
+
+
+def slice_layout(layout: Dict[str, Any], first: int, last: int) -> Dict[str, Any]:
+    """Pages `first` to `last` of a layout result, their content and tables with offsets from the sliced content"""
+    sliced = deepcopy(layout)
+    sliced["content"], sliced["pages"], sliced["tables"] = "", [], []
+    shifts = {}
+    for page in deepcopy(layout["pages"]):
+        if not first <= page["page_number"] <= last:
+            continue
+        span = page["spans"][0]
+        if sliced["content"]:
+            sliced["content"] += "\n"
+        shifts[page["page_number"]] = len(sliced["content"]) - span["offset"]
+        sliced["content"] += layout["content"][
+            span["offset"] : span["offset"] + span["length"]
+        ]
+        for page_span in page["spans"]:
+            page_span["offset"] += shifts[page["page_number"]]
+        sliced["pages"].append(page)
+    for table in deepcopy(layout["tables"]):
+        shift = shifts.get(table["bounding_regions"][0]["page_number"])
+        if shift is None:
+            continue
+        for span in table["spans"] + [
+            s for cell in table["cells"] for s in cell["spans"]
+        ]:
+            span["offset"] += shift
+        sliced["tables"].append(table)
+    return sliced
+
+
+def renumber_layout(layout: Dict[str, Any], first: int) -> Dict[str, Any]:
+    """Page numbers of a sliced layout counted from its `first` page, in place"""
+    for page in layout["pages"]:
+        page["page_number"] -= first - 1
+    for table in layout["tables"]:
+        for region in table["bounding_regions"] + [
+            r for cell in table["cells"] for r in cell["bounding_regions"]
+        ]:
+            region["page_number"] -= first - 1
+    return layout
+
+
+def make_pdf(pages: int, text: Optional[str] = None, scanned_every: int = 0) -> bytes:
+    """
+    A PDF with `pages` pages of text, for the GPT-4V ingestion path.
+    With `scanned_every`, every n-th page (starting with the first) is an image of the text without a text layer,
+    like a scanned page. Every page carries its number in invisible text (PAGE_MARKER).
+    """
+    import fitz
+
+    text = text or load_fixture("layout")["content"]
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        page.insert_textbox(fitz.Rect(50, 50, 550, 800), text, fontsize=9)
+        if scanned_every and i % scanned_every == 0:
+            pixmap = page.get_pixmap(dpi=100)
+            doc.delete_page(i)
+            page = doc.new_page(i)
+            page.insert_image(page.rect, pixmap=pixmap)
+        page.insert_text((0, 10), PAGE_MARKER.format(i + 1), fontsize=1, render_mode=3)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+class Stubs:
+    """Builds every stand-in and swaps them into `gpt`, `az` and llm/assistants.py"""
+
+    def __init__(self, latency: Optional[Latency] = None, pages: Optional[int] = None):
+        from config import gpt
+
+        self.latency = latency or Latency()
+        self.client = FakeOpenAI(self.latency, vision_model=gpt.CHATGPT_VISION_MODEL)
+        self.aclient = FakeAsyncOpenAI(self.latency)
+        self.search_client = FakeSearchClient(self.latency)
+        self.blob_container = FakeBlobContainer(self.latency)
+        self.queue = FakeQueue(self.latency)
+        self.lane_queues = {lane: FakeQueue(self.latency) for lane in LANES}
+        self.form_recognizer = FakeFormRecognizer(self.latency, pages)
+
+    def install(self):
+        from config import az, gpt
+        import llm.assistants
+
+        gpt.client = self.client
+        gpt.aclient = self.aclient
+        az.search_client = self.search_client
+        az.blob_container = self.blob_container
+        az.queue = self.queue
+        az.lane_queues = self.lane_queues
+        az.form_recognizer = self.form_recognizer
+        # Assistants are looked up through the module level client
+        llm.assistants.openai = self.client
+        return self
@@ -10,6 +10,12 @@ logger = Logger(
     name=os.getenv("AZURE_ENV_NAME"),
     file=True,
     level=os.getenv("APP_LOG_LEVEL", "INFO"),
+    log_format=config.LOG_FORMAT,
+    max_message_length=config.LOG_MAX_MESSAGE_LENGTH,
+    payload_sample_rate=config.LOG_PAYLOAD_SAMPLE_RATE,
+    file_max_bytes=config.LOG_FILE_MAX_BYTES,
+    file_backups=config.LOG_FILE_BACKUPS,
+    queue_size=config.LOG_QUEUE_SIZE,
 )
 
 az = AzureConfig()
@@ -10,3 +10,115 @@ class ApiConfig:
     USE_SEARCH = os.getenv("USE_SEARCH", False)
     TEMPERATURE = os.getenv("TEMPERATURE", 0.5)
     APP_LOG_LEVEL = os.getenv("APP_LOG_LEVEL", "INFO")
+    # Logging: "text" or "json", messages longer than LOG_MAX_MESSAGE_LENGTH are truncated (0 disables),
+    # LOG_PAYLOAD_SAMPLE_RATE is the share of large payloads (search results, model outputs) that are logged
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+    LOG_MAX_MESSAGE_LENGTH = int(os.getenv("LOG_MAX_MESSAGE_LENGTH", 4000))
+    LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", 1.0))
+    LOG_FILE_MAX_BYTES = int(os.getenv("LOG_FILE_MAX_BYTES", 10 * 2**20))
+    LOG_FILE_BACKUPS = int(os.getenv("LOG_FILE_BACKUPS", 5))
+    LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+    RETRIEVAL_PROFILE = os.getenv("RETRIEVAL_PROFILE", "hybrid+semantic")
+    # Prompt budget of the answer call in tokens, per model as "model=tokens,..." with PROMPT_TOKEN_BUDGET as default.
+    # Sources get at most SOURCES_TOKEN_SHARE of what the system prompt and question leave, history the rest.
+    PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", 8000))
+    PROMPT_TOKEN_BUDGETS = os.getenv("PROMPT_TOKEN_BUDGETS", "")
+    SOURCES_TOKEN_SHARE = float(os.getenv("SOURCES_TOKEN_SHARE", 0.75))
+    # Rolling history memory (see llm/history.py): messages before the last HISTORY_WINDOW are summarized,
+    # HISTORY_MEMORY_STEP at a time, and the query rewrite only sees the last REWRITE_HISTORY_WINDOW messages
+    HISTORY_MEMORY = os.getenv("HISTORY_MEMORY", "true").lower() in ("1", "true", "on")
+    HISTORY_WINDOW = int(os.getenv("HISTORY_WINDOW", 6))
+    REWRITE_HISTORY_WINDOW = int(os.getenv("REWRITE_HISTORY_WINDOW", 2))
+    HISTORY_MEMORY_STEP = int(os.getenv("HISTORY_MEMORY_STEP", 4))
+    HISTORY_MEMORY_MAX_TOKENS = int(os.getenv("HISTORY_MEMORY_MAX_TOKENS", 300))
+    HISTORY_MEMORY_CACHE_SIZE = int(os.getenv("HISTORY_MEMORY_CACHE_SIZE", 1000))
+    # Signs the memory returned in session_state; without it every process uses a random key of its own
+    HISTORY_MEMORY_SECRET = os.getenv("HISTORY_MEMORY_SECRET", "")
+    # Query rewrite: "auto" searches with the question itself on the first turn and for self-contained questions,
+    # "always" rewrites every question. Rewrites are cached per worker (0 disables the cache).
+    REWRITE_POLICY = os.getenv("REWRITE_POLICY", "auto")
+    REWRITE_MIN_WORDS = int(os.getenv("REWRITE_MIN_WORDS", 4))
+    REWRITE_CACHE_SIZE = int(os.getenv("REWRITE_CACHE_SIZE", 1000))
+    # Semantic answer cache for first-turn questions (see utils/answer_cache.py)
+    ANSWER_CACHE = os.getenv("ANSWER_CACHE", "false").lower() in ("1", "true", "on")
+    ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+    ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", 1000))
+    ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", 86400))
+    ANSWER_CACHE_SYNC_INTERVAL = float(os.getenv("ANSWER_CACHE_SYNC_INTERVAL", 30))
+    # Identical concurrent rewrites, embeddings and searches share one upstream call (0 disables coalescing)
+    SINGLE_FLIGHT_MAX_WAITERS = int(os.getenv("SINGLE_FLIGHT_MAX_WAITERS", 100))
+    # Streaming: "ndjson" or "sse", and the window used to merge token deltas (0 disables)
+    STREAM_TRANSPORT = os.getenv("STREAM_TRANSPORT", "ndjson")
+    STREAM_COALESCE_MS = int(os.getenv("STREAM_COALESCE_MS", 0))
+    STREAM_COALESCE_BYTES = int(os.getenv("STREAM_COALESCE_BYTES", 0))
+    # Per-worker admission control for /chat (0 disables the limit)
+    MAX_ACTIVE_STREAMS = int(os.getenv("MAX_ACTIVE_STREAMS", 64))
+    MAX_QUEUED_REQUESTS = int(os.getenv("MAX_QUEUED_REQUESTS", 32))
+    QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", 10))
+    DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", 220))
+    # v-scan documents: pages covered by their text layer are extracted with PyMuPDF, the others are sent to
+    # GPT-4V (see llm/page_classifier.py). SCAN_TEXT_FIRST=false scans every page with the vision model.
+    SCAN_TEXT_FIRST = os.getenv("SCAN_TEXT_FIRST", "true").lower() in (
+        "1",
+        "true",
+        "on",
+    )
+    SCAN_MIN_TEXT_CHARS = int(os.getenv("SCAN_MIN_TEXT_CHARS", 200))
+    SCAN_MAX_IMAGE_COVERAGE = float(os.getenv("SCAN_MAX_IMAGE_COVERAGE", 0.3))
+    SCAN_MAX_DRAWINGS = int(os.getenv("SCAN_MAX_DRAWINGS", 50))
+    # Reuse the ingestion result of content uploaded before, under any filename (see utils/content_registry.py)
+    CONTENT_DEDUP = os.getenv("CONTENT_DEDUP", "true").lower() in ("1", "true", "on")
+    # Ingestion job lanes (see utils/job_scheduler.py): uploads go to the queue "<AZURE_STORAGE_QUEUE>-<lane>" of
+    # their priority ("interactive", or "bulk" when the upload asks for it) and size (large from JOB_LARGE_PAGES
+    # pages). Workers share the pages they ingest between the lanes by JOB_LANE_WEIGHTS, run at most
+    # JOB_LARGE_SLOTS large jobs at once (0 for no cap) and pick the least served tenant out of JOB_TENANT_WINDOW
+    # messages. JOB_LANES=false keeps the single queue.
+    JOB_LANES = os.getenv("JOB_LANES", "true").lower() in ("1", "true", "on")
+    JOB_LARGE_PAGES = int(os.getenv("JOB_LARGE_PAGES", 50))
+    JOB_LARGE_SLOTS = int(os.getenv("JOB_LARGE_SLOTS", 2))
+    JOB_LANE_WEIGHTS = {
+        lane: int(weight)
+        for lane, weight in (
+            item.split(":")
+            for item in os.getenv(
+                "JOB_LANE_WEIGHTS",
+                "interactive-small:8,interactive-large:4,bulk-small:2,bulk-large:1",
+            ).split(",")
+        )
+    }
+    JOB_TENANT_WINDOW = int(os.getenv("JOB_TENANT_WINDOW", 16))
+    # Seconds a running job's message stays invisible; the worker renews it every third of that while the job runs,
+    # so a job outlives it, and the message of a worker that died reappears after it
+    JOB_VISIBILITY_TIMEOUT = int(os.getenv("JOB_VISIBILITY_TIMEOUT", 300))
+    # Job status (see utils/job_status.py): seconds between the progress updates a worker writes, and how often
+    # /jobs/<id>/events checks for changes, sends a keep-alive comment, and how long it streams at most
+    JOB_STATUS_INTERVAL = float(os.getenv("JOB_STATUS_INTERVAL", 2))
+    # Statuses not updated for JOB_STATUS_TTL seconds are deleted by idle workers, at most every
+    # JOB_STATUS_EXPIRY_INTERVAL seconds
+    JOB_STATUS_TTL = int(os.getenv("JOB_STATUS_TTL", 7 * 24 * 3600))
+    JOB_STATUS_EXPIRY_INTERVAL = int(os.getenv("JOB_STATUS_EXPIRY_INTERVAL", 3600))
+    JOB_EVENTS_POLL_INTERVAL = float(os.getenv("JOB_EVENTS_POLL_INTERVAL", 1))
+    JOB_EVENTS_HEARTBEAT = float(os.getenv("JOB_EVENTS_HEARTBEAT", 15))
+    JOB_EVENTS_TIMEOUT = float(os.getenv("JOB_EVENTS_TIMEOUT", 3600))
+    # Autoscaling of the ACI task workers (see utils/autoscaler.py), run by the web tier. Workers write a heartbeat
+    # every AUTOSCALE_HEARTBEAT_INTERVAL seconds; the controller sizes the pool for AUTOSCALE_JOBS_PER_WORKER queued
+    # or running jobs per worker, adds one while the oldest message is older than AUTOSCALE_MAX_AGE seconds, and
+    # scales down once fewer workers have been enough for AUTOSCALE_DOWN_DELAY seconds.
+    AUTOSCALE = os.getenv("AUTOSCALE", "false").lower() in ("1", "true", "on")
+    AUTOSCALE_INTERVAL = float(os.getenv("AUTOSCALE_INTERVAL", 30))
+    AUTOSCALE_MIN_WORKERS = int(os.getenv("AUTOSCALE_MIN_WORKERS", 1))
+    AUTOSCALE_MAX_WORKERS = int(os.getenv("AUTOSCALE_MAX_WORKERS", 4))
+    AUTOSCALE_JOBS_PER_WORKER = int(os.getenv("AUTOSCALE_JOBS_PER_WORKER", 4))
+    AUTOSCALE_MAX_AGE = float(os.getenv("AUTOSCALE_MAX_AGE", 300))
+    AUTOSCALE_UP_COOLDOWN = float(os.getenv("AUTOSCALE_UP_COOLDOWN", 60))
+    AUTOSCALE_DOWN_DELAY = float(os.getenv("AUTOSCALE_DOWN_DELAY", 600))
+    AUTOSCALE_HEARTBEAT_INTERVAL = float(os.getenv("AUTOSCALE_HEARTBEAT_INTERVAL", 30))
+    # Task worker mode: "online" ingests one document at a time, "backfill" collects up to BACKFILL_DOCUMENTS
+    # queued documents and ingests them through the OpenAI Batch API (see llm/backfill.py). Backfill messages stay
+    # invisible for BACKFILL_VISIBILITY_TIMEOUT seconds, after which unfinished documents are picked up again.
+    INGESTION_MODE = os.getenv("INGESTION_MODE", "online")
+    BACKFILL_DOCUMENTS = int(os.getenv("BACKFILL_DOCUMENTS", 500))
+    BACKFILL_POLL_INTERVAL = float(os.getenv("BACKFILL_POLL_INTERVAL", 60))
+    BACKFILL_VISIBILITY_TIMEOUT = int(os.getenv("BACKFILL_VISIBILITY_TIMEOUT", 172800))
+    # Port of the task worker's Prometheus endpoint (0 disables it)
+    INGESTION_METRICS_PORT = int(os.getenv("INGESTION_METRICS_PORT", 0))
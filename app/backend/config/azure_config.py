@@ -2,27 +2,9 @@ import os
 from azure.identity import DefaultAzureCredential
 from azure.storage.queue import QueueServiceClient
 from azure.storage.blob import BlobServiceClient
-from azure.ai.formrecognizer import DocumentAnalysisClient
 from azure.search.documents.aio import SearchClient
-from azure.search.documents.indexes import SearchIndexClient
-from azure.search.documents.indexes.models import (
-    HnswParameters,
-    SearchableField,
-    SearchField,
-    SearchIndex,
-    SemanticConfiguration,
-    SemanticField,
-    SimpleField,
-    VectorSearch,
-    SearchFieldDataType,
-    SemanticConfiguration,
-    SemanticPrioritizedFields,
-    HnswAlgorithmConfiguration,
-    VectorSearchAlgorithmKind,
-    VectorSearchAlgorithmMetric,
-    VectorSearchProfile,
-    SemanticSearch,
-)
+from utils.search_backend import LocalSearchClient
+from utils.job_scheduler import LANES
 
 
 class AzureConfig:
@@ -35,6 +17,25 @@ class AzureConfig:
     SEARCH_INDEX = os.environ["AZURE_SEARCH_INDEX"]
     SEARCH_SERVICE = os.environ["AZURE_SEARCH_SERVICE"]
     FORMRECOGNIZER_SERVICE = os.environ["AZURE_FORMRECOGNIZER_SERVICE"]
+    # The first container group of the task worker pool, and the group this worker runs in
+    TASKS_CONTAINER_GROUP = os.getenv("AZURE_TASKS_CONTAINER_GROUP", "")
+    WORKER_ID = os.getenv("WORKER_ID", "")
+    # Longer PDFs are analyzed in page ranges of this size, FORM_RECOGNIZER_CONCURRENCY at a time (0 disables)
+    FORM_RECOGNIZER_PAGES_PER_CALL = int(
+        os.getenv("FORM_RECOGNIZER_PAGES_PER_CALL", 20)
+    )
+    FORM_RECOGNIZER_CONCURRENCY = int(os.getenv("FORM_RECOGNIZER_CONCURRENCY", 4))
+    # "azure" or "local" (in-process index, see utils/search_backend.py)
+    SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "azure")
+    LOCAL_SEARCH_DIR = os.getenv("LOCAL_SEARCH_DIR", "local_search")
+    _form_recognizer = None
+    # Sections sent per indexing request. The search documents (with their embeddings) are built one batch at
+    # a time; Azure Cognitive Search takes up to 1000 documents and 16 MB per request.
+    SEARCH_UPLOAD_BATCH_SIZE = int(os.getenv("SEARCH_UPLOAD_BATCH_SIZE", 100))
+    # Whether search results may return the embedding vectors (1536 floats per hit)
+    SEARCH_VECTORS_RETRIEVABLE = (
+        os.getenv("SEARCH_VECTORS_RETRIEVABLE", "false").lower() == "true"
+    )
 
     def configure_clients(self):
         self.credential = DefaultAzureCredential()
@@ -52,17 +53,40 @@ class AzureConfig:
         )
 
         self.queue = self.queue_service.get_queue_client(self.STORAGE_QUEUE)
+        # One queue per scheduling lane (see utils/job_scheduler.py)
+        self.lane_queues = {
+            lane: self.queue_service.get_queue_client(f"{self.STORAGE_QUEUE}-{lane}")
+            for lane in LANES
+        }
 
-        self.search_client = SearchClient(
-            endpoint=f"https://{self.SEARCH_SERVICE}.search.windows.net",
-            index_name=self.SEARCH_INDEX,
-            credential=self.credential,
-        )
-        self.form_recognizer = DocumentAnalysisClient(
-            endpoint=f"https://{self.FORMRECOGNIZER_SERVICE}.cognitiveservices.azure.com/",
-            credential=self.credential,
-            headers={"x-ms-useragent": "pedantic-geek/1.0.0"},
-        )
+        if self.SEARCH_BACKEND == "local":
+            self.search_client = LocalSearchClient(
+                os.path.join(self.LOCAL_SEARCH_DIR, self.SEARCH_INDEX)
+            )
+        else:
+            self.search_client = SearchClient(
+                endpoint=f"https://{self.SEARCH_SERVICE}.search.windows.net",
+                index_name=self.SEARCH_INDEX,
+                credential=self.credential,
+            )
+        self._form_recognizer = None
+
+    @property
+    def form_recognizer(self):
+        """Created on first use: only the task worker analyzes documents"""
+        if self._form_recognizer is None:
+            from azure.ai.formrecognizer import DocumentAnalysisClient
+
+            self._form_recognizer = DocumentAnalysisClient(
+                endpoint=f"https://{self.FORMRECOGNIZER_SERVICE}.cognitiveservices.azure.com/",
+                credential=self.credential,
+                headers={"x-ms-useragent": "pedantic-geek/1.0.0"},
+            )
+        return self._form_recognizer
+
+    @form_recognizer.setter
+    def form_recognizer(self, client):
+        self._form_recognizer = client
 
     def attrs_to_dict(self):
         attributes = {}
@@ -75,6 +99,30 @@ class AzureConfig:
         return attributes
 
     def create_search_index(self):
+        if self.SEARCH_BACKEND == "local":
+            # The local index is schemaless and created on first upload
+            return
+        # The index management SDK is only needed once, at startup
+        from azure.search.documents.indexes import SearchIndexClient
+        from azure.search.documents.indexes.models import (
+            HnswParameters,
+            SearchableField,
+            SearchField,
+            SearchIndex,
+            SemanticConfiguration,
+            SemanticField,
+            SimpleField,
+            VectorSearch,
+            SearchFieldDataType,
+            SemanticConfiguration,
+            SemanticPrioritizedFields,
+            HnswAlgorithmConfiguration,
+            VectorSearchAlgorithmKind,
+            VectorSearchAlgorithmMetric,
+            VectorSearchProfile,
+            SemanticSearch,
+        )
+
         self.search_index_client = SearchIndexClient(
             endpoint=f"https://{self.SEARCH_SERVICE}.search.windows.net/",
             credential=self.credential,
@@ -88,7 +136,7 @@ class AzureConfig:
                 SearchField(
                     name="embedding",
                     type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
-                    hidden=False,
+                    hidden=not self.SEARCH_VECTORS_RETRIEVABLE,
                     searchable=True,
                     filterable=False,
                     sortable=False,
@@ -165,3 +213,15 @@ class AzureConfig:
                 semantic_search=semantic_search,
             )
             self.search_index_client.create_index(index)
+        else:
+            self.update_vector_retrievability()
+
+    def update_vector_retrievability(self):
+        """Retrievability can be changed on an existing index without reindexing"""
+        index = self.search_index_client.get_index(self.SEARCH_INDEX)
+        hidden = not self.SEARCH_VECTORS_RETRIEVABLE
+        for field in index.fields:
+            if field.name == "embedding" and field.hidden != hidden:
+                field.hidden = hidden
+                self.search_index_client.create_or_update_index(index)
+                break
@@ -1,7 +1,14 @@
 # Imports for local logging
 import os
+import sys
+import json
+import queue
+import atexit
+import random
 import logging
-import traceback
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, List
 
 
 class CustomFormatter(logging.Formatter):
@@ -24,69 +31,219 @@ class CustomFormatter(logging.Formatter):
             logging.ERROR: self.red + self.fmt + self.reset,
             logging.CRITICAL: self.bold_red + self.fmt + self.reset,
         }
+        # Formatters are built once, not for every record
+        self.formatters = {
+            level: logging.Formatter(log_fmt) for level, log_fmt in self.FORMATS.items()
+        }
+        self.default_formatter = logging.Formatter(self.fmt)
+
+    def format(self, record):
+        formatter = self.formatters.get(record.levelno, self.default_formatter)
+        text = formatter.format(record)
+        if fields := getattr(record, "fields", None):
+            text += " " + json.dumps(fields, default=str)
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the structured fields passed to the Logger methods"""
 
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt)
-        return formatter.format(record)
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if fields := getattr(record, "fields", None):
+            entry.update(fields)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class AsyncQueueHandler(QueueHandler):
+    """
+    Hands records to a bounded queue; a listener thread formats them and writes them to `targets`.
+    The listener is started lazily in every process, so it survives gunicorn forking workers.
+    When the queue is full, records are dropped and counted instead of blocking the caller.
+    """
+
+    def __init__(self, targets: List[logging.Handler], maxsize: int = 10000):
+        super().__init__(queue.Queue(maxsize))
+        self.targets = targets
+        self.maxsize = maxsize
+        self.listener = None
+        self.pid = None
+        self.dropped = 0
+
+    def start(self):
+        self.queue = queue.Queue(self.maxsize)
+        self.listener = QueueListener(
+            self.queue, *self.targets, respect_handler_level=True
+        )
+        self.listener.start()
+        self.pid = os.getpid()
+
+    def stop(self):
+        """Flushes the queued records"""
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+        self.listener = None
+        self.pid = None
+
+    def prepare(self, record):
+        # Formatting happens on the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped:
+                self.queue.put_nowait(
+                    logging.makeLogRecord(
+                        {
+                            "name": record.name,
+                            "levelno": logging.WARNING,
+                            "levelname": "WARNING",
+                            "msg": f"Dropped {self.dropped} log records, the log queue was full",
+                        }
+                    )
+                )
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
 
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        super().emit(record)
 
-def create_logger(name, file, level):
+    def close(self):
+        self.stop()
+        super().close()
+
+
+def create_logger(
+    name,
+    file,
+    level,
+    log_format="text",
+    file_max_bytes=10 * 2**20,
+    file_backups=5,
+    queue_size=10000,
+):
     """Creates a logger"""
     logger = logging.getLogger(name)
     logger.setLevel(getattr(logging, level))
     # Create formatter and apply it to both handlers
     fmt = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    json_formatter = JsonFormatter() if log_format == "json" else None
+    handlers = []
     if bool(file):
         if not os.path.exists(os.getcwd() + "/logs"):
             os.mkdir(os.getcwd() + "/logs")
-            # Create a log file handler to write all logs
-        try:
-            os.remove(os.getcwd() + f"/logs/{name}.log")
-        except:
-            pass
-        file_logger = logging.FileHandler(os.getcwd() + f"/logs/{name}.log")
+        # Create a log file handler to write all logs, rotated instead of truncated at startup
+        file_logger = RotatingFileHandler(
+            os.getcwd() + f"/logs/{name}.log",
+            maxBytes=file_max_bytes,
+            backupCount=file_backups,
+        )
         file_logger.setLevel(getattr(logging, level))
-        file_logger.setFormatter(CustomFormatter(fmt))
-        logger.addHandler(file_logger)
-    # Create a console log handler to handle only ERROR level logs
+        file_logger.setFormatter(json_formatter or logging.Formatter(fmt))
+        handlers.append(file_logger)
+    # Create a console log handler to handle only INFO and above
     console_logger = logging.StreamHandler()
     console_logger.setLevel(logging.INFO)
-    console_logger.setFormatter(CustomFormatter(fmt))
-    logger.addHandler(console_logger)
+    console_logger.setFormatter(json_formatter or CustomFormatter(fmt))
+    handlers.append(console_logger)
+
+    queue_handler = AsyncQueueHandler(handlers, maxsize=queue_size)
+    logger.addHandler(queue_handler)
+    atexit.register(queue_handler.stop)
 
     return logger
 
 
 class Logger:
-    def __init__(self, name: str, file: bool | str, level: str):
-        self.logger = create_logger(name, file, level)
+    """
+    Attributes:
+        max_message_length (int): Longer messages are truncated (0 disables the cap).
+        payload_sample_rate (float): Share of `payload` calls that are logged.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        file: bool | str,
+        level: str,
+        log_format: str = "text",
+        max_message_length: int = 4000,
+        payload_sample_rate: float = 1.0,
+        file_max_bytes: int = 10 * 2**20,
+        file_backups: int = 5,
+        queue_size: int = 10000,
+    ):
+        self.logger = create_logger(
+            name, file, level, log_format, file_max_bytes, file_backups, queue_size
+        )
         self.logger.setLevel(level)
+        self.max_message_length = max_message_length
+        self.payload_sample_rate = payload_sample_rate
 
     def log(self, exception):
-        getattr(self.logger, exception["level"])(exception["message"])
-        return exception["message"]
+        message = str(exception["message"])
+        if self.max_message_length and len(message) > self.max_message_length:
+            message = (
+                message[: self.max_message_length]
+                + f"... [{len(message) - self.max_message_length} more characters]"
+            )
+        getattr(self.logger, exception["level"])(
+            message,
+            exc_info=exception.get("exc_info", False),
+            extra={"fields": exception.get("fields") or {}},
+        )
+        return message
 
-    def info(self, text):
+    def info(self, text, **fields):
         return self.log(
             {
                 "message": text,
                 "level": "info",
+                "fields": fields,
             }
         )
 
-    def debug(self, text):
-        return self.log({"message": text, "level": "debug"})
+    def debug(self, text, **fields):
+        return self.log({"message": text, "level": "debug", "fields": fields})
+
+    def warning(self, text, **fields):
+        return self.log({"message": text, "level": "warning", "fields": fields})
 
-    def warning(self, text):
-        return self.log({"message": text, "level": "warning"})
+    def error(self, text, **fields):
+        # The traceback is attached only while an exception is being handled
+        return self.log(
+            {
+                "message": text,
+                "level": "error",
+                "fields": fields,
+                "exc_info": sys.exc_info()[0] is not None,
+            }
+        )
 
-    def error(self, text):
-        tb = traceback.format_exc()
-        return self.log({"message": str(text) + f"\nTraceback: {tb}", "level": "error"})
+    def exception(self, text, **fields):
+        return self.error(text, **fields)
 
-    def exception(self, text):
-        return self.error(text)
+    def payload(self, label: str, payload: Any, level: str = "debug"):
+        """
+        Logs a potentially large payload (search results, model outputs).
+        Skipped without building the message when the level is disabled or the call is not sampled.
+        """
+        if not self.logger.isEnabledFor(getattr(logging, level.upper())):
+            return
+        if random.random() >= self.payload_sample_rate:
+            return
+        self.log({"message": f"{label}: {payload}", "level": level})
 
     def embedding_limit_reached(self, retry_state):
         self.warning(
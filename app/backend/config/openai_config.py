@@ -1,5 +1,9 @@
 import os
+import tempfile
+import httpx
 import openai
+from openai._constants import DEFAULT_LIMITS
+from utils.rate_limiter import FileBackend, MemoryBackend, RateLimiter, parse_limits
 
 
 class OpenAIConfig:
@@ -9,10 +13,57 @@ class OpenAIConfig:
     EMB_MODEL_NAME = os.environ["EMB_MODEL_NAME"]
     CHATGPT_MODEL = os.environ["CHATGPT_MODEL"]
     CHATGPT_VISION_MODEL = os.environ["CHATGPT_VISION_MODEL"]
+    # A smaller, faster model can be used for the query rewrite
+    REWRITE_MODEL = os.getenv("REWRITE_MODEL") or CHATGPT_MODEL
+    # Client-side rate limiting (see utils/rate_limiter.py): "file" shares the budget between the processes
+    # of a host, "memory" keeps it per process, "off" disables it.
+    RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "file")
+    RATE_LIMIT_DIR = os.getenv(
+        "RATE_LIMIT_DIR", os.path.join(tempfile.gettempdir(), "openai-rate-limits")
+    )
+    # Known limits as "model=rpm:tpm,...", otherwise they are learnt from the response headers
+    RATE_LIMITS = os.getenv("OPENAI_RATE_LIMITS", "")
+    # Share of the budget that bulk calls (ingestion) leave to interactive ones (chat)
+    RATE_LIMIT_BULK_HEADROOM = float(os.getenv("RATE_LIMIT_BULK_HEADROOM", 0.2))
+
+    # Batch API used by the backfill ingestion mode: "openai", or "local" to run the requests directly (tests)
+    BATCH_BACKEND = os.getenv("BATCH_BACKEND", "openai")
+    BATCH_COMPLETION_WINDOW = os.getenv("BATCH_COMPLETION_WINDOW", "24h")
+    BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", 50000))
+    BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", 100 * 2**20))
+    # Total of the inputs of all requests in one embeddings batch
+    BATCH_MAX_EMBEDDING_INPUTS = int(os.getenv("BATCH_MAX_EMBEDDING_INPUTS", 50000))
+    # Sections embedded by one request of an embeddings batch
+    BATCH_EMBEDDING_INPUTS = int(os.getenv("BATCH_EMBEDDING_INPUTS", 100))
 
     def __init__(self) -> None:
         openai.api_type = "openai"
         openai.api_key = self.OPENAI_API_KEY
         openai.organization = self.OPENAI_ORG_ID
-        self.client = openai.OpenAI()
-        self.aclient = openai.AsyncOpenAI()
+        self.rate_limiter = self.create_rate_limiter()
+        if self.rate_limiter is None:
+            self.client = openai.OpenAI()
+            self.aclient = openai.AsyncOpenAI()
+        else:
+            self.client = openai.OpenAI(
+                http_client=httpx.Client(
+                    limits=DEFAULT_LIMITS,
+                    event_hooks=self.rate_limiter.event_hooks(),
+                )
+            )
+            self.aclient = openai.AsyncOpenAI(
+                http_client=httpx.AsyncClient(
+                    limits=DEFAULT_LIMITS,
+                    event_hooks=self.rate_limiter.async_event_hooks(),
+                )
+            )
+
+    def create_rate_limiter(self):
+        limits = parse_limits(self.RATE_LIMITS)
+        if self.RATE_LIMIT_BACKEND == "off":
+            return None
+        if self.RATE_LIMIT_BACKEND == "memory":
+            backend = MemoryBackend(limits)
+        else:
+            backend = FileBackend(self.RATE_LIMIT_DIR, limits)
+        return RateLimiter(backend, bulk_headroom=self.RATE_LIMIT_BULK_HEADROOM)
@@ -1,7 +1,7 @@
+import os
+import logging
 import multiprocessing
 
-max_requests = 1000
-max_requests_jitter = 50
 log_file = "-"
 bind = "0.0.0.0"
 
@@ -9,5 +9,49 @@ timeout = 230
 # https://learn.microsoft.com/en-us/troubleshoot/azure/app-service/web-apps-performance-faqs#why-does-my-request-time-out-after-230-seconds
 
 num_cpus = multiprocessing.cpu_count()
-workers = (num_cpus * 2) + 1
 worker_class = "uvicorn.workers.UvicornWorker"
+
+# Serving profiles
+# "streaming": few async workers, each serving many long-lived LLM streams (I/O bound).
+#   Workers are recycled rarely and drain in-flight streams for up to `timeout` seconds.
+# "classic": the CPU-bound recipe of (2 * cpus) + 1 workers recycled every ~1000 requests.
+serving_profiles = {
+    "streaming": {
+        "workers": max(2, min(num_cpus, 4)),
+        "max_requests": 10000,
+        "max_requests_jitter": 1000,
+        "graceful_timeout": timeout,
+    },
+    "classic": {
+        "workers": (num_cpus * 2) + 1,
+        "max_requests": 1000,
+        "max_requests_jitter": 50,
+        "graceful_timeout": 30,
+    },
+}
+serving_profile = os.getenv("SERVING_PROFILE", "streaming")
+if serving_profile not in serving_profiles:
+    logging.getLogger("gunicorn.error").warning(
+        f"Unknown SERVING_PROFILE '{serving_profile}', using 'streaming'"
+    )
+    serving_profile = "streaming"
+profile = serving_profiles[serving_profile]
+
+workers = int(os.getenv("WEB_CONCURRENCY", profile["workers"]))
+max_requests = int(os.getenv("MAX_REQUESTS", profile["max_requests"]))
+max_requests_jitter = profile["max_requests_jitter"]
+# Time a recycled or stopped worker gets to finish its in-flight streams
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", profile["graceful_timeout"]))
+
+
+def child_exit(server, worker):
+    # Drop the metrics of dead workers when /metrics aggregates across processes
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    # Uvicorn recycles the worker after this many requests (with the jitter): the app starts draining on the last one
+    os.environ["WORKER_MAX_REQUESTS"] = str(worker.max_requests)
@@ -1,5 +1,19 @@
+"""
+The web tier only needs `chat`. The upload classes pull in the ingestion dependencies (PyMuPDF, tenacity), so they
+are imported on first access, by the task worker.
+"""
+import importlib
 from llm.chat import Chat
-from llm.singlefilescanupload import SingleFileScanUpload
-from llm.singlefileupload import SingleFileUpload
 
 chat = Chat()
+
+INGESTION_CLASSES = {
+    "SingleFileUpload": "llm.singlefileupload",
+    "SingleFileScanUpload": "llm.singlefilescanupload",
+}
+
+
+def __getattr__(name: str):
+    if name in INGESTION_CLASSES:
+        return getattr(importlib.import_module(INGESTION_CLASSES[name]), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,338 @@
+"""
+Backfill ingestion: the same pipeline as SingleFileUpload / SingleFileScanUpload, run over many documents at once
+with the page scans and the section embeddings sent through the OpenAI Batch API instead of one call at a time.
+1. Download every document, extract the layout pages or render the scan pages
+2. Scan the page images that need the vision model in one vision batch, and upload the page blobs
+3. Summarize every document with the summarization assistant (live, at bulk priority)
+4. Embed the sections of all documents in one embeddings batch, many inputs per request
+5. Index all sections in bulk
+A document that fails at any step is reported and left out of the next steps, the others carry on.
+"""
+import os
+import asyncio
+from types import SimpleNamespace
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from llm.singlefileupload import SingleFileUpload
+from llm.singlefilescanupload import SingleFileScanUpload
+from llm.page_classifier import TEXT, VISION
+from utils import filename_to_id
+from utils.ingestion_metrics import IngestionMetrics
+from utils.section_store import SectionStore
+from utils.openai_batch import (
+    TERMINAL_STATUSES,
+    LocalBatchClient,
+    OpenAIBatchClient,
+    batch_files,
+    batch_request,
+    response_body,
+)
+from config import logger, gpt
+
+
+class BackfillDocument:
+    """
+    Attributes:
+        filename (str): The source file.
+        scan (bool): Whether the document is ingested with GPT-4V ("v-scan") or Form Recognizer.
+        metrics (IngestionMetrics): Telemetry of the document.
+        page_map (list): Pages of the document, filled by extraction or by the vision batch.
+        error (str): Why the document failed, None while it is on track.
+    """
+
+    def __init__(self, filename: str, scan: bool, metrics: IngestionMetrics):
+        self.filename = filename
+        self.scan = scan
+        self.metrics = metrics
+        self.file_id = filename_to_id(filename)
+        self.images: List[Dict[str, Any]] = []
+        self.page_map: List[Dict[str, Any]] = []
+        self.summary: Optional[Dict[str, Any]] = None
+        self.sections = SectionStore()
+        self.error: Optional[str] = None
+
+    def fail(self, step: str, error: Any):
+        self.error = f"{step}: {error}"
+        logger.error(f"Backfill of '{self.filename}' failed at {step}: {error}")
+
+
+def create_batch_client():
+    if gpt.BATCH_BACKEND == "local":
+        return LocalBatchClient(gpt.client)
+    return OpenAIBatchClient(gpt.client, gpt.BATCH_COMPLETION_WINDOW)
+
+
+class Backfill:
+    def __init__(self, batch_client=None, poll_interval: float = 60):
+        self.upload = SingleFileUpload()
+        self.scan_upload = SingleFileScanUpload()
+        self.batch_client = batch_client or create_batch_client()
+        self.poll_interval = poll_interval
+
+    def uploader(self, document: BackfillDocument):
+        uploader = self.scan_upload if document.scan else self.upload
+        # The per-call metrics of the upload classes go to the current document
+        uploader.metrics = document.metrics
+        return uploader
+
+    def submit_batches(
+        self,
+        requests: Iterable[Dict[str, Any]],
+        endpoint: str,
+        max_inputs: Optional[int] = None,
+    ) -> List[str]:
+        return [
+            self.batch_client.submit(content, endpoint)
+            for content in batch_files(
+                requests, gpt.BATCH_MAX_REQUESTS, gpt.BATCH_MAX_BYTES, max_inputs
+            )
+        ]
+
+    async def run_batches(
+        self, requests: Iterable[Dict[str, Any]], endpoint: str
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Submits the requests in as many batches as the limits require and waits for all results.
+        `requests` may be a generator, so that only one batch file is held in memory at a time.
+        """
+        max_inputs = (
+            gpt.BATCH_MAX_EMBEDDING_INPUTS if endpoint == "/v1/embeddings" else None
+        )
+        # Writing, uploading and polling the batch files are blocking calls: keep them off the event loop
+        batch_ids = await asyncio.to_thread(
+            self.submit_batches, requests, endpoint, max_inputs
+        )
+        logger.info(f"Submitted {len(batch_ids)} {endpoint} batches")
+        results = {}
+        pending = list(batch_ids)
+        while pending:
+            for batch_id in list(pending):
+                batch = await asyncio.to_thread(self.batch_client.retrieve, batch_id)
+                if batch["status"] not in TERMINAL_STATUSES:
+                    continue
+                pending.remove(batch_id)
+                logger.info(
+                    f"Batch {batch_id} {batch['status']}: {batch.get('request_counts')}"
+                )
+                # Expired and cancelled batches still return the requests they completed
+                for result in await asyncio.to_thread(
+                    list, self.batch_client.results(batch)
+                ):
+                    results[result["custom_id"]] = result
+            if pending:
+                await asyncio.sleep(self.poll_interval)
+        return results
+
+    def prepare(self, document: BackfillDocument):
+        uploader = self.uploader(document)
+        with document.metrics.stage("download"):
+            content = uploader.download_source_file(document.filename)
+        if document.scan:
+            with document.metrics.stage("render"):
+                document.images = uploader.split_pdf_into_images(
+                    document.filename, content
+                )
+            document.metrics.pages = len(document.images)
+        else:
+            with document.metrics.stage("extract"):
+                document.page_map = uploader.get_document_text(
+                    document.filename, content
+                )
+            document.metrics.pages = len(document.page_map)
+            with document.metrics.stage("blob_upload"):
+                uploader.upload_blobs(
+                    document.filename, document.page_map, document.file_id
+                )
+
+    async def scan_pages(self, documents: List[BackfillDocument]):
+        """
+        Scans the page images of all scan documents in one vision batch.
+        Pages routed to the native text extraction keep the text of their text layer.
+        """
+        if not any(document.images for document in documents):
+            return
+        # Page images are encoded while the batch files are written
+        requests = (
+            batch_request(
+                f"vision-{d}-{image['page_num']}",
+                "/v1/chat/completions",
+                self.scan_upload.vision_request(image["image_file"]),
+            )
+            for d, document in enumerate(documents)
+            for image in document.images
+            if image["route"] == VISION
+        )
+        results = {}
+        if any(
+            image["route"] == VISION
+            for document in documents
+            for image in document.images
+        ):
+            results = await self.run_batches(requests, "/v1/chat/completions")
+        for d, document in enumerate(documents):
+            if not document.images:
+                continue
+            offset = 0
+            for image in document.images:
+                document.metrics.page_route(image["route"])
+                if image["route"] == TEXT:
+                    text = image["text"]
+                else:
+                    result = results.get(f"vision-{d}-{image['page_num']}", {})
+                    if (body := response_body(result)) is None:
+                        document.fail(
+                            "scan", f"page {image['page_num']}: {result.get('error')}"
+                        )
+                        break
+                    document.metrics.api_call(
+                        gpt.CHATGPT_VISION_MODEL,
+                        "vision_batch",
+                        SimpleNamespace(**body.get("usage") or {}),
+                    )
+                    text = body["choices"][0]["message"]["content"]
+                document.page_map.append(
+                    {
+                        "page_num": image["page_num"],
+                        "page_offset": offset,
+                        "page_text": text,
+                    }
+                )
+                offset += len(text)
+            if document.error is None:
+                with document.metrics.stage("blob_upload"):
+                    self.scan_upload.upload_blobs(
+                        document.filename, document.page_map, document.file_id
+                    )
+
+    def build_sections(self, document: BackfillDocument):
+        uploader = self.uploader(document)
+        summary_page = [
+            {"page_num": 0, "page_offset": 0, "page_text": document.summary["summary"]}
+        ]
+        if document.scan:
+            category = "Business Summary Document"
+            sections = uploader.build_sections(
+                document.summary["title"],
+                category,
+                document.filename,
+                document.page_map,
+                document.file_id,
+            ) + uploader.build_sections(
+                document.summary["title"],
+                category,
+                document.filename,
+                summary_page,
+                document.file_id,
+                is_summary=True,
+            )
+        else:
+            category = document.summary["category"]
+            sections = uploader.build_sections(
+                document.summary["title"],
+                category,
+                document.filename,
+                document.file_id,
+                document.page_map,
+            ) + uploader.build_sections(
+                document.summary["title"],
+                category,
+                document.filename,
+                document.file_id,
+                summary_page,
+                is_summary=True,
+            )
+        document.sections = SectionStore(sections)
+
+    async def embed_sections(self, documents: List[BackfillDocument]):
+        """Embeds the sections of all documents in one embeddings batch"""
+        inputs: List[Tuple[BackfillDocument, int]] = [
+            (document, i)
+            for document in documents
+            for i in range(len(document.sections))
+        ]
+        size = max(1, gpt.BATCH_EMBEDDING_INPUTS)
+        chunks = [inputs[i : i + size] for i in range(0, len(inputs), size)]
+        requests = [
+            batch_request(
+                f"embedding-{c}",
+                "/v1/embeddings",
+                {
+                    "model": gpt.EMB_MODEL_NAME,
+                    "input": [
+                        document.sections.sections[i].content for document, i in chunk
+                    ],
+                },
+            )
+            for c, chunk in enumerate(chunks)
+        ]
+        if not requests:
+            return
+        results = await self.run_batches(requests, "/v1/embeddings")
+        for c, chunk in enumerate(chunks):
+            result = results.get(f"embedding-{c}", {})
+            if (body := response_body(result)) is None:
+                for document, _ in chunk:
+                    if document.error is None:
+                        document.fail("embed", result.get("error"))
+                continue
+            chunk_documents = {id(document): document for document, _ in chunk}
+            for document in chunk_documents.values():
+                # The usage of a request is shared by the documents it embeds
+                document.metrics.api_call(gpt.EMB_MODEL_NAME, "embedding_batch")
+            for item in body["data"]:
+                document, i = chunk[item["index"]]
+                document.sections.set_embedding(i, item["embedding"])
+
+    async def run(self, documents: List[BackfillDocument]) -> List[BackfillDocument]:
+        try:
+            return await self.ingest(documents)
+        finally:
+            # Cleanup the rendered page images
+            for document in documents:
+                for image in document.images:
+                    if os.path.exists(image["image_file"]):
+                        os.remove(image["image_file"])
+
+    async def ingest(self, documents: List[BackfillDocument]) -> List[BackfillDocument]:
+        # Step 1. Download and extract (layout) or render (scan) every document
+        for document in documents:
+            try:
+                self.prepare(document)
+            except Exception as error:
+                document.fail("extract", error)
+        # Step 2. Scan the page images in one vision batch
+        await self.scan_pages([d for d in documents if d.error is None])
+        # Step 3. Summarize every document
+        for document in (d for d in documents if d.error is None):
+            try:
+                with document.metrics.stage("summarize"):
+                    document.summary = self.uploader(document).run_openai_assistant(
+                        document.filename, document.page_map
+                    )
+                self.build_sections(document)
+            except Exception as error:
+                document.fail("summarize", error)
+        # Step 4. Embed the sections of all documents in one embeddings batch
+        await self.embed_sections([d for d in documents if d.error is None])
+        # Step 5. Index all sections in bulk
+        for document in (d for d in documents if d.error is None):
+            try:
+                await SingleFileUpload.upload_sections(document.sections)
+                document.metrics.sections = len(document.sections)
+            except Exception as error:
+                document.fail("index", error)
+        indexed = [d for d in documents if d.error is None]
+        logger.info(
+            f"Backfilled {len(indexed)} of {len(documents)} documents, "
+            f"{sum(len(d.sections) for d in indexed)} sections"
+        )
+        return documents
+
+    @staticmethod
+    def result(document: BackfillDocument) -> Dict[str, Any]:
+        if document.error is not None:
+            return {"filename": document.filename, "error": document.error}
+        return {
+            **document.summary,
+            "filename": document.filename,
+            "id": document.file_id,
+        }
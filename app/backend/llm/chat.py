@@ -1,8 +1,37 @@
 import re
-from typing import Any, AsyncGenerator, Union, Dict, List
+import json
+import time
+import asyncio
+from datetime import datetime, timezone
+from typing import Any, AsyncGenerator, Iterator, Optional, Union, Dict, List, Tuple
 from llm.tools import cognitive_search_tool
-from utils import nonewlines, build_filters, MessageBuilder
-from config import logger, az, gpt
+from llm.history import HistoryMemory
+from llm.rewrite import CACHED, MODEL, RewritePolicy
+from llm.retrieval import (
+    HYBRID_SEMANTIC,
+    RETRIEVAL_PROFILES,
+    RetrievalProfile,
+    get_retrieval_profile,
+)
+from utils import nonewlines, build_filters, MessageBuilder, FollowupParser
+from utils.answer_cache import AnswerCache, CachedAnswer
+from utils.context_packing import Source, deduplicate, pack_sources, parse_budgets
+from utils.message_builder import count_message_tokens
+from utils.single_flight import SingleFlight
+from utils.streaming import content_event
+from utils.telemetry import (
+    ANSWER_CACHE,
+    CHAT_REQUESTS,
+    PROMPT_TOKENS,
+    RETRIEVAL_HITS,
+    REWRITES,
+    STAGE_SECONDS,
+    GenerationTimer,
+    stage,
+    start_span,
+    use_span,
+)
+from config import logger, az, gpt, config
 from azure.search.documents.models import VectorizedQuery
 
 SYSTEM = "system"
@@ -51,105 +80,228 @@ class Chat:
     """
 
     def __init__(self) -> None:
-        self.retrieval_mode = "hybrid"
-        self.use_semantic_captions = True
-        self.top = 5
+        self.default_retrieval_profile = config.RETRIEVAL_PROFILE
+        if self.default_retrieval_profile not in RETRIEVAL_PROFILES:
+            logger.warning(
+                f"Unknown RETRIEVAL_PROFILE {config.RETRIEVAL_PROFILE!r}, using {HYBRID_SEMANTIC!r}. "
+                f"Profiles: {', '.join(RETRIEVAL_PROFILES)}"
+            )
+            self.default_retrieval_profile = HYBRID_SEMANTIC
         self.max_history_tokens = 32000
-
-    async def search_sources(self, query_text: str, filters: str):
-        logger.info(f"Searching for: {query_text}")
-        logger.info(f"Cognitive search filters: {filters}")
-        embedding = gpt.client.embeddings.create(
-            model=gpt.EMB_MODEL_NAME, input=query_text
+        self.prompt_token_budgets = parse_budgets(config.PROMPT_TOKEN_BUDGETS)
+        self.history_memory = (
+            HistoryMemory(
+                window=config.HISTORY_WINDOW,
+                step=config.HISTORY_MEMORY_STEP,
+                max_tokens=config.HISTORY_MEMORY_MAX_TOKENS,
+                capacity=config.HISTORY_MEMORY_CACHE_SIZE,
+                secret=config.HISTORY_MEMORY_SECRET.encode("utf-8") or None,
+            )
+            if config.HISTORY_MEMORY
+            else None
         )
-        vector_query = VectorizedQuery(
-            vector=embedding.data[0].embedding,
-            k_nearest_neighbors=3,
-            fields="embedding",
+        self.rewrite_policy = RewritePolicy(
+            skip_first_turn=config.REWRITE_POLICY == "auto",
+            skip_self_contained=config.REWRITE_POLICY == "auto",
+            min_words=config.REWRITE_MIN_WORDS,
+            capacity=config.REWRITE_CACHE_SIZE,
         )
-        r = await az.search_client.search(
-            query_text,
-            filter=filters,
-            query_type="semantic",
-            semantic_configuration_name="semantic-config",
-            top=self.top,
-            query_caption="extractive",
-            vector_queries=[vector_query],
+        self.answer_cache = (
+            AnswerCache(
+                threshold=config.ANSWER_CACHE_THRESHOLD,
+                capacity=config.ANSWER_CACHE_SIZE,
+                ttl=config.ANSWER_CACHE_TTL,
+                sync_interval=config.ANSWER_CACHE_SYNC_INTERVAL,
+            )
+            if config.ANSWER_CACHE
+            else None
+        )
+        self.rewrite_flight = SingleFlight("rewrite", config.SINGLE_FLIGHT_MAX_WAITERS)
+        self.embedding_flight = SingleFlight(
+            "embedding", config.SINGLE_FLIGHT_MAX_WAITERS
+        )
+        self.search_flight = SingleFlight("search", config.SINGLE_FLIGHT_MAX_WAITERS)
+        self.answer_cache_sync: Optional[asyncio.Task] = None
+
+    async def embed(self, text: str) -> List[float]:
+        """Embedding of `text`, shared with identical concurrent requests"""
+
+        async def create_embedding():
+            embedding = await gpt.aclient.embeddings.create(
+                model=gpt.EMB_MODEL_NAME, input=text
+            )
+            return embedding.data[0].embedding
+
+        vector, _ = await self.embedding_flight.do(
+            json.dumps([gpt.EMB_MODEL_NAME, text]), create_embedding
+        )
+        return vector
+
+    async def search_sources(
+        self,
+        query_text: str,
+        filters: str,
+        profile: RetrievalProfile,
+        query_embedding: Optional[List[float]] = None,
+    ) -> Tuple[List[Source], Dict[str, Any]]:
+        """Search results, shared with identical concurrent requests"""
+        key = json.dumps([query_text, filters, profile.to_dict()])
+        (sources, retrieval_info), coalesced = await self.search_flight.do(
+            key,
+            lambda: self.run_search(query_text, filters, profile, query_embedding),
         )
-        if self.use_semantic_captions:
-            results = [
-                doc["sourcepage"]
-                + ": "
-                + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
-                async for doc in r
+        # Each request gets its own copies, the packing step adds to them
+        return list(sources), {**retrieval_info, "coalesced": coalesced}
+
+    async def run_search(
+        self,
+        query_text: str,
+        filters: str,
+        profile: RetrievalProfile,
+        query_embedding: Optional[List[float]] = None,
+    ) -> Tuple[List[Source], Dict[str, Any]]:
+        """`query_embedding` is the embedding of `query_text` when the caller has it already"""
+        logger.info(f"Searching for: {query_text} (profile: {profile.name})")
+        logger.debug(f"Cognitive search filters: {filters}")
+        retrieval_info = profile.to_dict()
+        started = time.perf_counter()
+        vector_queries = None
+        if profile.use_vectors:
+            vector = query_embedding
+            if vector is None:
+                with stage("embedding", model=gpt.EMB_MODEL_NAME):
+                    vector = await self.embed(query_text)
+            vector_queries = [
+                VectorizedQuery(
+                    vector=vector,
+                    k_nearest_neighbors=profile.k_nearest_neighbors,
+                    fields="embedding",
+                )
             ]
+            retrieval_info["embedding_ms"] = round(
+                (time.perf_counter() - started) * 1000, 1
+            )
+        search_started = time.perf_counter()
+        if profile.use_semantic_ranker:
+            semantic_kwargs = {
+                "query_type": "semantic",
+                "semantic_configuration_name": "semantic-config",
+                "query_caption": "extractive"
+                if profile.use_semantic_captions
+                else None,
+            }
         else:
-            results = [
-                doc["sourcepage"] + ": " + nonewlines(doc["content"]) async for doc in r
-            ]
+            semantic_kwargs = {}
+        with stage("search", profile=profile.name) as span:
+            r = await az.search_client.search(
+                query_text if profile.use_text else None,
+                filter=filters,
+                top=profile.top,
+                vector_queries=vector_queries,
+                select=profile.select_fields(),
+                **semantic_kwargs,
+            )
+            results, sourcepages, sourcefiles = [], [], set()
+            async for doc in r:
+                if profile.use_semantic_captions:
+                    text = " . ".join([c.text for c in doc["@search.captions"]])
+                else:
+                    text = doc["content"]
+                source = Source(
+                    doc["sourcepage"],
+                    nonewlines(text),
+                    doc.get("id"),
+                    doc.get("sourcefile"),
+                )
+                results.append(source)
+                sourcepages.append(source.sourcepage)
+                if source.sourcefile:
+                    sourcefiles.add(source.sourcefile)
+            span.set_attribute("hits", len(results))
+        RETRIEVAL_HITS.labels(profile.name).observe(len(results))
+        finished = time.perf_counter()
+        retrieval_info["search_ms"] = round((finished - search_started) * 1000, 1)
+        retrieval_info["latency_ms"] = round((finished - started) * 1000, 1)
+        retrieval_info["hits"] = len(results)
+        retrieval_info["sourcepages"] = sourcepages
+        retrieval_info["sourcefiles"] = sorted(sourcefiles)
 
-        logger.info(f"Search results: {results}")
-        return results
+        logger.payload("Search results", [source.text for source in results])
+        logger.debug("Retrieval stats", **retrieval_info)
+        return results, retrieval_info
 
     async def run_until_final_call(
         self,
         history: List[dict[str, str]],
         overrides: Dict[str, Any],
         should_stream: bool = False,
+        memory: Optional[str] = None,
+        question_embedding: Optional[List[float]] = None,
     ) -> tuple:
+        """
+        `history` is the part of the conversation sent verbatim, `memory` the summary of the older part.
+        `question_embedding` is the embedding of the question, when the answer cache lookup computed it.
+        """
         filters = build_filters(overrides)
 
         original_user_query = history[-1]["content"]
-        user_query_request = "Generate search query for: " + original_user_query
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
-        messages = self.get_messages_from_history(
-            system_prompt=query_prompt_template,
-            model_id=gpt.CHATGPT_MODEL,
-            history=history,
-            user_content=user_query_request,
-            few_shots=query_prompt_few_shots,
-        )
-
-        chat_completion = gpt.client.chat.completions.create(
-            model=gpt.CHATGPT_MODEL,
-            messages=messages,
-            temperature=0.0,
-            n=1,
-            tools=[cognitive_search_tool],
-            tool_choice="auto",
-        )
-
-        query_text = self.get_search_query(chat_completion, original_user_query)
+        query_text, rewrite_info = await self.rewrite_query(history, memory)
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-        results = await self.search_sources(query_text, filters)
-        content = "\n".join(results)
+        profile = get_retrieval_profile(overrides, self.default_retrieval_profile)
+        sources, retrieval_info = await self.search_sources(
+            query_text,
+            filters,
+            profile,
+            # Reused when the question is searched as it is
+            question_embedding if query_text == original_user_query else None,
+        )
         # STEP 3: Generate a contextual and content specific answer using the search results and chat history
-        system_message = system_message_chat_conversation.format(
-            follow_up_questions_prompt=follow_up_questions_prompt_content,
+        system_message = HistoryMemory.system_prompt(
+            system_message_chat_conversation.format(
+                follow_up_questions_prompt=follow_up_questions_prompt_content,
+            ),
+            memory,
+        )
+        sources, max_tokens, prompt_info = self.pack_context(
+            system_message, original_user_query, sources, gpt.CHATGPT_MODEL
         )
+        results = [source.text for source in sources]
+        content = "\n".join(results)
 
         messages = self.get_messages_from_history(
             system_prompt=system_message,
             model_id=gpt.CHATGPT_MODEL,
             history=history,
             user_content=original_user_query + "\n\nSources:\n" + content,
+            call="answer",
+            max_tokens=max_tokens,
         )
+        prompt_info["history_messages"] = len(messages) - 2
+        prompt_info["tokens"] = sum(
+            count_message_tokens(message, gpt.CHATGPT_MODEL) for message in messages
+        )
+        logger.debug("Prompt stats", **prompt_info)
         msg_to_display = "\n\n".join([str(message) for message in messages])
 
         extra_info = {
             "data_points": results,
             "thoughts": f"Searched for:<br>{query_text}<br><br>Conversations:<br>"
             + msg_to_display.replace("\n", "<br>"),
+            "retrieval": retrieval_info,
+            "prompt": prompt_info,
+            "rewrite": rewrite_info,
         }
 
-        chat_coroutine = gpt.client.chat.completions.create(
-            model=gpt.CHATGPT_MODEL,
-            messages=messages,
-            temperature=0.7,
-            n=1,
-            stream=should_stream,
-        )
+        with stage("generation_request", model=gpt.CHATGPT_MODEL):
+            chat_coroutine = await gpt.aclient.chat.completions.create(
+                model=gpt.CHATGPT_MODEL,
+                messages=messages,
+                temperature=0.7,
+                n=1,
+                stream=should_stream,
+            )
         return (extra_info, chat_coroutine)
 
     async def run_with_streaming(
@@ -158,10 +310,114 @@ class Chat:
         overrides: Dict[str, Any],
         session_state: Any = None,
     ) -> AsyncGenerator[Dict, None]:
-        extra_info, chat_coroutine = await self.run_until_final_call(
-            history, overrides, should_stream=True
-        )
-        yield {
+        request_started = time.perf_counter()
+        span = start_span("request", history_length=len(history))
+        status = "error"
+        try:
+            question_embedding = None
+            if cache_key := self.answer_cache_key(history, overrides):
+                with use_span(span):
+                    question_embedding, hit = await self.lookup_answer(
+                        history[-1]["content"], cache_key
+                    )
+                if hit is not None:
+                    for event in self.replay_answer(
+                        *hit, overrides=overrides, session_state=session_state
+                    ):
+                        yield event
+                    status = "cached"
+                    return
+
+            memory, recent = None, history
+            if self.history_memory is not None:
+                with use_span(span):
+                    memory, recent, session_state = await self.history_memory.recall(
+                        history, session_state
+                    )
+            with use_span(span):
+                extra_info, chat_coroutine = await self.run_until_final_call(
+                    recent,
+                    overrides,
+                    should_stream=True,
+                    memory=memory,
+                    question_embedding=question_embedding,
+                )
+            extra_info["prompt"]["summarized_messages"] = len(history) - len(recent)
+            yield self.context_event(extra_info, session_state)
+
+            timer = GenerationTimer(request_started)
+            answer_parts = []
+            followup_questions = []
+            if not overrides.get("suggest_followup_questions"):
+                async for event in chat_coroutine:
+                    if event.choices:
+                        if event.choices[0].delta.content:
+                            timer.token()
+                            answer_parts.append(event.choices[0].delta.content)
+                        yield event
+            else:
+                # Follow-up questions are split from the answer while streaming and sent as soon as each one completes
+                parser = FollowupParser()
+                async for event in chat_coroutine:
+                    if not event.choices:
+                        continue
+                    content = event.choices[0].delta.content
+                    if content is None:
+                        yield event
+                        continue
+                    timer.token()
+                    answer, questions = parser.feed(content)
+                    if answer:
+                        answer_parts.append(answer)
+                        event.choices[0].delta.content = answer
+                        yield event
+                    if questions:
+                        yield self.followup_questions_event(parser.questions)
+                if remainder := parser.close():
+                    answer_parts.append(remainder)
+                    yield {
+                        "choices": [
+                            {
+                                "delta": {"content": remainder},
+                                "finish_reason": None,
+                                "index": 0,
+                            }
+                        ],
+                        "object": "chat.completion.chunk",
+                    }
+                followup_questions = parser.questions
+            generation_stats = timer.finish()
+            span.set_attributes(generation_stats)
+            logger.debug(f"Generation stats: {generation_stats}")
+            if question_embedding is not None:
+                self.store_answer(
+                    question_embedding,
+                    cache_key,
+                    history[-1]["content"],
+                    "".join(answer_parts),
+                    followup_questions,
+                    extra_info,
+                )
+            if self.history_memory is not None:
+                self.history_memory.prefetch(
+                    history + [{"role": ASSISTANT, "content": "".join(answer_parts)}]
+                )
+            status = "ok"
+        except GeneratorExit:
+            status = "cancelled"
+            raise
+        except Exception as error:
+            span.record_exception(error)
+            raise
+        finally:
+            CHAT_REQUESTS.labels(status).inc()
+            STAGE_SECONDS.labels("total").observe(time.perf_counter() - request_started)
+            span.set_attribute("status", status)
+            span.end()
+
+    @staticmethod
+    def context_event(extra_info: Dict[str, Any], session_state: Any = None):
+        return {
             "choices": [
                 {
                     "delta": {"role": ASSISTANT},
@@ -174,36 +430,115 @@ class Chat:
             "object": "chat.completion.chunk",
         }
 
-        followup_questions_started = False
-        followup_content = ""
-        for event in chat_coroutine:
-            if event.choices:
-                # if event contains << and not >>, it is start of follow-up question, truncate
-                content = event.choices[0].delta.content or ""
-                if overrides.get("suggest_followup_questions") and "<<" in content:
-                    followup_questions_started = True
-                    earlier_content = content[: content.index("<<")]
-                    if earlier_content:
-                        event.choices[0].delta.content = earlier_content
-                        yield event
-                    followup_content += content[content.index("<<") :]
-                elif followup_questions_started:
-                    followup_content += content
-                else:
-                    yield event
-        if followup_content:
-            _, followup_questions = self.extract_followup_questions(followup_content)
-            yield {
-                "choices": [
-                    {
-                        "delta": {"role": ASSISTANT},
-                        "context": {"followup_questions": followup_questions},
-                        "finish_reason": None,
-                        "index": 0,
-                    }
-                ],
-                "object": "chat.completion.chunk",
-            }
+    def answer_cache_key(
+        self, history: List[Dict[str, str]], overrides: Dict[str, Any]
+    ) -> Optional[str]:
+        """
+        Key of the answer in the cache: everything but the question that shapes it.
+        None when the answer can't be cached: only first-turn questions are, as later ones depend on the history.
+        """
+        if (
+            self.answer_cache is None
+            or len(history) != 1
+            or overrides.get("skip_answer_cache")
+        ):
+            return None
+        profile = get_retrieval_profile(overrides, self.default_retrieval_profile)
+        return json.dumps([build_filters(overrides), profile.to_dict()])
+
+    async def sync_answer_cache(self):
+        """Applies the invalidations published by other workers and the ingestion tasks"""
+        try:
+            invalidations = await asyncio.to_thread(
+                AnswerCache.list_invalidations,
+                az.blob_container,
+                self.answer_cache.ttl,
+            )
+        except Exception as error:
+            logger.warning(f"Failed to sync the answer cache: {error}")
+            invalidations = []
+        if dropped := self.answer_cache.apply_invalidations(invalidations):
+            logger.info(f"Dropped {dropped} cached answers with updated sources")
+
+    async def lookup_answer(
+        self, question: str, cache_key: str
+    ) -> Tuple[List[float], Optional[Tuple[CachedAnswer, float]]]:
+        if self.answer_cache.needs_sync():
+            # One sync at a time, the requests arriving meanwhile wait for it instead of listing again
+            if self.answer_cache_sync is None or self.answer_cache_sync.done():
+                self.answer_cache_sync = asyncio.ensure_future(self.sync_answer_cache())
+            # Shielded: a client going away must not cancel the sync the others wait for
+            await asyncio.shield(self.answer_cache_sync)
+        with stage("cache_lookup", model=gpt.EMB_MODEL_NAME):
+            question_embedding = await self.embed(question)
+            hit = self.answer_cache.lookup(question_embedding, cache_key)
+        ANSWER_CACHE.labels("hit" if hit else "miss").inc()
+        return question_embedding, hit
+
+    def store_answer(
+        self,
+        question_embedding: List[float],
+        cache_key: str,
+        question: str,
+        answer: str,
+        followup_questions: List[str],
+        extra_info: Dict[str, Any],
+    ):
+        retrieval = extra_info.get("retrieval", {})
+        # Answers that cite no sourcefile could never be invalidated by ingestion
+        if not answer.strip() or not retrieval.get("sourcefiles"):
+            return
+        self.answer_cache.store(
+            question_embedding,
+            cache_key,
+            CachedAnswer(
+                question=question,
+                answer=answer,
+                followup_questions=followup_questions,
+                sourcepages=retrieval.get("sourcepages", []),
+                sourcefiles=retrieval["sourcefiles"],
+                context=extra_info,
+            ),
+        )
+
+    def replay_answer(
+        self,
+        entry: CachedAnswer,
+        similarity: float,
+        overrides: Dict[str, Any],
+        session_state: Any = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """Streams a cached answer in the same events as a generated one"""
+        logger.info(f"Answer cache hit ({similarity:.3f}): {entry.question}")
+        context = {
+            **entry.context,
+            "answer_cache": {
+                "question": entry.question,
+                "similarity": round(similarity, 4),
+                "cached_at": datetime.fromtimestamp(
+                    entry.created, timezone.utc
+                ).isoformat(),
+            },
+        }
+        yield self.context_event(context, session_state)
+        for piece in re.findall(r"\S+\s*|\s+", entry.answer):
+            yield content_event(piece)
+        if overrides.get("suggest_followup_questions") and entry.followup_questions:
+            yield self.followup_questions_event(entry.followup_questions)
+
+    @staticmethod
+    def followup_questions_event(followup_questions: List[str]) -> Dict[str, Any]:
+        return {
+            "choices": [
+                {
+                    "delta": {"role": ASSISTANT},
+                    "context": {"followup_questions": followup_questions},
+                    "finish_reason": None,
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
 
     async def run(
         self,
@@ -217,6 +552,91 @@ class Chat:
             session_state=session_state,
         )
 
+    async def rewrite_query(
+        self, history: List[Dict[str, str]], memory: Optional[str] = None
+    ) -> Tuple[str, Dict[str, Any]]:
+        """The search query for the last question, and the path the rewrite policy took"""
+        original_user_query = history[-1]["content"]
+        if path := self.rewrite_policy.skip(history):
+            REWRITES.labels(path).inc()
+            return original_user_query, {"path": path}
+
+        rewrite_history = history
+        if self.history_memory is not None:
+            rewrite_history = history[-(config.REWRITE_HISTORY_WINDOW + 1) :]
+        key = RewritePolicy.key(rewrite_history, memory, gpt.REWRITE_MODEL)
+        if (query_text := self.rewrite_policy.get(key)) is not None:
+            REWRITES.labels(CACHED).inc()
+            return query_text, {"path": CACHED, "model": gpt.REWRITE_MODEL}
+
+        query_text, coalesced = await self.rewrite_flight.do(
+            key, lambda: self.run_rewrite(rewrite_history, memory)
+        )
+        self.rewrite_policy.put(key, query_text)
+        REWRITES.labels(MODEL).inc()
+        return query_text, {
+            "path": MODEL,
+            "model": gpt.REWRITE_MODEL,
+            "coalesced": coalesced,
+        }
+
+    async def run_rewrite(
+        self, rewrite_history: List[Dict[str, str]], memory: Optional[str]
+    ) -> str:
+        original_user_query = rewrite_history[-1]["content"]
+        messages = self.get_messages_from_history(
+            system_prompt=HistoryMemory.system_prompt(query_prompt_template, memory),
+            model_id=gpt.REWRITE_MODEL,
+            history=rewrite_history,
+            user_content="Generate search query for: " + original_user_query,
+            few_shots=query_prompt_few_shots,
+            call="rewrite",
+        )
+        with stage("rewrite", model=gpt.REWRITE_MODEL):
+            chat_completion = await gpt.aclient.chat.completions.create(
+                model=gpt.REWRITE_MODEL,
+                messages=messages,
+                temperature=0.0,
+                n=1,
+                tools=[cognitive_search_tool],
+                tool_choice="auto",
+            )
+        return self.get_search_query(chat_completion, original_user_query)
+
+    def pack_context(
+        self, system_prompt: str, question: str, sources: List[Source], model: str
+    ) -> Tuple[List[Source], int, Dict[str, Any]]:
+        """
+        Fits the sources and the history into the prompt budget of the model.
+        Returns the packed sources, the token limit of the user message and history, and stats for `extra_info`.
+        """
+        budget = self.prompt_token_budgets.get(model, config.PROMPT_TOKEN_BUDGET)
+        system_tokens = count_message_tokens(
+            {"role": "system", "content": system_prompt}, model
+        )
+        question_tokens = count_message_tokens(
+            {"role": USER, "content": question + "\n\nSources:\n"}, model
+        )
+        sources_budget = max(
+            0,
+            int(
+                (budget - system_tokens - question_tokens) * config.SOURCES_TOKEN_SHARE
+            ),
+        )
+        unique, stats = deduplicate(sources)
+        packed, sources_tokens = pack_sources(unique, sources_budget, model)
+        prompt_info = {
+            "budget": budget,
+            "sources_budget": sources_budget,
+            "sources_tokens": sources_tokens,
+            "sources_retrieved": len(sources),
+            "sources_used": len(packed),
+            "sources_duplicated": stats["duplicates"],
+            "sources_merged": stats["merged"],
+            "sources_dropped": len(unique) - len(packed),
+        }
+        return packed, min(self.max_history_tokens, budget - system_tokens), prompt_info
+
     def get_messages_from_history(
         self,
         system_prompt: str,
@@ -224,7 +644,11 @@ class Chat:
         history: List[Dict[str, str]],
         user_content: str,
         few_shots=[],
+        call: str = "answer",
+        max_tokens: Optional[int] = None,
     ) -> List:
+        """Older history messages are dropped once the user message and history reach `max_tokens`"""
+        max_tokens = max_tokens or self.max_history_tokens
         message_builder = MessageBuilder(system_prompt, model_id)
 
         # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
@@ -241,15 +665,16 @@ class Chat:
         newest_to_oldest = list(reversed(history[:-1]))
         for message in newest_to_oldest:
             potential_message_count = message_builder.count_tokens_for_message(message)
-            if (total_token_count + potential_message_count) > self.max_history_tokens:
+            if (total_token_count + potential_message_count) > max_tokens:
                 logger.debug(
-                    f"Reached max tokens of {self.max_history_tokens}, history will be truncated"
+                    f"Reached max tokens of {max_tokens}, history will be truncated"
                 )
                 break
             message_builder.insert_message(
                 message["role"], message["content"], index=append_index
             )
             total_token_count += potential_message_count
+        PROMPT_TOKENS.labels(call).observe(total_token_count)
         return message_builder.messages
 
     def get_search_query(self, chat_completion: dict[str, Any], user_query: str):
@@ -264,6 +689,3 @@ class Chat:
             if query_text.strip() != NO_RESPONSE:
                 return query_text
         return user_query
-
-    def extract_followup_questions(self, content: str):
-        return content.split("<<")[0], re.findall(r"<<([^>>]+)>>", content)
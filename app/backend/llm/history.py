@@ -0,0 +1,215 @@
+"""
+Rolling memory of long conversations.
+Only the last `window` messages are sent verbatim; the older ones are summarized into a short memory that is added
+to the system prompt. The memory moves forward by `step` messages at a time: the summary of a prefix is cached
+(in the worker, and in the session_state returned to the client), so it is computed once and later turns only
+fold the next `step` messages into it. The memory in session_state is signed with an HMAC of the server's `secret`:
+it ends up in the system prompt, so a summary the client made up or edited is ignored.
+"""
+import os
+import hmac
+import json
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from utils.message_builder import count_message_tokens
+from utils.telemetry import stage
+from config import logger, gpt
+
+SUMMARY_PROMPT = """You maintain the memory of a conversation between a user and an assistant answering questions about company documents.
+Update the memory with the new messages. Keep the facts, names, numbers, documents and open questions the rest of the conversation may refer to, drop small talk.
+Answer with the updated memory only, in at most {max_tokens} tokens."""
+
+MEMORY_PROMPT = """
+
+Summary of the earlier conversation:
+{memory}"""
+
+
+class HistoryMemory:
+    """
+    Attributes:
+        window (int): Latest messages (before the question) that are always sent verbatim.
+        step (int): Messages folded into the memory at once, so it is recomputed every `step` messages only.
+        max_tokens (int): Maximum length of the memory.
+        max_input_tokens (int): Maximum length of the messages summarized in one call.
+        capacity (int): Memories kept in the worker's cache.
+        secret (bytes): Signs the memories returned in session_state. Share one between all workers and instances,
+            with a random one only the memories this process returned are accepted back.
+    """
+
+    def __init__(
+        self,
+        window: int = 6,
+        step: int = 4,
+        max_tokens: int = 300,
+        max_input_tokens: int = 8000,
+        capacity: int = 1000,
+        secret: Optional[bytes] = None,
+    ):
+        self.window = window
+        self.step = max(1, step)
+        self.max_tokens = max_tokens
+        self.max_input_tokens = max_input_tokens
+        self.capacity = capacity
+        self.secret = secret or os.urandom(32)
+        self.cache: OrderedDict[str, str] = OrderedDict()
+        self.pending: Dict[str, asyncio.Task] = {}
+
+    def split(self, previous: List[Dict[str, str]]) -> Tuple[int, int]:
+        """Number of messages covered by the memory and by the one it is built from"""
+        covered = max(0, len(previous) - self.window) // self.step * self.step
+        return covered, max(0, covered - self.step)
+
+    @staticmethod
+    def key(messages: List[Dict[str, str]]) -> str:
+        content = json.dumps([(m["role"], m["content"]) for m in messages])
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def sign(self, key: str, summary: str) -> str:
+        message = json.dumps([key, summary]).encode("utf-8")
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+
+    def get_cached(self, key: str, session_state: Any = None) -> Optional[str]:
+        if isinstance(session_state, dict):
+            memory = session_state.get("history_memory")
+            if (
+                isinstance(memory, dict)
+                and memory.get("key") == key
+                and isinstance(memory.get("summary"), str)
+                and isinstance(memory.get("signature"), str)
+                and hmac.compare_digest(
+                    memory["signature"], self.sign(key, memory["summary"])
+                )
+            ):
+                return memory["summary"]
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        return None
+
+    def put(self, key: str, summary: str):
+        self.cache[key] = summary
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+
+    async def recall(
+        self, history: List[Dict[str, str]], session_state: Any = None
+    ) -> Tuple[Optional[str], List[Dict[str, str]], Any]:
+        """
+        The memory of the messages before the window, the messages to send verbatim (window and question),
+        and the session_state to return to the client.
+        """
+        previous = history[:-1]
+        covered, base = self.split(previous)
+        if not covered:
+            return None, history, session_state
+        summary = await self.summarize_prefix(previous, covered, base, session_state)
+        if session_state is None or isinstance(session_state, dict):
+            key = self.key(previous[:covered])
+            session_state = {
+                **(session_state or {}),
+                "history_memory": {
+                    "key": key,
+                    "summary": summary,
+                    "messages": covered,
+                    "signature": self.sign(key, summary),
+                },
+            }
+        return summary, history[covered:], session_state
+
+    async def summarize_prefix(
+        self,
+        previous: List[Dict[str, str]],
+        covered: int,
+        base: int,
+        session_state: Any = None,
+    ) -> str:
+        key = self.key(previous[:covered])
+        if (summary := self.get_cached(key, session_state)) is not None:
+            return summary
+        # Single flight: the summary may already be computed for this worker, e.g. by `prefetch`
+        if key not in self.pending:
+            base_summary = (
+                self.get_cached(self.key(previous[:base]), session_state)
+                if base
+                else None
+            )
+            if base_summary is None:
+                messages = previous[:covered]
+            else:
+                messages = previous[base:covered]
+            self.pending[key] = asyncio.create_task(
+                self.summarize(key, base_summary, messages)
+            )
+        return await asyncio.shield(self.pending[key])
+
+    async def summarize(
+        self, key: str, memory: Optional[str], messages: List[Dict[str, str]]
+    ) -> str:
+        try:
+            # The newest messages matter most when the input has to be cut
+            kept, tokens = [], 0
+            for message in reversed(messages):
+                tokens += count_message_tokens(message, gpt.CHATGPT_MODEL)
+                if tokens > self.max_input_tokens and kept:
+                    break
+                kept.insert(0, message)
+            transcript = "\n".join(f"{m['role']}: {m['content']}" for m in kept)
+            with stage("summarize_history", model=gpt.CHATGPT_MODEL):
+                completion = await gpt.aclient.chat.completions.create(
+                    model=gpt.CHATGPT_MODEL,
+                    messages=[
+                        {
+                            "role": "system",
+                            "content": SUMMARY_PROMPT.format(
+                                max_tokens=self.max_tokens
+                            ),
+                        },
+                        {
+                            "role": "user",
+                            "content": f"Memory:\n{memory or '(empty)'}\n\nNew messages:\n{transcript}",
+                        },
+                    ],
+                    temperature=0.0,
+                    max_tokens=self.max_tokens,
+                    n=1,
+                )
+            summary = completion.choices[0].message.content or ""
+            self.put(key, summary)
+            logger.debug(
+                f"Summarized {len(kept)} messages into the history memory",
+                tokens=tokens,
+            )
+            return summary
+        finally:
+            self.pending.pop(key, None)
+
+    def prefetch(self, previous: List[Dict[str, str]]):
+        """
+        Starts summarizing the memory the next turn will need, given the history before its question.
+        Best effort: the next turn computes it itself if it lands on another worker.
+        """
+        covered, base = self.split(previous)
+        if not covered:
+            return
+        key = self.key(previous[:covered])
+        if key in self.cache or key in self.pending:
+            return
+        task = asyncio.create_task(self.summarize_prefix(previous, covered, base))
+        task.add_done_callback(self.prefetch_done)
+
+    @staticmethod
+    def prefetch_done(task: asyncio.Task):
+        if not task.cancelled() and (error := task.exception()):
+            logger.warning(f"Failed to prefetch the history memory: {error}")
+
+    @staticmethod
+    def system_prompt(system_prompt: str, memory: Optional[str]) -> str:
+        return (
+            system_prompt + MEMORY_PROMPT.format(memory=memory)
+            if memory
+            else system_prompt
+        )
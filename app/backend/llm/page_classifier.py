@@ -0,0 +1,67 @@
+"""
+Routing of the pages of a v-scan document between native text extraction and GPT-4V.
+A page whose text layer covers it is extracted with PyMuPDF; pages that are mostly images (scans, photos), have little
+or unreadable text, or carry charts and diagrams (many vector drawings) are sent to the vision model.
+"""
+from typing import Any, Dict, Tuple
+import fitz
+
+TEXT = "text"
+VISION = "vision"
+
+
+class PageClassifier:
+    """
+    Attributes:
+        min_text_chars (int): Pages with fewer extracted characters need the vision model.
+        max_image_coverage (float): Share of the page area covered by images above which the page needs the vision model.
+        max_drawings (int): Vector drawing paths above which the page is treated as a chart or diagram.
+        min_printable (float): Share of printable characters below which the text layer is treated as unreadable.
+    """
+
+    def __init__(
+        self,
+        min_text_chars: int = 200,
+        max_image_coverage: float = 0.3,
+        max_drawings: int = 50,
+        min_printable: float = 0.9,
+    ):
+        self.min_text_chars = min_text_chars
+        self.max_image_coverage = max_image_coverage
+        self.max_drawings = max_drawings
+        self.min_printable = min_printable
+
+    @staticmethod
+    def image_coverage(page: fitz.Page) -> float:
+        """Share of the page covered by images (overlapping images add up, capped at 1)"""
+        page_area = abs(page.rect) or 1
+        covered = 0.0
+        for image in page.get_image_info():
+            covered += abs(fitz.Rect(image["bbox"]) & page.rect)
+        return min(1.0, covered / page_area)
+
+    def classify(self, page: fitz.Page) -> Tuple[str, str, Dict[str, Any]]:
+        """The route of the page, its native text and the features the decision was made on"""
+        text = page.get_text("text").strip()
+        printable = (
+            sum(1 for c in text if c.isprintable() or c.isspace()) / len(text)
+            if text
+            else 0.0
+        )
+        features = {
+            "text_chars": len(text),
+            "printable": round(printable, 3),
+            "image_coverage": round(self.image_coverage(page), 3),
+        }
+        if (
+            features["text_chars"] < self.min_text_chars
+            or "\ufffd" in text
+            or printable < self.min_printable
+            or features["image_coverage"] > self.max_image_coverage
+        ):
+            return VISION, text, features
+        # Counting the drawings is the expensive check, so it runs last
+        features["drawings"] = len(page.get_drawings())
+        if features["drawings"] > self.max_drawings:
+            return VISION, text, features
+        return TEXT, text, features
@@ -0,0 +1,114 @@
+"""
+Named retrieval profiles for Azure Cognitive Search. A profile decides which parts of the
+hybrid query are sent (text, vectors, semantic ranker) and carries its own top/k/caption settings.
+A profile can be selected per request through `context.overrides.retrieval_profile`.
+"""
+from typing import Any, Dict, List, Optional
+
+TEXT = "text"
+VECTOR = "vector"
+HYBRID = "hybrid"
+HYBRID_SEMANTIC = "hybrid+semantic"
+
+# Legacy `retrieval_mode` values sent by the frontend
+RETRIEVAL_MODES = {"text": TEXT, "vectors": VECTOR, "hybrid": HYBRID}
+
+# Fields every search result needs: the section id and where it was cut from
+SOURCE_FIELDS = ["id", "sourcepage", "sourcefile"]
+
+
+class RetrievalProfile:
+    def __init__(
+        self,
+        name: str,
+        use_text: bool,
+        use_vectors: bool,
+        use_semantic_ranker: bool = False,
+        use_semantic_captions: bool = False,
+        top: int = 5,
+        k_nearest_neighbors: int = 3,
+    ):
+        self.name = name
+        self.use_text = use_text
+        self.use_vectors = use_vectors
+        self.use_semantic_ranker = use_semantic_ranker
+        # Captions are produced by the semantic ranker only
+        self.use_semantic_captions = use_semantic_captions and use_semantic_ranker
+        self.top = top
+        self.k_nearest_neighbors = k_nearest_neighbors
+
+    def with_overrides(self, overrides: Dict[str, Any]) -> "RetrievalProfile":
+        """Returns a copy of the profile with the per-request top/k/captions applied"""
+        return RetrievalProfile(
+            name=self.name,
+            use_text=self.use_text,
+            use_vectors=self.use_vectors,
+            use_semantic_ranker=self.use_semantic_ranker,
+            use_semantic_captions=overrides.get(
+                "semantic_captions", self.use_semantic_captions
+            ),
+            top=int(overrides.get("top") or self.top),
+            k_nearest_neighbors=int(
+                overrides.get("k_nearest_neighbors") or self.k_nearest_neighbors
+            ),
+        )
+
+    def select_fields(self) -> List[str]:
+        """
+        The fields retrieved for each hit. The section text is not needed when the answer is built from the
+        semantic captions, which come back with the hit anyway.
+        """
+        if self.use_semantic_captions:
+            return SOURCE_FIELDS
+        return SOURCE_FIELDS + ["content"]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "profile": self.name,
+            "top": self.top,
+            "k_nearest_neighbors": self.k_nearest_neighbors,
+            "semantic_ranker": self.use_semantic_ranker,
+            "semantic_captions": self.use_semantic_captions,
+        }
+
+
+RETRIEVAL_PROFILES = {
+    TEXT: RetrievalProfile(TEXT, use_text=True, use_vectors=False, top=5),
+    VECTOR: RetrievalProfile(
+        VECTOR, use_text=False, use_vectors=True, top=5, k_nearest_neighbors=5
+    ),
+    HYBRID: RetrievalProfile(
+        HYBRID, use_text=True, use_vectors=True, top=5, k_nearest_neighbors=3
+    ),
+    HYBRID_SEMANTIC: RetrievalProfile(
+        HYBRID_SEMANTIC,
+        use_text=True,
+        use_vectors=True,
+        use_semantic_ranker=True,
+        use_semantic_captions=True,
+        top=5,
+        k_nearest_neighbors=3,
+    ),
+}
+
+
+def get_retrieval_profile(
+    overrides: Dict[str, Any], default: Optional[str] = HYBRID_SEMANTIC
+) -> RetrievalProfile:
+    """
+    Picks the retrieval profile for a request.
+    `retrieval_profile` wins; otherwise the legacy `retrieval_mode` and `semantic_ranker`
+    overrides are mapped onto a profile. Unknown names fall back to the default profile,
+    and an unknown default to hybrid+semantic.
+    """
+    name = overrides.get("retrieval_profile")
+    if name is None and (mode := overrides.get("retrieval_mode")):
+        name = RETRIEVAL_MODES.get(mode)
+        if name == HYBRID and overrides.get("semantic_ranker", True):
+            name = HYBRID_SEMANTIC
+    profile = (
+        RETRIEVAL_PROFILES.get(name)
+        or RETRIEVAL_PROFILES.get(default)
+        or RETRIEVAL_PROFILES[HYBRID_SEMANTIC]
+    )
+    return profile.with_overrides(overrides)
@@ -0,0 +1,86 @@
+"""
+Policy for the query rewrite step of /chat.
+The rewrite turns a follow-up question into a standalone search query. It is skipped when there is nothing to
+resolve: on the first turn, and for questions that do not refer back to the conversation. Rewrites that are needed
+are cached on the question and the context they were made with, and can be routed to a smaller model.
+"""
+import re
+import json
+import hashlib
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+# Paths taken by the rewrite step, reported in the `chat_rewrite` metric
+FIRST_TURN = "first_turn"
+SELF_CONTAINED = "self_contained"
+CACHED = "cached"
+MODEL = "model"
+
+# Words that make a question depend on earlier turns
+REFERENCES = re.compile(
+    r"\b(it|its|they|them|their|theirs|this|that|these|those|he|him|his|she|her|hers|"
+    r"above|previous|previously|earlier|former|latter|same|else|also|too|again|"
+    r"what about|how about)\b",
+    re.IGNORECASE,
+)
+# ... and so do questions that continue the previous one ("and in 2022?")
+CONTINUATION = re.compile(r"^\W*(and|or|but|so|then|what if)\b", re.IGNORECASE)
+
+
+class RewritePolicy:
+    """
+    Attributes:
+        skip_first_turn (bool): Search with the question itself on the first turn.
+        skip_self_contained (bool): Search with the question itself when it does not refer to earlier turns.
+        min_words (int): Shorter questions ("why?", "and in 2022?") are always rewritten.
+        capacity (int): Rewrites kept in the worker's cache (0 disables it).
+    """
+
+    def __init__(
+        self,
+        skip_first_turn: bool = True,
+        skip_self_contained: bool = True,
+        min_words: int = 4,
+        capacity: int = 1000,
+    ):
+        self.skip_first_turn = skip_first_turn
+        self.skip_self_contained = skip_self_contained
+        self.min_words = min_words
+        self.capacity = capacity
+        self.cache: OrderedDict[str, str] = OrderedDict()
+
+    def is_self_contained(self, question: str) -> bool:
+        return (
+            len(question.split()) >= self.min_words
+            and REFERENCES.search(question) is None
+            and CONTINUATION.search(question) is None
+        )
+
+    def skip(self, history: List[Dict[str, str]]) -> Optional[str]:
+        """The path that makes the rewrite unnecessary, if any"""
+        if self.skip_first_turn and len(history) == 1:
+            return FIRST_TURN
+        if self.skip_self_contained and self.is_self_contained(history[-1]["content"]):
+            return SELF_CONTAINED
+        return None
+
+    @staticmethod
+    def key(history: List[Dict[str, str]], memory: Optional[str], model: str) -> str:
+        content = json.dumps(
+            [model, memory, [(m["role"], m["content"]) for m in history]]
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        return None
+
+    def put(self, key: str, query: str):
+        if not self.capacity:
+            return
+        self.cache[key] = query
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
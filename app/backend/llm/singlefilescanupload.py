@@ -1,13 +1,19 @@
 import os
 import fitz
 import time
-from typing import Any, List, Dict
+from typing import Any, List, Dict, Optional
+import numpy as np
 import tiktoken
 from openai import RateLimitError
 
 from utils import filename_to_id, encode_image
 from llm.assistants import get_or_create_assistant_by_name, page_scanning_template
-from config import logger, az, gpt
+from llm.page_classifier import TEXT, VISION, PageClassifier
+from utils.ingestion_metrics import IngestionMetrics, rate_limit_callback
+from utils.section_store import Section, SectionStore
+from utils.search_backend import SearchBackend
+from utils.content_registry import ContentRegistry, IngestionResult
+from config import logger, az, gpt, config
 from tenacity import (
     retry,
     retry_if_exception_type,
@@ -19,13 +25,15 @@ from tenacity import (
 MAX_SECTION_LENGTH = 1000
 SENTENCE_SEARCH_LIMIT = 100
 SECTION_OVERLAP = 100
+# Ingestion results of this class are registered under this mode
+MODE = "scan"
 
 
 class SingleFileScanUpload:
     """
     The logic:
     1. Splits the document into pages and saves them as images using fitz (PyMuPDF)
-    2. Uses GPT-4 Vision model to scan the pages for informative data
+    2. Extracts the text of pages covered by their text layer, and uses GPT-4 Vision model to scan the other pages
     3. Uploads the source file, pages, and texts into Azure Blob Storage
     4. Uses summary assistant to summarize the document
     5. Indexes the outputs in Azure Cognitive Search
@@ -38,6 +46,16 @@ class SingleFileScanUpload:
             gpt.CHATGPT_MODEL, "document-summarization"
         )
         self.temp_dir = "temp"
+        self.metrics = IngestionMetrics(filename="", mode="scan")
+        self.classifier = (
+            PageClassifier(
+                min_text_chars=config.SCAN_MIN_TEXT_CHARS,
+                max_image_coverage=config.SCAN_MAX_IMAGE_COVERAGE,
+                max_drawings=config.SCAN_MAX_DRAWINGS,
+            )
+            if config.SCAN_TEXT_FIRST
+            else None
+        )
 
     def calculate_tokens(self, input: str):
         encoding = tiktoken.encoding_for_model(gpt.CHATGPT_MODEL)
@@ -51,15 +69,40 @@ class SingleFileScanUpload:
     def get_temp_image_path(self, filename, page):
         return f"{self.temp_dir}/{filename}-{page}.png"
 
-    def upload_blobs(self, filename, page_map: List[Dict[str, Any]], file_id):
+    def cleanup_temp_dir(self):
+        # Nothing was rendered when the content is reused
+        if os.path.exists(self.temp_dir):
+            for i in os.listdir(self.temp_dir):
+                os.remove(f"{self.temp_dir}/{i}")
+
+    def upload_blobs(
+        self,
+        filename,
+        page_map: List[Dict[str, Any]],
+        file_id,
+        image_source: Optional[str] = None,
+    ):
+        """
+        Uploads the page images and texts. The images are read from the temp directory,
+        or with `image_source` copied from the page images of that earlier file
+        """
         for page in page_map:
             blob_name = f"{filename}-page{page['page_num']}"
-            image_path = self.get_temp_image_path(filename, page["page_num"])
             # Step 1. Upload image
-            with open(image_path, "rb") as f:
+            if image_source is None:
+                image_path = self.get_temp_image_path(filename, page["page_num"])
+                with open(image_path, "rb") as f:
+                    image = f.read()
+            elif image_source != filename:
+                image = az.blob_container.download_blob(
+                    f"{image_source}-page{page['page_num']}.png"
+                ).readall()
+            else:
+                image = None
+            if image is not None:
                 az.blob_container.upload_blob(
                     blob_name + ".png",
-                    f.read(),
+                    image,
                     overwrite=True,
                     metadata={"id": file_id},
                 )
@@ -71,8 +114,22 @@ class SingleFileScanUpload:
                 metadata={"id": file_id},
             )
 
-    def split_pdf_into_images(self, filename: str, content) -> List[str]:
-        """This method saves pdf pages as images in the temp directory"""
+    def has_page_images(self, filename: str, page_map: List[Dict[str, Any]]) -> bool:
+        names = {
+            blob.name
+            for blob in az.blob_container.list_blobs(
+                name_starts_with=f"{filename}-page"
+            )
+        }
+        return all(
+            f"{filename}-page{page['page_num']}.png" in names for page in page_map
+        )
+
+    def split_pdf_into_images(self, filename: str, content) -> List[Dict[str, Any]]:
+        """
+        This method saves pdf pages as images in the temp directory, and routes each page to the
+        native text extraction ("route": "text", with its "text") or to the vision model ("route": "vision")
+        """
         if not os.path.exists(self.temp_dir):
             os.makedirs(self.temp_dir)
         doc = fitz.open(filename, content.read())
@@ -83,26 +140,24 @@ class SingleFileScanUpload:
             page = doc.load_page(page_num)  # Load each page
             pix = page.get_pixmap(dpi=150)  # Render page to an image pixmap
             image_path = self.get_temp_image_path(filename, page_num)
-            images.append({"page_num": page_num, "image_file": image_path})
+            image = {"page_num": page_num, "image_file": image_path, "route": VISION}
+            if self.classifier is not None:
+                route, text, features = self.classifier.classify(page)
+                logger.debug(f"Page {page_num} of '{filename}': {route}", **features)
+                if route == TEXT:
+                    image.update({"route": TEXT, "text": text})
+            images.append(image)
             pix.save(image_path)  # Save the image of the page
 
         doc.close()
         images.sort(key=lambda x: x["page_num"])
         return images
 
-    @retry(
-        retry=retry_if_exception_type(RateLimitError),
-        wait=wait_random_exponential(min=15, max=60),
-        stop=stop_after_attempt(30),
-        before_sleep=logger.vision_limit_reached,
-    )
-    def scan_page_image(self, image_file: str) -> str:
-        """
-        As of the moment of writing this code, OpenAI only has GPT4-Vision in preview and it's only available through ChatCompletion API.
-        """
-        logger.info(f"Scanning page image '{image_file}' using OpenAI")
+    @staticmethod
+    def vision_request(image_file: str) -> Dict[str, Any]:
+        """Body of the chat completion request that scans a page image"""
         base64_image = encode_image(image_file)
-        payload = {
+        return {
             "model": gpt.CHATGPT_VISION_MODEL,
             "messages": [
                 {
@@ -121,15 +176,35 @@ class SingleFileScanUpload:
             ],
             "max_tokens": 2048,
         }
+
+    @retry(
+        retry=retry_if_exception_type(RateLimitError),
+        wait=wait_random_exponential(min=1, max=60),
+        stop=stop_after_attempt(30),
+        before_sleep=rate_limit_callback(
+            gpt.CHATGPT_VISION_MODEL, logger.vision_limit_reached
+        ),
+    )
+    def scan_page_image(self, image_file: str) -> str:
+        """
+        As of the moment of writing this code, OpenAI only has GPT4-Vision in preview and it's only available through ChatCompletion API.
+        """
+        logger.info(f"Scanning page image '{image_file}' using OpenAI")
+        payload = self.vision_request(image_file)
         response = gpt.client.chat.completions.create(**payload)
-        logger.info(f"Output: {response.choices[0].message.content}")
+        self.metrics.api_call(gpt.CHATGPT_VISION_MODEL, "vision", response.usage)
+        logger.payload("Vision output", response.choices[0].message.content)
         return response.choices[0].message.content
 
-    def scan_page_images(self, image_files: List[Dict[int, str]]):
+    def scan_page_images(self, image_files: List[Dict[str, Any]]):
         page_map = []
         offset = 0
-        for img in image_files:
-            image_text = self.scan_page_image(img["image_file"])
+        for i, img in enumerate(image_files):
+            self.metrics.page_route(img["route"])
+            if img["route"] == TEXT:
+                image_text = img["text"]
+            else:
+                image_text = self.scan_page_image(img["image_file"])
             page_map.append(
                 {
                     "page_num": img["page_num"],
@@ -138,16 +213,20 @@ class SingleFileScanUpload:
                 }
             )
             offset += len(image_text)
+            self.metrics.progress(i + 1, len(image_files))
         return page_map
 
     @retry(
         retry=retry_if_exception_type(RateLimitError),
-        wait=wait_random_exponential(min=15, max=60),
+        wait=wait_random_exponential(min=1, max=60),
         stop=stop_after_attempt(15),
-        before_sleep=logger.embedding_limit_reached,
+        before_sleep=rate_limit_callback(
+            gpt.EMB_MODEL_NAME, logger.embedding_limit_reached
+        ),
     )
     def compute_embedding(self, content):
         res = gpt.client.embeddings.create(model=gpt.EMB_MODEL_NAME, input=content)
+        self.metrics.api_call(gpt.EMB_MODEL_NAME, "embedding", res.usage)
         return res.data[0].embedding
 
     @staticmethod
@@ -222,7 +301,7 @@ class SingleFileScanUpload:
                 # If the section ends with an unclosed table, we need to start the next section with the table.
                 # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
                 # If last table starts inside SECTION_OVERLAP, keep overlapping
-                logger.info(
+                logger.debug(
                     f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}"
                 )
                 start = min(end - SECTION_OVERLAP, start + last_table_start)
@@ -232,6 +311,42 @@ class SingleFileScanUpload:
         if start + SECTION_OVERLAP < end:
             yield (all_text[start:end], find_page(start))
 
+    def build_sections(
+        self,
+        title,
+        category,
+        filename,
+        page_map,
+        file_id,
+        is_summary=False,
+        is_assessment=False,
+    ) -> List[Section]:
+        """The sections of a document, without their embeddings"""
+        return [
+            Section(
+                id=f"{file_id}-page-{i}",
+                content=content,
+                title=title,
+                category=category,
+                sourcepage=f"{filename}-page{i}.txt",
+                sourcefile=filename,
+                is_summary=is_summary,
+                is_assessment=is_assessment,
+            )
+            for i, (content, pagenum) in enumerate(self.split_text(page_map, filename))
+        ]
+
+    @staticmethod
+    async def upload_sections(sections: SectionStore):
+        # The search documents are built one batch at a time
+        for batch in sections.batches(az.SEARCH_UPLOAD_BATCH_SIZE):
+            results = await az.search_client.upload_documents(documents=batch)
+            succeeded = sum([1 for r in results if r.succeeded])
+            logger.info(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+        # The local index writes its files once per document instead of per batch
+        if isinstance(az.search_client, SearchBackend):
+            await az.search_client.flush()
+
     async def index_document(
         self,
         title,
@@ -241,45 +356,39 @@ class SingleFileScanUpload:
         file_id,
         is_summary=False,
         is_assessment=False,
-    ) -> str:
+        embeddings: Optional[np.ndarray] = None,
+    ) -> SectionStore:
         """
-        This method indexes a document into Azure Cognitive Search
+        This method indexes a document into Azure Cognitive Search.
+        `embeddings` of the same sections, e.g. from the content registry, are used instead of computing them.
         """
         logger.info(
             f"Indexing sections from '{filename}' into search index '{az.SEARCH_INDEX}'"
         )
         # Step 1: Generate sections
-        sections = []
-        for i, (content, pagenum) in enumerate(self.split_text(page_map, filename)):
-            section = {
-                "id": f"{file_id}-page-{i}",
-                "content": content,
-                "title": title,
-                "category": category,
-                "sourcepage": f"{filename}-page{i}.txt",
-                "sourcefile": filename,
-                "is_summary": is_summary,
-                "is_assessment": is_assessment,
-            }
-            section["embedding"] = self.compute_embedding(content)
-            sections.append(section)
+        with self.metrics.stage("embed"):
+            sections = SectionStore(
+                self.build_sections(
+                    title,
+                    category,
+                    filename,
+                    page_map,
+                    file_id,
+                    is_summary,
+                    is_assessment,
+                )
+            )
+            if embeddings is not None and len(embeddings) == len(sections):
+                sections.set_embeddings(embeddings)
+            else:
+                for i, section in enumerate(sections):
+                    sections.set_embedding(i, self.compute_embedding(section.content))
+                    self.metrics.progress(i + 1, len(sections))
+        self.metrics.sections += len(sections)
         # Step 2. Index Sections
-        i = 0
-        batch = []
-        # Preventive save every 1000 sections
-        for s in sections:
-            batch.append(s)
-            i += 1
-            if i % 1000 == 0:
-                results = await az.search_client.upload_documents(documents=batch)
-                succeeded = sum([1 for r in results if r.succeeded])
-                logger.info(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
-                batch = []
-        # Save the remaining sections
-        if len(batch) > 0:
-            results = await az.search_client.upload_documents(documents=batch)
-            succeeded = sum([1 for r in results if r.succeeded])
-            logger.info(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+        with self.metrics.stage("index"):
+            await self.upload_sections(sections)
+        return sections
 
     def add_message_to_thread(self, page, thread):
         gpt.client.beta.threads.messages.create(
@@ -288,6 +397,45 @@ class SingleFileScanUpload:
             content=page["page_text"],
             metadata={"page_num": page["page_num"]},
         )
+        self.metrics.api_call(gpt.CHATGPT_MODEL, "assistant")
+
+    def lookup_content(self, content_hash: Optional[str]) -> Optional[IngestionResult]:
+        if not content_hash or not config.CONTENT_DEDUP:
+            return None
+        try:
+            return ContentRegistry.get(
+                az.blob_container, MODE, content_hash, gpt.EMB_MODEL_NAME
+            )
+        except Exception as error:
+            logger.warning(f"Failed to look up the content registry: {error}")
+            return None
+
+    def register_content(
+        self,
+        content_hash: Optional[str],
+        filename: str,
+        page_map: List[Dict[str, Any]],
+        summary: Dict[str, Any],
+        pages: SectionStore,
+        summary_sections: SectionStore,
+    ):
+        if not content_hash or not config.CONTENT_DEDUP:
+            return
+        try:
+            ContentRegistry.put(
+                az.blob_container,
+                MODE,
+                content_hash,
+                gpt.EMB_MODEL_NAME,
+                IngestionResult(
+                    filename,
+                    page_map,
+                    summary,
+                    {"pages": pages.matrix(), "summary": summary_sections.matrix()},
+                ),
+            )
+        except Exception as error:
+            logger.warning(f"Failed to store the content registry entry: {error}")
 
     def run_openai_assistant(self, filename, page_map):
         """
@@ -301,6 +449,7 @@ class SingleFileScanUpload:
                 "pages_count": len(page_map),
             }
         )
+        self.metrics.api_call(gpt.CHATGPT_MODEL, "assistant")
         # Step 2: Insert every page as a message
         for page in page_map:
             self.add_message_to_thread(page, thread)
@@ -311,48 +460,89 @@ class SingleFileScanUpload:
             thread_id=thread.id,
             assistant_id=self.summary_assistant.id,
         )
+        self.metrics.api_call(gpt.CHATGPT_MODEL, "assistant")
 
         while run.status in ["queued", "in_progress"]:
             time.sleep(1)
             run = gpt.client.beta.threads.runs.retrieve(
                 thread_id=thread.id, run_id=run.id
             )
+            self.metrics.api_call(gpt.CHATGPT_MODEL, "assistant")
         thread_messages = gpt.client.beta.threads.messages.list(thread.id)
+        self.metrics.api_call(gpt.CHATGPT_MODEL, "assistant")
         res = thread_messages.data[0].content[0].text.value
         summary = eval(res[res.find("{") : res.rfind("}") + 1])
         logger.info(f"Title: {summary['title']}")
         logger.info(f"Category: {summary['category']}")
         logger.info(f"Summary: {summary['summary']}")
         gpt.client.beta.threads.delete(thread.id)
+        self.metrics.api_call(gpt.CHATGPT_MODEL, "assistant")
+        # Runs report their token usage on newer API versions
+        if (usage := getattr(run, "usage", None)) is not None:
+            self.metrics.api_call(gpt.CHATGPT_MODEL, "assistant_run", usage)
         return summary
 
-    async def run(self, filename: str) -> None:
+    async def run(
+        self,
+        filename: str,
+        metrics: Optional[IngestionMetrics] = None,
+        content_hash: Optional[str] = None,
+    ) -> None:
+        self.metrics = metrics or IngestionMetrics(filename, mode="scan")
         file_id = filename_to_id(filename)
-        # Download the file
-        file = self.download_source_file(filename)
-        # Step 1. Recognize the document using Azure Form Recognizer and split it into pages
-        images = self.split_pdf_into_images(filename, file)
+        # The same content may have been ingested before, under this or another filename.
+        # Its page images are copied from that file, so the PDF is not downloaded and rendered again
+        reused = self.lookup_content(content_hash)
+        if reused is not None and not self.has_page_images(
+            reused.filename, reused.page_map
+        ):
+            reused = None
         try:
-            # Step 2. Uses GPT-4 Vision model to scan the pages for informative data
-            page_map = self.scan_page_images(images)
+            if reused is not None:
+                logger.info(
+                    f"'{filename}' has the content of '{reused.filename}', indexing it from the content registry"
+                )
+                self.metrics.reused_from = reused.filename
+                page_map, summary = reused.page_map, reused.summary
+                self.metrics.pages = len(page_map)
+            else:
+                # Download the file
+                with self.metrics.stage("download"):
+                    file = self.download_source_file(filename)
+                # Step 1. Split the document into page images
+                with self.metrics.stage("render"):
+                    images = self.split_pdf_into_images(filename, file)
+                self.metrics.pages = len(images)
+                # Step 2. Uses GPT-4 Vision model to scan the pages for informative data
+                with self.metrics.stage("scan"):
+                    page_map = self.scan_page_images(images)
 
             # Step 3. Upload pages into Azure Blob Storage
-            self.upload_blobs(filename, page_map, file_id)
+            with self.metrics.stage("blob_upload"):
+                self.upload_blobs(
+                    filename,
+                    page_map,
+                    file_id,
+                    image_source=reused.filename if reused else None,
+                )
 
             # Step 4. Run the summarization
-            summary = self.run_openai_assistant(filename, page_map)
+            if reused is None:
+                with self.metrics.stage("summarize"):
+                    summary = self.run_openai_assistant(filename, page_map)
 
             # Step 5. Index pages into Azure Cognitive Search
-            await self.index_document(
+            pages = await self.index_document(
                 title=summary["title"],
                 category="Business Summary Document",
                 filename=filename,
                 file_id=file_id,
                 page_map=page_map,
+                embeddings=reused.embeddings.get("pages") if reused else None,
             )
 
             # And summary
-            await self.index_document(
+            summary_sections = await self.index_document(
                 title=summary["title"],
                 category="Business Summary Document",
                 filename=filename,
@@ -361,15 +551,18 @@ class SingleFileScanUpload:
                     {"page_num": 0, "page_offset": 0, "page_text": summary["summary"]}
                 ],
                 is_summary=True,
+                embeddings=reused.embeddings.get("summary") if reused else None,
             )
+            if reused is None:
+                self.register_content(
+                    content_hash, filename, page_map, summary, pages, summary_sections
+                )
 
             # Cleanup
-            for i in os.listdir(self.temp_dir):
-                os.remove(f"{self.temp_dir}/{i}")
+            self.cleanup_temp_dir()
 
             return {**summary, "filename": filename, "id": file_id}
         except Exception as e:
             # Cleanup
-            for i in os.listdir(self.temp_dir):
-                os.remove(f"{self.temp_dir}/{i}")
+            self.cleanup_temp_dir()
             raise e
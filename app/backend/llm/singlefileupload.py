@@ -1,12 +1,20 @@
 import os
 import html
 import time
-from typing import Any, List, Dict, Optional
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterator, List, Dict, Optional, Tuple
+import fitz
+import numpy as np
 import tiktoken
 from openai import RateLimitError
 from utils import filename_to_id
 from llm.assistants import get_or_create_assistant_by_name
-from config import logger, az, gpt
+from utils.ingestion_metrics import IngestionMetrics, rate_limit_callback
+from utils.section_store import Section, SectionStore
+from utils.search_backend import SearchBackend
+from utils.content_registry import ContentRegistry, IngestionResult
+from config import logger, az, gpt, config
 from tenacity import (
     retry,
     retry_if_exception_type,
@@ -18,6 +26,8 @@ from tenacity import (
 MAX_SECTION_LENGTH = 1000
 SENTENCE_SEARCH_LIMIT = 100
 SECTION_OVERLAP = 100
+# Ingestion results of this class are registered under this mode
+MODE = "layout"
 
 
 class SingleFileUpload:
@@ -36,6 +46,7 @@ class SingleFileUpload:
         self.assistant = get_or_create_assistant_by_name(
             gpt.CHATGPT_MODEL, "document-summarization"
         )
+        self.metrics = IngestionMetrics(filename="")
 
     def calculate_tokens(self, input: str):
         encoding = tiktoken.encoding_for_model(gpt.CHATGPT_MODEL)
@@ -53,7 +64,7 @@ class SingleFileUpload:
     def upload_blobs(self, filename, pages: List[Dict[str, Any]], file_id):
         for page in pages:
             blob_name = self.blob_name_from_file_page(filename, page["page_num"])
-            logger.info(f"\tUploading blob for page {page['page_num']} -> {blob_name}")
+            logger.debug(f"\tUploading blob for page {page['page_num']} -> {blob_name}")
             az.blob_container.upload_blob(
                 blob_name, page["page_text"], overwrite=True, metadata={"id": file_id}
             )
@@ -86,19 +97,92 @@ class SingleFileUpload:
         table_html += "</table>"
         return table_html
 
-    def get_document_text(self, filename, content):
-        offset = 0
-        page_map = []
-        logger.info(f"Extracting text from '{filename}' using Azure Form Recognizer")
+    @staticmethod
+    def count_pdf_pages(data: bytes) -> Optional[int]:
+        try:
+            with fitz.open("pdf", data) as doc:
+                return doc.page_count
+        except Exception as error:
+            logger.warning(f"Failed to count the pages of the document: {error}")
+            return None
+
+    @staticmethod
+    def page_ranges(page_count: int, pages_per_call: int) -> List[Tuple[int, int]]:
+        """(first, last) page ranges, 1-based, of `pages_per_call` pages covering `page_count` pages"""
+        return [
+            (start, min(start + pages_per_call - 1, page_count))
+            for start in range(1, page_count + 1, pages_per_call)
+        ]
+
+    @staticmethod
+    def cut_pdf(data: bytes, ranges: List[Tuple[int, int]]) -> List[bytes]:
+        """The pages of every range as a PDF of their own"""
+        parts = []
+        with fitz.open("pdf", data) as source:
+            for first, last in ranges:
+                with fitz.open() as part:
+                    part.insert_pdf(source, from_page=first - 1, to_page=last - 1)
+                    parts.append(part.tobytes())
+        return parts
+
+    def analyze_layout(self, content, pages: Optional[str] = None):
+        kwargs = {"pages": pages} if pages else {}
         poller = az.form_recognizer.begin_analyze_document(
-            "prebuilt-layout", document=content
+            "prebuilt-layout", document=content, **kwargs
         )
-        form_recognizer_results = poller.result()
-        for page_num, page in enumerate(form_recognizer_results.pages):
+        return poller.result()
+
+    def analyze_document(self, filename, content) -> List[Tuple[int, Any]]:
+        """
+        Layout results of the document, with the number of their first page. PDFs longer than
+        FORM_RECOGNIZER_PAGES_PER_CALL pages are cut into PDFs of that many pages, analyzed
+        FORM_RECOGNIZER_CONCURRENCY at a time, and come back as one result per part.
+        """
+        pages_per_call = az.FORM_RECOGNIZER_PAGES_PER_CALL
+        if (
+            not pages_per_call
+            or content is None
+            or not filename.lower().endswith(".pdf")
+        ):
+            return [(1, self.analyze_layout(content))]
+        if isinstance(content, bytes):
+            data = content
+        else:
+            data = content.readall() if hasattr(content, "readall") else content.read()
+        page_count = self.count_pdf_pages(data)
+        if not page_count or page_count <= pages_per_call:
+            return [(1, self.analyze_layout(data))]
+        ranges = self.page_ranges(page_count, pages_per_call)
+        logger.info(
+            f"Analyzing {page_count} pages of '{filename}' in {len(ranges)} page ranges"
+        )
+        # Every call uploads only its own pages (MuPDF is cut in this thread, it is not thread safe)
+        parts = self.cut_pdf(data, ranges)
+        workers = max(1, min(len(ranges), az.FORM_RECOGNIZER_CONCURRENCY))
+        analyzed = itertools.count(1)
+
+        def analyze(part: bytes):
+            result = self.analyze_layout(part)
+            self.metrics.progress(next(analyzed), len(ranges))
+            return result
+
+        with ThreadPoolExecutor(workers) as executor:
+            results = list(executor.map(analyze, parts))
+        return [(first, result) for (first, _), result in zip(ranges, results)]
+
+    def page_texts(
+        self, form_recognizer_results, first_page: int = 1
+    ) -> Iterator[Tuple[int, str]]:
+        """
+        (page_num, page text) of every page of a layout result, tables replaced by their html.
+        `first_page` is the page of the whole document the analyzed part starts with.
+        """
+        for page in form_recognizer_results.pages:
+            # Page numbers of the result (and of its tables) count from the start of the analyzed part
             tables_on_page = [
                 table
                 for table in form_recognizer_results.tables
-                if table.bounding_regions[0].page_number == page_num + 1
+                if table.bounding_regions[0].page_number == page.page_number
             ]
 
             # mark all positions of the table spans in the page
@@ -124,21 +208,40 @@ class SingleFileUpload:
                     added_tables.add(table_id)
 
             page_text += " "
-            page_map.append(
-                {"page_num": page_num, "page_offset": offset, "page_text": page_text}
-            )
-            offset += len(page_text)
+            yield first_page - 1 + page.page_number - 1, page_text
+
+    def get_document_text(self, filename, content):
+        offset = 0
+        page_map = []
+        logger.info(f"Extracting text from '{filename}' using Azure Form Recognizer")
+        for first_page, form_recognizer_results in self.analyze_document(
+            filename, content
+        ):
+            for page_num, page_text in self.page_texts(
+                form_recognizer_results, first_page
+            ):
+                page_map.append(
+                    {
+                        "page_num": page_num,
+                        "page_offset": offset,
+                        "page_text": page_text,
+                    }
+                )
+                offset += len(page_text)
 
         return page_map
 
     @retry(
         retry=retry_if_exception_type(RateLimitError),
-        wait=wait_random_exponential(min=15, max=60),
+        wait=wait_random_exponential(min=1, max=60),
         stop=stop_after_attempt(15),
-        before_sleep=logger.embedding_limit_reached,
+        before_sleep=rate_limit_callback(
+            gpt.EMB_MODEL_NAME, logger.embedding_limit_reached
+        ),
     )
     def compute_embedding(self, content):
         res = gpt.client.embeddings.create(model=gpt.EMB_MODEL_NAME, input=content)
+        self.metrics.api_call(gpt.EMB_MODEL_NAME, "embedding", res.usage)
         return res.data[0].embedding
 
     def add_message_to_thread(self, page, thread):
@@ -148,6 +251,7 @@ class SingleFileUpload:
             content=page["page_text"],
             metadata={"page_num": page["page_num"]},
         )
+        self.metrics.api_call(gpt.CHATGPT_MODEL, "assistant")
 
     @staticmethod
     def split_text(page_map, filename):
@@ -221,7 +325,7 @@ class SingleFileUpload:
                 # If the section ends with an unclosed table, we need to start the next section with the table.
                 # If table starts inside SENTENCE_SEARCH_LIMIT, we ignore it, as that will cause an infinite loop for tables longer than MAX_SECTION_LENGTH
                 # If last table starts inside SECTION_OVERLAP, keep overlapping
-                logger.info(
+                logger.debug(
                     f"Section ends with unclosed table, starting next section with the table at page {find_page(start)} offset {start} table start {last_table_start}"
                 )
                 start = min(end - SECTION_OVERLAP, start + last_table_start)
@@ -231,46 +335,107 @@ class SingleFileUpload:
         if start + SECTION_OVERLAP < end:
             yield (all_text[start:end], find_page(start))
 
-    async def index_document(
+    def build_sections(
         self, title, category, filename, file_id, page_map, is_summary=False
-    ) -> str:
+    ) -> List[Section]:
+        """The sections of a document, without their embeddings"""
+        return [
+            Section(
+                id=f"{file_id}-page-{i}",
+                content=content,
+                title=title,
+                category=category,
+                sourcepage=self.blob_name_from_file_page(filename, pagenum),
+                sourcefile=filename,
+                is_summary=is_summary,
+            )
+            for i, (content, pagenum) in enumerate(self.split_text(page_map, filename))
+        ]
+
+    @staticmethod
+    async def upload_sections(sections: SectionStore):
+        # The search documents are built one batch at a time
+        for batch in sections.batches(az.SEARCH_UPLOAD_BATCH_SIZE):
+            results = await az.search_client.upload_documents(documents=batch)
+            succeeded = sum([1 for r in results if r.succeeded])
+            logger.info(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+        # The local index writes its files once per document instead of per batch
+        if isinstance(az.search_client, SearchBackend):
+            await az.search_client.flush()
+
+    async def index_document(
+        self,
+        title,
+        category,
+        filename,
+        file_id,
+        page_map,
+        is_summary=False,
+        embeddings: Optional[np.ndarray] = None,
+    ) -> SectionStore:
         """
-        This method indexes a document into Azure Cognitive Search
+        This method indexes a document into Azure Cognitive Search.
+        `embeddings` of the same sections, e.g. from the content registry, are used instead of computing them.
         """
         logger.info(
             f"Indexing sections from '{filename}' into search index '{az.SEARCH_INDEX}'"
         )
         # Step 1: Generate sections
-        sections = []
-        for i, (content, pagenum) in enumerate(self.split_text(page_map, filename)):
-            section = {
-                "id": f"{file_id}-page-{i}",
-                "content": content,
-                "title": title,
-                "category": category,
-                "sourcepage": self.blob_name_from_file_page(filename, pagenum),
-                "sourcefile": filename,
-                "is_summary": is_summary,
-            }
-            section["embedding"] = self.compute_embedding(content)
-            sections.append(section)
+        with self.metrics.stage("embed"):
+            sections = SectionStore(
+                self.build_sections(
+                    title, category, filename, file_id, page_map, is_summary
+                )
+            )
+            if embeddings is not None and len(embeddings) == len(sections):
+                sections.set_embeddings(embeddings)
+            else:
+                for i, section in enumerate(sections):
+                    sections.set_embedding(i, self.compute_embedding(section.content))
+                    self.metrics.progress(i + 1, len(sections))
+        self.metrics.sections += len(sections)
         # Step 2. Index Sections
-        i = 0
-        batch = []
-        # Preventive save every 1000 sections
-        for s in sections:
-            batch.append(s)
-            i += 1
-            if i % 1000 == 0:
-                results = await az.search_client.upload_documents(documents=batch)
-                succeeded = sum([1 for r in results if r.succeeded])
-                logger.info(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
-                batch = []
-        # Save the remaining sections
-        if len(batch) > 0:
-            results = await az.search_client.upload_documents(documents=batch)
-            succeeded = sum([1 for r in results if r.succeeded])
-            logger.info(f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+        with self.metrics.stage("index"):
+            await self.upload_sections(sections)
+        return sections
+
+    def lookup_content(self, content_hash: Optional[str]) -> Optional[IngestionResult]:
+        if not content_hash or not config.CONTENT_DEDUP:
+            return None
+        try:
+            return ContentRegistry.get(
+                az.blob_container, MODE, content_hash, gpt.EMB_MODEL_NAME
+            )
+        except Exception as error:
+            logger.warning(f"Failed to look up the content registry: {error}")
+            return None
+
+    def register_content(
+        self,
+        content_hash: Optional[str],
+        filename: str,
+        page_map: List[Dict[str, Any]],
+        summary: Dict[str, Any],
+        pages: SectionStore,
+        summary_sections: SectionStore,
+    ):
+        if not content_hash or not config.CONTENT_DEDUP:
+            return
+        try:
+            ContentRegistry.put(
+                az.blob_container,
+                MODE,
+                content_hash,
+                gpt.EMB_MODEL_NAME,
+                IngestionResult(
+                    filename,
+                    page_map,
+                    summary,
+                    {"pages": pages.matrix(), "summary": summary_sections.matrix()},
+                ),
+            )
+        except Exception as error:
+            logger.warning(f"Failed to store the content registry entry: {error}")
 
     def run_openai_assistant(self, filename, page_map):
         """
@@ -284,6 +449,7 @@ class SingleFileUpload:
                 "pages_count": len(page_map),
             }
         )
+        self.metrics.api_call(gpt.CHATGPT_MODEL, "assistant")
         # Step 2: Insert every page as a message
         for page in page_map:
             self.add_message_to_thread(page, thread)
@@ -293,47 +459,76 @@ class SingleFileUpload:
             thread_id=thread.id,
             assistant_id=self.assistant.id,
         )
+        self.metrics.api_call(gpt.CHATGPT_MODEL, "assistant")
 
         while run.status in ["queued", "in_progress"]:
             time.sleep(1)
             run = gpt.client.beta.threads.runs.retrieve(
                 thread_id=thread.id, run_id=run.id
             )
+            self.metrics.api_call(gpt.CHATGPT_MODEL, "assistant")
 
         # Step 4: Get the result
         thread_messages = gpt.client.beta.threads.messages.list(thread.id)
+        self.metrics.api_call(gpt.CHATGPT_MODEL, "assistant")
         res = thread_messages.data[0].content[0].text.value
         summary = eval(res[res.find("{") : res.rfind("}") + 1])
         logger.info(f"Title: {summary['title']}")
         logger.info(f"Category: {summary['category']}")
         logger.info(f"Summary: {summary['summary']}")
         gpt.client.beta.threads.delete(thread.id)
+        self.metrics.api_call(gpt.CHATGPT_MODEL, "assistant")
+        # Runs report their token usage on newer API versions
+        if (usage := getattr(run, "usage", None)) is not None:
+            self.metrics.api_call(gpt.CHATGPT_MODEL, "assistant_run", usage)
         return summary
 
-    async def run(self, filename: str) -> None:
+    async def run(
+        self,
+        filename: str,
+        metrics: Optional[IngestionMetrics] = None,
+        content_hash: Optional[str] = None,
+    ) -> None:
+        self.metrics = metrics or IngestionMetrics(filename, mode="layout")
         file_id = filename_to_id(filename)
-        # Download the file
-        file = self.download_source_file(filename)
-        # Step 1. Recognize the document using Azure Form Recognizer and split it into pages
-        page_map = self.get_document_text(filename, file)
+        # The same content may have been ingested before, under this or another filename
+        reused = self.lookup_content(content_hash)
+        if reused is not None:
+            logger.info(
+                f"'{filename}' has the content of '{reused.filename}', indexing it from the content registry"
+            )
+            self.metrics.reused_from = reused.filename
+            page_map, summary = reused.page_map, reused.summary
+        else:
+            # Download the file
+            with self.metrics.stage("download"):
+                file = self.download_source_file(filename)
+            # Step 1. Recognize the document using Azure Form Recognizer and split it into pages
+            with self.metrics.stage("extract"):
+                page_map = self.get_document_text(filename, file)
+        self.metrics.pages = len(page_map)
 
         # Step 2. Upload pages into Azure Blob Storage
-        self.upload_blobs(filename, page_map, file_id)
+        with self.metrics.stage("blob_upload"):
+            self.upload_blobs(filename, page_map, file_id)
 
         # Step 3. Summarize the file using OpenAI
-        summary = self.run_openai_assistant(filename, page_map)
+        if reused is None:
+            with self.metrics.stage("summarize"):
+                summary = self.run_openai_assistant(filename, page_map)
 
         # Step 4. Index pages into Azure Cognitive Search
-        await self.index_document(
+        pages = await self.index_document(
             title=summary["title"],
             category=summary["category"],
             filename=filename,
             file_id=file_id,
             page_map=page_map,
+            embeddings=reused.embeddings.get("pages") if reused else None,
         )
 
         # Step 5. Index summary into Azure Cognitive Search
-        await self.index_document(
+        summary_sections = await self.index_document(
             title=summary["title"],
             category=summary["category"],
             filename=filename,
@@ -342,6 +537,11 @@ class SingleFileUpload:
                 {"page_num": 0, "page_offset": 0, "page_text": summary["summary"]}
             ],
             is_summary=True,
+            embeddings=reused.embeddings.get("summary") if reused else None,
         )
+        if reused is None:
+            self.register_content(
+                content_hash, filename, page_map, summary, pages, summary_sections
+            )
 
         return {**summary, "filename": filename, "id": file_id}
@@ -1,33 +1,212 @@
 import time
+import socket
 import asyncio
 import json
-from config import logger, az
+from typing import Optional
+from prometheus_client import start_http_server
+from config import logger, az, config
 from llm import SingleFileScanUpload, SingleFileUpload
+from llm.backfill import Backfill, BackfillDocument
+from utils.answer_cache import AnswerCache
+from utils.autoscaler import HeartbeatWriter
+from utils.ingestion_metrics import IngestionMetrics
+from utils.job_scheduler import Job, JobScheduler, LargeJobSlots
+from utils.job_status import (
+    FAILED,
+    SUCCEEDED,
+    JobStatusStore,
+    JobTracker,
+    queued_status,
+)
+from utils.rate_limiter import BULK, priority
+
+
+def finish_document(metrics: IngestionMetrics, filename: str, status: str):
+    summary = metrics.finish(status)
+    logger.info(f"Ingestion metrics: {json.dumps(summary)}")
+    try:
+        IngestionMetrics.upload_summary(az.blob_container, summary)
+    except Exception as ex:
+        logger.warning(f"Failed to store ingestion metrics: {ex}")
+    # Even a failed run may have replaced some of the indexed sections
+    try:
+        AnswerCache.publish_invalidation(az.blob_container, filename)
+    except Exception as ex:
+        logger.warning(f"Failed to invalidate cached answers: {ex}")
+
+
+def job_scheduler() -> JobScheduler:
+    """The lanes in priority order, then the single queue uploads went to before the lanes"""
+    if not config.JOB_LANES:
+        return JobScheduler(
+            {"default": az.queue},
+            {},
+            visibility_timeout=config.JOB_VISIBILITY_TIMEOUT,
+        )
+    slots = None
+    if config.JOB_LARGE_SLOTS:
+        slots = LargeJobSlots(az.blob_container, config.JOB_LARGE_SLOTS)
+    return JobScheduler(
+        {**az.lane_queues, "default": az.queue},
+        config.JOB_LANE_WEIGHTS,
+        slots=slots,
+        window=config.JOB_TENANT_WINDOW,
+        visibility_timeout=config.JOB_VISIBILITY_TIMEOUT,
+    )
+
+
+def job_tracker(job: Job) -> Optional[JobTracker]:
+    """Writes the status of the job, when it was uploaded with one (see /jobs/<id>)"""
+    job_id = job.body.get("job_id")
+    if not job_id:
+        return None
+    status = queued_status(
+        job_id, job.body["filename"], job.lane, job.body.get("pages") or 0
+    )
+    if job.message.inserted_on:
+        status["enqueued_at"] = job.message.inserted_on.isoformat()
+    return JobTracker(az.blob_container, status, config.JOB_STATUS_INTERVAL)
+
+
+def expire_job_statuses(last_run: float) -> float:
+    """Deletes the old job statuses when the last run was JOB_STATUS_EXPIRY_INTERVAL ago. Returns the last run"""
+    if time.monotonic() - last_run < config.JOB_STATUS_EXPIRY_INTERVAL:
+        return last_run
+    try:
+        expired = JobStatusStore.expire(az.blob_container, config.JOB_STATUS_TTL)
+        if expired:
+            logger.info(f"Deleted {expired} expired job statuses")
+    except Exception as ex:
+        logger.warning(f"Failed to delete expired job statuses: {ex}")
+    return time.monotonic()
+
+
+def heartbeat_writer() -> HeartbeatWriter:
+    """Tells the autoscaler this worker is alive, and whether it is busy (see utils/autoscaler.py)"""
+    worker_id = az.WORKER_ID or socket.gethostname()
+    return HeartbeatWriter(
+        az.blob_container, worker_id, config.AUTOSCALE_HEARTBEAT_INTERVAL
+    ).start()
+
+
+def run_backfill(loop):
+    """
+    Ingests the queued documents BACKFILL_DOCUMENTS at a time through the OpenAI Batch API.
+    Messages are deleted once their document is indexed; failed ones reappear after BACKFILL_VISIBILITY_TIMEOUT.
+    """
+    backfill = Backfill(poll_interval=config.BACKFILL_POLL_INTERVAL)
+    scheduler = job_scheduler()
+    heartbeat = heartbeat_writer()
+    logger.info(f"Starting Backfill Worker. Queues: {', '.join(scheduler.queues)}")
+    statuses_expired = float("-inf")
+    while True:
+        # Busy before receiving, so the autoscaler does not stop a worker that is taking messages
+        heartbeat.busy("receiving")
+        jobs = scheduler.batch(
+            config.BACKFILL_DOCUMENTS, config.BACKFILL_VISIBILITY_TIMEOUT
+        )
+        if not jobs:
+            heartbeat.idle()
+            logger.info("No messages in queue")
+            statuses_expired = expire_job_statuses(statuses_expired)
+            time.sleep(10)
+            continue
+        documents, trackers = [], []
+        for job in jobs:
+            tracker = job_tracker(job)
+            metrics = IngestionMetrics(
+                job.body["filename"],
+                mode="backfill-scan" if job.body["v-scan"] else "backfill-layout",
+                enqueued_at=job.message.inserted_on,
+                dequeue_count=job.message.dequeue_count,
+                listener=tracker,
+            )
+            if tracker is not None:
+                tracker.start(metrics)
+            documents.append(
+                BackfillDocument(job.body["filename"], job.body["v-scan"], metrics)
+            )
+            trackers.append(tracker)
+        logger.info(f"Backfilling {len(documents)} documents")
+        heartbeat.busy(f"backfill of {len(documents)} documents", held=len(jobs))
+        try:
+            loop.run_until_complete(backfill.run(documents))
+        except Exception:
+            heartbeat.idle()
+            raise
+        for job, document, tracker in zip(jobs, documents, trackers):
+            status = "failed" if document.error else "succeeded"
+            finish_document(document.metrics, document.filename, status)
+            if tracker is not None:
+                error = str(document.error) if document.error else None
+                tracker.finish(document.metrics, status, error)
+            logger.info(f"Result: {Backfill.result(document)}")
+            JobScheduler.done(job, succeeded=document.error is None)
+        heartbeat.idle()
 
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
     try:
         logger.info("Starting ACI Container")
+        # Ingestion leaves part of the OpenAI rate limits to interactive chat
+        priority.set(BULK)
         az.configure_clients()
+        if config.INGESTION_METRICS_PORT:
+            start_http_server(config.INGESTION_METRICS_PORT)
+        if config.INGESTION_MODE == "backfill":
+            run_backfill(loop)
         scan_upload = SingleFileScanUpload()
         upload = SingleFileUpload()
-        logger.info(f"Starting Task Worker. Queue: {az.STORAGE_QUEUE}")
+        scheduler = job_scheduler()
+        heartbeat = heartbeat_writer()
+        logger.info(f"Starting Task Worker. Queues: {', '.join(scheduler.queues)}")
+        statuses_expired = float("-inf")
         while True:
+            # Busy before receiving, so the autoscaler does not stop a worker that is taking a message
+            heartbeat.busy("receiving")
+            job = scheduler.next()
+            if job is None:
+                heartbeat.idle()
+                logger.info("No messages in queue")
+                statuses_expired = expire_job_statuses(statuses_expired)
+                time.sleep(10)
+                continue
+            logger.info(f"Received message from the {job.lane} lane: {job.message}")
+            body = job.body
+            tracker = job_tracker(job)
+            metrics = IngestionMetrics(
+                body["filename"],
+                mode="scan" if body["v-scan"] else "layout",
+                enqueued_at=job.message.inserted_on,
+                dequeue_count=job.message.dequeue_count,
+                listener=tracker,
+            )
+            if tracker is not None:
+                tracker.start(metrics)
+            heartbeat.busy(body["filename"], held=1)
+            status, error = FAILED, None
             try:
-                message = [_ for _ in az.queue.receive_messages(max_messages=1)][0]
-                logger.info(f"Received message: {message}")
-                body = json.loads(message["content"])
                 if body["v-scan"]:
-                    result = loop.run_until_complete(scan_upload.run(body["filename"]))
+                    result = loop.run_until_complete(
+                        scan_upload.run(body["filename"], metrics, body.get("sha256"))
+                    )
                 else:
-                    result = loop.run_until_complete(upload.run(body["filename"]))
-                logger.info(f"Result: {result}")
-                response = az.queue.delete_message(message)
-
-            except IndexError:
-                logger.info("No messages in queue")
-                time.sleep(10)
+                    result = loop.run_until_complete(
+                        upload.run(body["filename"], metrics, body.get("sha256"))
+                    )
+                status = SUCCEEDED
+            except Exception as ex:
+                error = str(ex)
+                raise
+            finally:
+                finish_document(metrics, body["filename"], status)
+                if tracker is not None:
+                    tracker.finish(metrics, status, error)
+                # Frees the large job slot, and deletes the message once it is done
+                JobScheduler.done(job, succeeded=status == SUCCEEDED)
+                heartbeat.idle()
+            logger.info(f"Result: {result}")
     except Exception as ex:
         logger.exception(ex)
         time.sleep(30)
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The tests import the backend packages (utils, llm, config) the way app.py and tasks.py do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.serving_profiles import FAKE_ENV
+
+# The config reads its settings on import; the Azure and OpenAI clients are replaced by the benchmark stubs
+for key, value in FAKE_ENV.items():
+    os.environ.setdefault(key, value)
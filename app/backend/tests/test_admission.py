@@ -0,0 +1,37 @@
+import asyncio
+import pytest
+from utils.admission import AdmissionController, Overloaded
+
+
+def test_queued_request_is_refused_once_draining():
+    async def scenario():
+        admission = AdmissionController(max_active=1, max_queued=1, queue_timeout=5)
+        await admission.acquire()
+        queued = asyncio.ensure_future(admission.acquire())
+        await asyncio.sleep(0)
+        # The worker is told to stop while the request waits for the slot
+        admission.draining = True
+        admission.release()
+        with pytest.raises(Overloaded):
+            await queued
+        assert admission.stats()["active"] == 0
+        assert admission._semaphore._value == 1
+
+    asyncio.run(scenario())
+
+
+def test_draining_starts_with_the_last_request_before_a_recycle():
+    admission = AdmissionController(max_active=0, max_queued=0, queue_timeout=1)
+    admission.max_requests = 3
+    for _ in range(2):
+        admission.count_request()
+    assert not admission.draining
+    admission.count_request()
+    assert admission.draining
+
+
+def test_no_recycle_limit_never_drains():
+    admission = AdmissionController(max_active=0, max_queued=0, queue_timeout=1)
+    for _ in range(1000):
+        admission.count_request()
+    assert not admission.draining
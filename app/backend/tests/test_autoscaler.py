@@ -0,0 +1,181 @@
+import json
+from datetime import datetime, timedelta, timezone
+from benchmarks.stubs import FakeBlobContainer, FakeContainerGroups, FakeQueue, Latency
+from utils.autoscaler import (
+    BUSY,
+    IDLE,
+    Autoscaler,
+    Heartbeats,
+    QueueDepth,
+    ScalingPolicy,
+)
+
+NAMES = ["tasks", "tasks-1", "tasks-2", "tasks-3"]
+
+
+def policy(**kwargs) -> ScalingPolicy:
+    settings = dict(
+        min_workers=1,
+        max_workers=4,
+        jobs_per_worker=4,
+        max_age=300,
+        up_cooldown=60,
+        down_delay=600,
+    )
+    settings.update(kwargs)
+    return ScalingPolicy(**settings)
+
+
+def test_wanted_covers_backlog_within_bounds():
+    scaling = policy()
+    assert scaling.wanted(QueueDepth(0), current=1, busy=0) == 1
+    assert scaling.wanted(QueueDepth(9), current=1, busy=0) == 3
+    assert scaling.wanted(QueueDepth(100), current=1, busy=0) == 4
+    # Running jobs count too, and busy workers are never given up
+    assert scaling.wanted(QueueDepth(3), current=2, busy=2) == 2
+    assert policy(max_workers=1).wanted(QueueDepth(0), current=3, busy=3) == 3
+
+
+def test_old_messages_add_one_worker():
+    scaling = policy()
+    assert scaling.wanted(QueueDepth(1, oldest_age=301), current=2, busy=2) == 3
+    assert scaling.wanted(QueueDepth(1, oldest_age=299), current=2, busy=2) == 2
+    assert scaling.wanted(QueueDepth(1, oldest_age=301), current=4, busy=4) == 4
+
+
+def test_scale_up_waits_for_the_cooldown():
+    scaling = policy()
+    assert scaling.desired(QueueDepth(8), current=1, busy=0, now=0) == 2
+    assert scaling.desired(QueueDepth(16), current=2, busy=0, now=30) == 2
+    assert scaling.desired(QueueDepth(16), current=2, busy=0, now=61) == 4
+
+
+def test_scale_down_waits_for_the_delay_and_resets_on_demand():
+    scaling = policy()
+    assert scaling.desired(QueueDepth(0), current=3, busy=0, now=0) == 3
+    assert scaling.desired(QueueDepth(0), current=3, busy=0, now=500) == 3
+    # A spike in between restarts the delay
+    assert scaling.desired(QueueDepth(12), current=3, busy=0, now=550) == 3
+    assert scaling.desired(QueueDepth(0), current=3, busy=0, now=700) == 3
+    assert scaling.desired(QueueDepth(0), current=3, busy=0, now=1299) == 3
+    assert scaling.desired(QueueDepth(0), current=3, busy=0, now=1301) == 1
+
+
+class Pool:
+    """A simulated queue, heartbeats and container groups on one clock"""
+
+    def __init__(self, start_delay: float = 0, **kwargs):
+        latency = Latency()
+        self.queue = FakeQueue(latency)
+        self.blob_container = FakeBlobContainer(latency)
+        self.containers = FakeContainerGroups(NAMES, start_delay)
+        self.started = datetime.now(timezone.utc)
+        self.scaler = Autoscaler(
+            {"bulk-small": self.queue},
+            self.blob_container,
+            self.containers,
+            policy(**kwargs),
+            heartbeat_timeout=90,
+        )
+
+    def now(self) -> datetime:
+        return self.started + timedelta(seconds=self.containers.clock)
+
+    def enqueue(self, count: int):
+        for i in range(count):
+            self.queue.send_message(json.dumps({"filename": f"job-{i}.pdf"}))
+
+    def beat(self, name: str, state: str, held: int = 0):
+        Heartbeats.write(self.blob_container, name, state, now=self.now(), held=held)
+
+    def receive(self, name: str, count: int):
+        """`name` takes `count` messages and keeps them invisible while it works"""
+        received = list(
+            self.queue.receive_messages(max_messages=count, visibility_timeout=172800)
+        )
+        self.beat(name, BUSY, held=len(received))
+
+    def tick(self, clock: float):
+        self.containers.clock = clock
+        return self.scaler.tick(self.now(), clock)
+
+
+def test_tick_starts_workers_for_the_backlog():
+    pool = Pool()
+    pool.containers.start("tasks")
+    pool.enqueue(10)
+    result = pool.tick(0)
+    assert result["messages"] == 10
+    assert result["desired"] == 3
+    assert result["started"] == ["tasks-1", "tasks-2"]
+    assert list(pool.containers.states().values()).count("Running") == 3
+
+
+def test_tick_counts_starting_workers_as_active():
+    pool = Pool(start_delay=120)
+    pool.enqueue(8)
+    assert pool.tick(0)["started"] == ["tasks", "tasks-1"]
+    # Still starting after the cooldown: not started a second time
+    result = pool.tick(90)
+    assert result["active"] == 2
+    assert result["started"] == []
+
+
+def test_tick_stops_idle_workers_only():
+    pool = Pool(down_delay=0)
+    for name in NAMES:
+        pool.containers.start(name)
+    pool.beat("tasks", IDLE)
+    pool.beat("tasks-1", BUSY)
+    pool.beat("tasks-2", IDLE)
+    pool.beat("tasks-3", BUSY)
+    result = pool.tick(0)
+    assert result["busy"] == 2
+    assert result["desired"] == 2
+    assert sorted(result["stopped"]) == ["tasks", "tasks-2"]
+    states = pool.containers.states()
+    assert states["tasks-1"] == states["tasks-3"] == "Running"
+
+
+def test_silent_workers_are_not_counted_busy():
+    pool = Pool(down_delay=0)
+    for name in NAMES[:2]:
+        pool.containers.start(name)
+    pool.beat("tasks-1", BUSY)
+    # The heartbeat is older than the timeout: the worker can be stopped
+    result = pool.tick(200)
+    assert result["busy"] == 0
+    assert result["stopped"] == ["tasks-1"]
+
+
+def test_messages_held_by_busy_workers_are_not_backlog():
+    pool = Pool()
+    pool.containers.start("tasks")
+    # A backfill worker holds 500 invisible messages for its whole batch
+    pool.enqueue(500)
+    pool.receive("tasks", 500)
+    result = pool.tick(0)
+    assert result["messages"] == 0
+    assert result["desired"] == 1
+    assert result["started"] == []
+    # Only what is still visible sizes the pool
+    pool.enqueue(8)
+    result = pool.tick(60)
+    assert result["messages"] == 8
+    assert result["desired"] == 3
+
+
+def test_tick_does_not_stop_a_worker_that_just_took_a_job(monkeypatch):
+    pool = Pool(down_delay=0)
+    for name in NAMES[:2]:
+        pool.containers.start(name)
+    pool.beat("tasks", IDLE)
+    pool.beat("tasks-1", IDLE)
+    stale = Heartbeats.read(pool.blob_container, 90, pool.now())
+    # tasks-1 takes a job after the heartbeats were read
+    monkeypatch.setattr(Heartbeats, "read", lambda *args: stale)
+    pool.enqueue(1)
+    pool.receive("tasks-1", 1)
+    result = pool.tick(0)
+    assert result["stopped"] == ["tasks"]
+    assert pool.containers.states()["tasks-1"] == "Running"
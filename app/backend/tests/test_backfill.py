@@ -0,0 +1,71 @@
+import asyncio
+import tempfile
+import pytest
+from benchmarks.stubs import Stubs, make_pdf
+from llm.backfill import Backfill, BackfillDocument
+from utils.ingestion_metrics import IngestionMetrics
+from utils.openai_batch import LocalBatchClient
+from config import gpt
+
+
+@pytest.fixture
+def stubs():
+    return Stubs(pages=3).install()
+
+
+@pytest.fixture
+def backfill(stubs):
+    backfill = Backfill(LocalBatchClient(gpt.client), poll_interval=0)
+    backfill.scan_upload.temp_dir = tempfile.mkdtemp(prefix="test-backfill-")
+    return backfill
+
+
+def documents(stubs, count: int):
+    pdf = make_pdf(3, scanned_every=2)
+    batch = []
+    for i in range(count):
+        filename = f"test-backfill-{i}.pdf"
+        stubs.blob_container.upload_blob(f"sourcefiles/{filename}", pdf)
+        batch.append(BackfillDocument(filename, i % 2 == 1, IngestionMetrics(filename)))
+    return batch
+
+
+def test_layout_and_scan_documents_are_indexed(stubs, backfill):
+    batch = asyncio.run(backfill.run(documents(stubs, 4)))
+    assert [d.error for d in batch] == [None] * 4
+    assert all(d.metrics.sections == len(d.sections) > 0 for d in batch)
+    assert stubs.search_client.uploaded == sum(len(d.sections) for d in batch)
+
+
+def test_embeddings_batches_respect_the_input_cap(stubs, backfill, monkeypatch):
+    monkeypatch.setattr(gpt, "BATCH_EMBEDDING_INPUTS", 2)
+    monkeypatch.setattr(gpt, "BATCH_MAX_EMBEDDING_INPUTS", 3)
+    batch = asyncio.run(backfill.run(documents(stubs, 2)))
+    assert [d.error for d in batch] == [None, None]
+    embedding_batches = [
+        b
+        for b in backfill.batch_client.batches.values()
+        if b["results"][0]["custom_id"].startswith("embedding-")
+    ]
+    inputs = [
+        sum(len(r["response"]["body"]["data"]) for r in b["results"])
+        for b in embedding_batches
+    ]
+    assert max(inputs) <= 3
+    assert sum(inputs) == sum(len(d.sections) for d in batch)
+    assert len(embedding_batches) > 1
+
+
+def test_index_error_fails_only_its_document(stubs, backfill, monkeypatch):
+    upload_documents = stubs.search_client.upload_documents
+
+    async def failing_upload(documents):
+        if documents[0]["sourcefile"] == "test-backfill-0.pdf":
+            raise RuntimeError("index unavailable")
+        return await upload_documents(documents)
+
+    monkeypatch.setattr(stubs.search_client, "upload_documents", failing_upload)
+    batch = asyncio.run(backfill.run(documents(stubs, 3)))
+    assert batch[0].error == "index: index unavailable"
+    assert [d.error for d in batch[1:]] == [None, None]
+    assert Backfill.result(batch[0])["error"] == "index: index unavailable"
@@ -0,0 +1,89 @@
+import re
+import random
+from typing import List, Tuple
+import pytest
+from utils.followup_parser import FollowupParser
+
+ALPHABET = "ab ?<>\n"
+TEMPLATES = [
+    "The policy is in [policy.pdf].\n<<What is the leave policy?>>\n<<Who approves it?>>",
+    "Sales grew 5% <the table> [sales.pdf]<<What about 2022?>><<By region?>><<Why?>>",
+    "No follow-ups, just a < sign and a > sign.",
+    "Answer<<unterminated question",
+    "Answer<<  >><<real one>>",
+    "Answer<<<nested <<open>>>trailing<< last >>",
+]
+
+
+def reference(text: str) -> Tuple[str, List[str]]:
+    """What the streamed parser has to produce for the whole completion at once"""
+    start = text.find("<<")
+    if start == -1:
+        return text, []
+    questions = re.findall(r"<<(.*?)>>", text[start:], re.S)
+    return text[:start], [question for question in questions if question.strip()]
+
+
+def random_text(rng: random.Random) -> str:
+    if rng.random() < 0.3:
+        return rng.choice(TEMPLATES)
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 60)))
+
+
+def random_chunks(rng: random.Random, text: str) -> List[str]:
+    """`text` cut at random points, with empty and one-character chunks"""
+    cuts = sorted(rng.randint(0, len(text)) for _ in range(rng.randint(0, len(text))))
+    bounds = [0] + cuts + [len(text)]
+    return [text[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def parse(chunks: List[str]) -> Tuple[str, List[str], FollowupParser]:
+    parser = FollowupParser()
+    answer, questions = "", []
+    for chunk in chunks:
+        text, completed = parser.feed(chunk)
+        answer += text
+        questions += completed
+    answer += parser.close()
+    return answer, questions, parser
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_chunk_splits_match_reference(seed):
+    rng = random.Random(seed)
+    for _ in range(500):
+        text = random_text(rng)
+        answer, questions, parser = parse(random_chunks(rng, text))
+        assert (answer, questions) == reference(text), text
+        assert parser.questions == questions
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_questions_are_emitted_with_their_closing_delimiter(seed):
+    rng = random.Random(seed)
+    for _ in range(500):
+        text = random_text(rng)
+        chunks = random_chunks(rng, text)
+        parser = FollowupParser()
+        fed = ""
+        for chunk in chunks:
+            parser.feed(chunk)
+            fed += chunk
+            # Every question closed within the text fed so far is out, none later
+            assert parser.questions == reference(fed)[1], (fed, text)
+
+
+def test_delimiters_split_across_chunks():
+    parser = FollowupParser()
+    assert parser.feed("Answer <") == ("Answer ", [])
+    assert parser.feed("<First?>") == ("", [])
+    assert parser.feed("><") == ("", ["First?"])
+    assert parser.feed("<Second?>>") == ("", ["Second?"])
+    assert parser.close() == ""
+    assert parser.questions == ["First?", "Second?"]
+
+
+def test_held_back_character_is_returned_on_close():
+    parser = FollowupParser()
+    assert parser.feed("a < b <") == ("a < b ", [])
+    assert parser.close() == "<"
@@ -0,0 +1,43 @@
+import pytest
+from benchmarks.stubs import Stubs, make_pdf
+from llm.singlefileupload import SingleFileUpload
+from config import az
+
+PAGES = 45
+
+
+@pytest.fixture
+def stubs():
+    return Stubs(pages=PAGES).install()
+
+
+def page_map(monkeypatch, pages_per_call: int, data: bytes):
+    monkeypatch.setattr(az, "FORM_RECOGNIZER_PAGES_PER_CALL", pages_per_call)
+    return SingleFileUpload().get_document_text("report.pdf", data)
+
+
+@pytest.mark.parametrize("pages_per_call", [1, 7, 20, 44])
+def test_page_ranges_merge_into_the_single_call_page_map(
+    stubs, monkeypatch, pages_per_call
+):
+    data = make_pdf(PAGES)
+    single = page_map(monkeypatch, 0, data)
+    assert len(single) == PAGES
+    assert any("<table>" in page["page_text"] for page in single)
+    assert page_map(monkeypatch, pages_per_call, data) == single
+
+
+def test_each_range_uploads_only_its_pages(stubs, monkeypatch):
+    data = make_pdf(PAGES)
+    sent = []
+    analyze = stubs.form_recognizer.begin_analyze_document
+
+    def record(model_id, document=None, **kwargs):
+        sent.append((len(document), kwargs))
+        return analyze(model_id, document=document, **kwargs)
+
+    monkeypatch.setattr(stubs.form_recognizer, "begin_analyze_document", record)
+    page_map(monkeypatch, 20, data)
+    assert len(sent) == 3
+    assert all(not kwargs for _, kwargs in sent)
+    assert sum(size for size, _ in sent) < 2 * len(data)
@@ -0,0 +1,47 @@
+import json
+import time
+from benchmarks.stubs import FakeQueue, Latency
+from utils.job_scheduler import JobScheduler, job_body
+
+
+def queue_with_jobs(count: int) -> FakeQueue:
+    queue = FakeQueue(Latency())
+    for i in range(count):
+        body = job_body(f"job-{i}.pdf", str(i), False, "", 1, "default", "tenant")
+        queue.send_message(json.dumps(body))
+    return queue
+
+
+def test_running_job_stays_invisible_past_the_visibility_timeout():
+    queue = queue_with_jobs(1)
+    scheduler = JobScheduler({"default": queue}, {}, visibility_timeout=0.3)
+    job = scheduler.next()
+    time.sleep(1)
+    assert job.lease.held
+    # Another worker finds nothing to run
+    assert JobScheduler({"default": queue}, {}).next() is None
+    JobScheduler.done(job)
+    assert queue.messages == []
+
+
+def test_failed_job_message_reappears():
+    queue = queue_with_jobs(1)
+    scheduler = JobScheduler({"default": queue}, {}, visibility_timeout=0.3)
+    job = scheduler.next()
+    JobScheduler.done(job, succeeded=False)
+    time.sleep(0.4)
+    again = scheduler.next()
+    assert again.body["filename"] == "job-0.pdf"
+    JobScheduler.done(again)
+
+
+def test_done_with_a_stale_pop_receipt_leaves_the_message_to_its_new_holder():
+    queue = queue_with_jobs(1)
+    scheduler = JobScheduler({"default": queue}, {})
+    # The backfill batches take no lease, and their timeout can run out
+    [stale] = scheduler.batch(1, visibility_timeout=0)
+    [current] = scheduler.batch(1, visibility_timeout=60)
+    JobScheduler.done(stale)
+    assert len(queue.messages) == 1
+    JobScheduler.done(current)
+    assert queue.messages == []
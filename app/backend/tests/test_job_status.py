@@ -0,0 +1,34 @@
+import time
+from datetime import datetime, timedelta, timezone
+from benchmarks.stubs import FakeBlobContainer, Latency
+from utils.job_status import JobStatusStore, new_job_id, queued_status
+
+
+def test_expire_deletes_only_old_statuses():
+    blob_container = FakeBlobContainer(Latency())
+    old, recent = new_job_id(), new_job_id()
+    for job_id in (old, recent):
+        JobStatusStore.put(blob_container, queued_status(job_id, "a.pdf", "lane", 1))
+    blob_container.upload_blob("sourcefiles/a.pdf", b"")
+    two_hours_ago = datetime.now(timezone.utc) - timedelta(hours=2)
+    blob_container.modified[JobStatusStore.blob_name(old)] = two_hours_ago
+    blob_container.modified["sourcefiles/a.pdf"] = two_hours_ago
+    assert JobStatusStore.expire(blob_container, 3600) == 1
+    assert JobStatusStore.blob_name(old) not in blob_container.blobs
+    assert JobStatusStore.blob_name(recent) in blob_container.blobs
+    assert "sourcefiles/a.pdf" in blob_container.blobs
+
+
+def test_expire_keeps_a_status_updated_since_the_listing():
+    blob_container = FakeBlobContainer(Latency())
+    job_id = new_job_id()
+    status = queued_status(job_id, "a.pdf", "lane", 1)
+    JobStatusStore.put(blob_container, status)
+    listed = blob_container.list_blobs
+    # The worker picks the job up between the listing and the delete
+    blob_container.list_blobs = lambda **kwargs: [
+        listed(**kwargs)[0],
+        JobStatusStore.put(blob_container, status),
+    ][:1]
+    assert JobStatusStore.expire(blob_container, 0, now=time.time() + 60) == 0
+    assert JobStatusStore.get(blob_container, job_id)[0]["id"] == job_id
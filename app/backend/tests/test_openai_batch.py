@@ -0,0 +1,50 @@
+import json
+from utils.openai_batch import batch_files, batch_request
+
+
+def embedding_request(i: int, inputs: int):
+    return batch_request(
+        f"embedding-{i}", "/v1/embeddings", {"model": "m", "input": ["x"] * inputs}
+    )
+
+
+def lines(content: bytes):
+    return [json.loads(line) for line in content.splitlines()]
+
+
+def test_files_are_split_by_request_count():
+    requests = [embedding_request(i, 1) for i in range(5)]
+    files = [lines(f) for f in batch_files(requests, max_requests=2, max_bytes=2**20)]
+    assert [len(f) for f in files] == [2, 2, 1]
+    assert [r["custom_id"] for f in files for r in f] == [
+        r["custom_id"] for r in requests
+    ]
+
+
+def test_files_are_split_by_size():
+    requests = [embedding_request(i, 1) for i in range(4)]
+    line = len(json.dumps(requests[0])) + 1
+    files = list(batch_files(requests, max_requests=100, max_bytes=2 * line + 1))
+    assert [len(lines(f)) for f in files] == [2, 2]
+    assert all(len(f) <= 2 * line + 1 for f in files)
+
+
+def test_embeddings_files_are_split_by_total_inputs():
+    requests = [embedding_request(i, 100) for i in range(7)]
+    files = [
+        lines(f)
+        for f in batch_files(
+            requests, max_requests=100, max_bytes=2**20, max_inputs=250
+        )
+    ]
+    assert [len(f) for f in files] == [2, 2, 2, 1]
+    assert all(sum(len(r["body"]["input"]) for r in f) <= 250 for f in files)
+
+
+def test_requests_without_input_list_count_once():
+    requests = [
+        batch_request(f"vision-{i}", "/v1/chat/completions", {"messages": []})
+        for i in range(3)
+    ]
+    files = list(batch_files(requests, 100, 2**20, max_inputs=2))
+    assert [len(lines(f)) for f in files] == [2, 1]
@@ -0,0 +1,97 @@
+import asyncio
+import random
+import pytest
+from azure.search.documents import IndexDocumentsBatch
+from utils import build_filters
+from utils.search_backend import LocalSearchClient, parse_filter
+
+DIMS = 8
+
+
+def section(key: str, sourcefile: str, rng: random.Random):
+    return {
+        "id": key,
+        "content": f"section {key} of {sourcefile}",
+        "sourcefile": sourcefile,
+        "category": "Finance",
+        "embedding": [rng.random() for _ in range(DIMS)],
+    }
+
+
+def ids(client: LocalSearchClient, filter=None):
+    async def search():
+        results = await client.search("*", filter=filter, select="id", top=1000)
+        return sorted([hit["id"] async for hit in results])
+
+    return asyncio.run(search())
+
+
+def test_a_client_sees_the_uploads_of_another(tmp_path):
+    rng = random.Random(0)
+    web, worker = LocalSearchClient(str(tmp_path)), LocalSearchClient(str(tmp_path))
+    asyncio.run(worker.upload_documents([section("a-0", "a.pdf", rng)]))
+    # Not flushed yet: only the writer sees it
+    assert ids(web) == []
+    asyncio.run(worker.flush())
+    assert ids(web) == ["a-0"]
+    asyncio.run(worker.upload_documents([section("a-1", "a.pdf", rng)]))
+    asyncio.run(worker.flush())
+    assert ids(web) == ["a-0", "a-1"]
+    assert len(web.embeddings) == 2
+
+
+def test_writes_merge_with_the_documents_of_other_clients(tmp_path):
+    rng = random.Random(1)
+    web, worker = LocalSearchClient(str(tmp_path)), LocalSearchClient(str(tmp_path))
+    asyncio.run(worker.upload_documents([section("a-0", "a.pdf", rng)]))
+    asyncio.run(worker.flush())
+    # The web client loaded the index before the worker uploaded b.pdf
+    assert ids(web) == ["a-0"]
+    asyncio.run(worker.upload_documents([section("b-0", "b.pdf", rng)]))
+    asyncio.run(worker.flush())
+    batch = IndexDocumentsBatch()
+    batch.add_delete_actions([{"id": "a-0"}])
+    asyncio.run(web.index_documents(batch))
+    assert ids(worker) == ["b-0"]
+    assert ids(LocalSearchClient(str(tmp_path))) == ["b-0"]
+
+
+def test_pending_uploads_survive_a_write_of_another_client(tmp_path):
+    rng = random.Random(2)
+    first, second = LocalSearchClient(str(tmp_path)), LocalSearchClient(str(tmp_path))
+    asyncio.run(first.upload_documents([section("a-0", "a.pdf", rng)]))
+    asyncio.run(second.upload_documents([section("b-0", "b.pdf", rng)]))
+    asyncio.run(second.flush())
+    # Searching reloads the files and keeps the upload not flushed yet
+    assert ids(first) == ["a-0", "b-0"]
+    asyncio.run(first.flush())
+    reloaded = LocalSearchClient(str(tmp_path))
+    assert ids(reloaded) == ["a-0", "b-0"]
+    vector = reloaded.embeddings[reloaded._rows["b-0"]]
+    assert abs(float((vector**2).sum()) - 1) < 1e-5
+
+
+def random_name(rng: random.Random) -> str:
+    # Commas separate the values of search.in, so file names can't have them
+    alphabet = "ab '-_.and eqne()"
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 12)))
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_parse_filter_round_trips_build_filters(seed):
+    rng = random.Random(seed)
+    for _ in range(200):
+        names = [random_name(rng) for _ in range(6)]
+        overrides = {
+            "exclude_categories": rng.sample(names, rng.randint(0, 3)),
+            "sourcefiles": rng.sample(names, rng.randint(0, 3)),
+        }
+        predicate = parse_filter(build_filters(overrides))
+        for category in names:
+            for sourcefile in names:
+                doc = {"category": category, "sourcefile": sourcefile}
+                expected = category not in overrides["exclude_categories"] and (
+                    not overrides["sourcefiles"]
+                    or sourcefile in overrides["sourcefiles"]
+                )
+                assert predicate(doc) == expected, (overrides, doc)
@@ -2,6 +2,7 @@ from typing import Any, List, Optional, Dict
 import base64
 import subprocess
 from utils.message_builder import MessageBuilder
+from utils.followup_parser import FollowupParser
 
 
 def filename_to_id(filename: str) -> str:
@@ -36,7 +37,7 @@ def build_filters(overrides: Dict[str, Any]) -> Optional[str]:
             )
 
     if len(sourcefiles := overrides.get("sourcefiles", [])) > 0:
-        formatted_sourcefiles = ",".join(sourcefiles)
+        formatted_sourcefiles = ",".join(s.replace("'", "''") for s in sourcefiles)
         filters.append(f"search.in(sourcefile, '{formatted_sourcefiles}', ',')")
     return None if len(filters) == 0 else " and ".join(filters)
 
@@ -0,0 +1,138 @@
+import asyncio
+from typing import Any, AsyncIterator, Callable, Dict
+
+
+class Overloaded(Exception):
+    """Raised when a request cannot be admitted. Surfaced to clients as 503 with Retry-After"""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Per-worker admission control for long-lived chat streams.
+    At most `max_active` requests run at once, up to `max_queued` more wait up to `queue_timeout`
+    seconds for a slot, and anything beyond that is rejected immediately, so an overloaded worker
+    pushes back instead of stretching every stream's latency. `max_active=0` disables the limit.
+    """
+
+    def __init__(self, max_active: int, max_queued: int, queue_timeout: float):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queued = 0
+        self.rejected = 0
+        self.draining = False
+        # Requests after which the server recycles the worker (0 for never), and the requests seen so far
+        self.max_requests = 0
+        self.requests = 0
+        self._semaphore = asyncio.Semaphore(max_active) if max_active > 0 else None
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def acquire(self):
+        if self.draining:
+            self.rejected += 1
+            raise Overloaded("Server is shutting down", retry_after=5)
+        if self._semaphore is not None:
+            if self._semaphore.locked() and self.queued >= self.max_queued:
+                self.rejected += 1
+                raise Overloaded(
+                    f"Server is busy ({self.active} active, {self.queued} queued)",
+                    retry_after=max(1, int(self.queue_timeout)),
+                )
+            self.queued += 1
+            acquired = False
+            try:
+                # Not wait_for: on 3.11 it can drop a permit granted just as the timeout fires
+                async with asyncio.timeout(self.queue_timeout):
+                    await self._semaphore.acquire()
+                    acquired = True
+            except BaseException as ex:
+                if acquired:
+                    self._semaphore.release()
+                if not isinstance(ex, TimeoutError):
+                    raise
+                self.rejected += 1
+                raise Overloaded(
+                    f"Timed out after {self.queue_timeout}s waiting for a free slot",
+                    retry_after=max(1, int(self.queue_timeout)),
+                )
+            finally:
+                self.queued -= 1
+            if self.draining:
+                # Shutdown began while it was queued: better retried on another worker
+                self._semaphore.release()
+                self.rejected += 1
+                raise Overloaded("Server is shutting down", retry_after=5)
+        self.active += 1
+        self._idle.clear()
+
+    def release(self):
+        self.active -= 1
+        if self._semaphore is not None:
+            self._semaphore.release()
+        if self.active == 0:
+            self._idle.set()
+
+    def count_request(self):
+        """From the last request before the worker is recycled on, nothing more is admitted"""
+        self.requests += 1
+        if self.max_requests and self.requests >= self.max_requests:
+            self.draining = True
+
+    def admitted(self, stream: AsyncIterator[Any]) -> "AdmittedStream":
+        """Holds the slot for as long as the response is being streamed"""
+        return AdmittedStream(stream, self.release)
+
+    async def drain(self, timeout: float) -> bool:
+        """Stops admitting new requests and waits for in-flight ones. Returns True if all finished"""
+        self.draining = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "max_active": self.max_active,
+            "max_queued": self.max_queued,
+            "draining": self.draining,
+        }
+
+
+class AdmittedStream:
+    """
+    Wraps a response stream and releases its admission slot exactly once: when the stream ends,
+    fails, or is garbage collected without being consumed (e.g. the client disconnected early).
+    """
+
+    def __init__(self, stream: AsyncIterator[Any], release: Callable[[], None]):
+        self._stream = stream.__aiter__()
+        self._release = release
+        self._released = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._stream.__anext__()
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._release()
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,185 @@
+"""
+Semantic cache of /chat answers.
+Answers are stored with the embedding of the question, a key for everything else that shapes the answer
+(filters, retrieval profile), and the sourcefiles they were grounded on. A new question is served from the cache when
+its embedding is close enough (cosine similarity) to a cached one with the same key.
+Entries are dropped when one of their sourcefiles is re-uploaded, re-ingested or deleted. Those events are published
+as blobs under answer-cache/invalidated/ so that every worker picks them up on its next sync, and deleted once they
+are older than the TTL, when every entry they could drop has expired.
+"""
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError
+
+INVALIDATIONS_PREFIX = "answer-cache/invalidated/"
+
+
+class CachedAnswer:
+    """
+    Attributes:
+        question (str): The question that produced the answer.
+        answer (str): The answer text, without follow-up questions.
+        followup_questions (list): Follow-up questions suggested with the answer.
+        sourcepages (list): Retrieved sourcepages the answer was grounded on.
+        sourcefiles (list): Their sourcefiles, used for invalidation.
+        context (dict): The `context` sent with the original answer (data points, thoughts, retrieval).
+    """
+
+    def __init__(
+        self,
+        question: str,
+        answer: str,
+        followup_questions: List[str],
+        sourcepages: List[str],
+        sourcefiles: List[str],
+        context: Dict[str, Any],
+    ):
+        self.question = question
+        self.answer = answer
+        self.followup_questions = followup_questions
+        self.sourcepages = sourcepages
+        self.sourcefiles = sourcefiles
+        self.context = context
+        self.created = time.time()
+
+
+class AnswerCache:
+    """
+    A fixed capacity ring of normalized question embeddings in one float32 matrix, searched with a single
+    matrix-vector product. The oldest entry is overwritten when the cache is full.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.95,
+        capacity: int = 1000,
+        ttl: float = 86400,
+        sync_interval: float = 30,
+    ):
+        self.threshold = threshold
+        self.capacity = capacity
+        self.ttl = ttl
+        self.sync_interval = sync_interval
+        self.matrix: Optional[np.ndarray] = None
+        self.valid = np.zeros(capacity, dtype=bool)
+        self.created = np.zeros(capacity, dtype=np.float64)
+        self.key_ids = np.full(capacity, -1, dtype=np.int32)
+        self.entries: List[Optional[CachedAnswer]] = [None] * capacity
+        self.keys: Dict[str, int] = {}
+        self.by_sourcefile: Dict[str, set] = {}
+        self.next = 0
+        self.synced = 0.0
+        self.invalidated: Dict[str, float] = {}
+
+    @staticmethod
+    def normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(
+        self, embedding, key: str, now: Optional[float] = None
+    ) -> Optional[Tuple[CachedAnswer, float]]:
+        """The closest live entry with the same key and its similarity, if it passes the threshold"""
+        if self.matrix is None or key not in self.keys:
+            return None
+        now = now or time.time()
+        mask = (
+            self.valid
+            & (self.key_ids == self.keys[key])
+            & (now - self.created < self.ttl)
+        )
+        if not mask.any():
+            return None
+        similarities = self.matrix @ self.normalize(embedding)
+        similarities[~mask] = -np.inf
+        index = int(np.argmax(similarities))
+        if similarities[index] < self.threshold:
+            return None
+        return self.entries[index], float(similarities[index])
+
+    def store(self, embedding, key: str, entry: CachedAnswer):
+        vector = self.normalize(embedding)
+        if self.matrix is None:
+            self.matrix = np.zeros((self.capacity, len(vector)), dtype=np.float32)
+        index = self.next
+        self.next = (self.next + 1) % self.capacity
+        self.evict(index)
+        self.matrix[index] = vector
+        self.valid[index] = True
+        self.created[index] = entry.created
+        self.key_ids[index] = self.keys.setdefault(key, len(self.keys))
+        self.entries[index] = entry
+        for sourcefile in entry.sourcefiles:
+            self.by_sourcefile.setdefault(sourcefile, set()).add(index)
+
+    def evict(self, index: int):
+        if (entry := self.entries[index]) is not None:
+            for sourcefile in entry.sourcefiles:
+                self.by_sourcefile.get(sourcefile, set()).discard(index)
+        self.entries[index] = None
+        self.valid[index] = False
+
+    def invalidate(self, sourcefile: str, before: Optional[float] = None) -> int:
+        """Drops the entries grounded on `sourcefile` that were created before `before` (default: now)"""
+        before = before or time.time()
+        dropped = 0
+        for index in list(self.by_sourcefile.get(sourcefile, ())):
+            if self.created[index] <= before:
+                self.evict(index)
+                dropped += 1
+        return dropped
+
+    def needs_sync(self, now: Optional[float] = None) -> bool:
+        return (now or time.time()) - self.synced >= self.sync_interval
+
+    def apply_invalidations(self, invalidations: Iterable[Tuple[str, float]]) -> int:
+        """Applies (sourcefile, timestamp) pairs read by `list_invalidations` that are newer than the last sync"""
+        self.synced = time.time()
+        dropped = 0
+        for sourcefile, timestamp in invalidations:
+            if timestamp > self.invalidated.get(sourcefile, 0.0):
+                self.invalidated[sourcefile] = timestamp
+                dropped += self.invalidate(sourcefile, before=timestamp)
+        self.invalidated = {
+            sourcefile: timestamp
+            for sourcefile, timestamp in self.invalidated.items()
+            if self.synced - timestamp <= self.ttl
+        }
+        return dropped
+
+    @staticmethod
+    def list_invalidations(
+        blob_container, max_age: Optional[float] = None, now: Optional[float] = None
+    ) -> List[Tuple[str, float]]:
+        """The published invalidations. Those older than `max_age` seconds are deleted instead"""
+        now = now or time.time()
+        invalidations = []
+        for blob in blob_container.list_blobs(name_starts_with=INVALIDATIONS_PREFIX):
+            timestamp = blob.last_modified.timestamp()
+            if max_age is not None and now - timestamp > max_age:
+                try:
+                    # Unless the sourcefile was invalidated again since the listing
+                    blob_container.delete_blob(
+                        blob.name,
+                        etag=blob.etag,
+                        match_condition=MatchConditions.IfNotModified,
+                    )
+                except HttpResponseError:
+                    # Deleted by another worker, or published again
+                    pass
+                continue
+            invalidations.append((blob.name[len(INVALIDATIONS_PREFIX) :], timestamp))
+        return invalidations
+
+    @staticmethod
+    def publish_invalidation(blob_container, sourcefile: str):
+        """Tells every worker that cached answers grounded on `sourcefile` are stale"""
+        blob_container.upload_blob(
+            INVALIDATIONS_PREFIX + sourcefile,
+            datetime.now(timezone.utc).isoformat(),
+            overwrite=True,
+        )
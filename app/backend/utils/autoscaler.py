@@ -0,0 +1,329 @@
+"""
+Autoscaling of the ACI task workers from the depth of the ingestion queues.
+infra/main.bicep provisions a pool of worker container groups ("<group>", "<group>-1", ...); a stopped container
+group is not billed, so scaling is starting and stopping them. Every `interval` seconds the controller reads the
+approximate message count and the age of the oldest message of every lane, and the heartbeats the workers write to
+worker-heartbeats/ (busy or idle, and how many messages they hold), and sizes the pool with `ScalingPolicy`.
+The message count includes the invisible messages of running jobs, so the messages the busy workers hold are
+taken out of it:
+- scale up at once to cover the backlog, `jobs_per_worker` queued or running jobs per worker, and by one more worker
+  while the oldest message is older than `max_age`, at most every `up_cooldown` seconds;
+- scale down only after the backlog has needed fewer workers for `down_delay` seconds, and only idle workers.
+  A worker reports busy before it receives messages, and its heartbeat is read again right before it is stopped.
+The web tier runs the controller; a blob lease makes one process of all its workers and instances the leader.
+"""
+import re
+import json
+import math
+import time
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+
+HEARTBEAT_PREFIX = "worker-heartbeats/"
+RUNNING = "Running"
+STOPPED = "Stopped"
+# Container group states in which it is billed and works, or will shortly
+ACTIVE_STATES = (RUNNING, "Pending", "Starting", "Repairing")
+
+BUSY = "busy"
+IDLE = "idle"
+
+
+class Heartbeats:
+    """Worker liveness and in-flight work, one blob per worker"""
+
+    @staticmethod
+    def write(
+        blob_container,
+        worker_id: str,
+        state: str,
+        job: Optional[str] = None,
+        now: Optional[datetime] = None,
+        held: int = 0,
+    ):
+        """`held`: the queue messages the worker keeps invisible while it works on them"""
+        now = now or datetime.now(timezone.utc)
+        blob_container.upload_blob(
+            f"{HEARTBEAT_PREFIX}{worker_id}.json",
+            json.dumps(
+                {
+                    "worker_id": worker_id,
+                    "state": state,
+                    "job": job,
+                    "held": held,
+                    "updated_at": now.isoformat(),
+                }
+            ),
+            overwrite=True,
+        )
+
+    @staticmethod
+    def get(
+        blob_container, worker_id: str, max_age: float, now: Optional[datetime] = None
+    ) -> Optional[Dict[str, Any]]:
+        """The heartbeat of one worker, if it was seen in the last `max_age` seconds"""
+        return Heartbeats.load(
+            blob_container, f"{HEARTBEAT_PREFIX}{worker_id}.json", max_age, now
+        )
+
+    @staticmethod
+    def load(
+        blob_container, name: str, max_age: float, now: Optional[datetime] = None
+    ) -> Optional[Dict[str, Any]]:
+        now = now or datetime.now(timezone.utc)
+        try:
+            heartbeat = json.loads(blob_container.download_blob(name).readall())
+        except ResourceNotFoundError:
+            return None
+        updated_at = datetime.fromisoformat(heartbeat["updated_at"])
+        if (now - updated_at).total_seconds() > max_age:
+            return None
+        return heartbeat
+
+    @staticmethod
+    def read(
+        blob_container, max_age: float, now: Optional[datetime] = None
+    ) -> Dict[str, Dict[str, Any]]:
+        """The heartbeats of the workers seen in the last `max_age` seconds, by worker id"""
+        heartbeats = {}
+        for blob in blob_container.list_blobs(name_starts_with=HEARTBEAT_PREFIX):
+            heartbeat = Heartbeats.load(blob_container, blob.name, max_age, now)
+            if heartbeat is not None:
+                heartbeats[heartbeat["worker_id"]] = heartbeat
+        return heartbeats
+
+
+class HeartbeatWriter:
+    """Writes the heartbeat of this worker every `interval` seconds, and right away when its state changes"""
+
+    def __init__(self, blob_container, worker_id: str, interval: float = 30):
+        self.blob_container = blob_container
+        self.worker_id = worker_id
+        self.interval = interval
+        self.state, self.job, self.held = IDLE, None, 0
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.beat, daemon=True)
+
+    def start(self):
+        self.write()
+        self.thread.start()
+        return self
+
+    def write(self):
+        with self.lock:
+            try:
+                Heartbeats.write(
+                    self.blob_container,
+                    self.worker_id,
+                    self.state,
+                    self.job,
+                    held=self.held,
+                )
+            except HttpResponseError:
+                # The next beat tries again; a missed one only looks like a slow worker
+                pass
+
+    def beat(self):
+        while not self.stopped.wait(self.interval):
+            self.write()
+
+    def busy(self, job: str, held: int = 0):
+        self.state, self.job, self.held = BUSY, job, held
+        self.write()
+
+    def idle(self):
+        self.state, self.job, self.held = IDLE, None, 0
+        self.write()
+
+
+class QueueDepth:
+    """Approximate backlog of the lanes"""
+
+    def __init__(self, messages: int = 0, oldest_age: float = 0.0):
+        self.messages = messages
+        self.oldest_age = oldest_age
+
+    @staticmethod
+    def read(
+        queues: Dict[str, Any], now: Optional[datetime] = None, held: int = 0
+    ) -> "QueueDepth":
+        """The messages waiting: the count of the queues (which includes invisible ones) less the `held` ones"""
+        now = now or datetime.now(timezone.utc)
+        depth = QueueDepth()
+        for queue in queues.values():
+            depth.messages += queue.get_queue_properties().approximate_message_count
+            head = list(queue.peek_messages(max_messages=1))
+            if head and head[0].inserted_on:
+                age = (now - head[0].inserted_on).total_seconds()
+                depth.oldest_age = max(depth.oldest_age, age)
+        depth.messages = max(0, depth.messages - held)
+        return depth
+
+
+class ScalingPolicy:
+    """
+    Attributes:
+        min_workers (int), max_workers (int): Bounds of the running workers.
+        jobs_per_worker (int): Queued or running jobs one worker is sized for.
+        max_age (float): Seconds the oldest message may wait before one more worker is added.
+        up_cooldown (float): Seconds between two scale ups.
+        down_delay (float): Seconds fewer workers must have been enough before scaling down.
+    """
+
+    def __init__(
+        self,
+        min_workers: int = 1,
+        max_workers: int = 4,
+        jobs_per_worker: int = 4,
+        max_age: float = 300,
+        up_cooldown: float = 60,
+        down_delay: float = 600,
+    ):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.jobs_per_worker = max(1, jobs_per_worker)
+        self.max_age = max_age
+        self.up_cooldown = up_cooldown
+        self.down_delay = down_delay
+        self.scaled_up_at: Optional[float] = None
+        self.lower_since: Optional[float] = None
+
+    def wanted(self, depth: QueueDepth, current: int, busy: int) -> int:
+        """The workers the backlog needs right now, without hysteresis"""
+        wanted = math.ceil((depth.messages + busy) / self.jobs_per_worker)
+        if depth.messages and depth.oldest_age > self.max_age:
+            wanted = max(wanted, current + 1)
+        return max(self.min_workers, busy, min(self.max_workers, wanted))
+
+    def desired(self, depth: QueueDepth, current: int, busy: int, now: float) -> int:
+        wanted = self.wanted(depth, current, busy)
+        if wanted > current:
+            self.lower_since = None
+            if (
+                self.scaled_up_at is not None
+                and now - self.scaled_up_at < self.up_cooldown
+            ):
+                return current
+            self.scaled_up_at = now
+            return wanted
+        if wanted < current:
+            if self.lower_since is None:
+                self.lower_since = now
+            if now - self.lower_since < self.down_delay:
+                return current
+            return wanted
+        self.lower_since = None
+        return current
+
+
+class AciContainerGroups:
+    """The worker pool: the container groups named `group` and `group-<n>` in the resource group"""
+
+    def __init__(
+        self, credential, subscription_id: str, resource_group: str, group: str
+    ):
+        # Only the leader manages container groups, so the SDK is loaded on first use
+        from azure.mgmt.containerinstance import ContainerInstanceManagementClient
+
+        self.client = ContainerInstanceManagementClient(credential, subscription_id)
+        self.resource_group = resource_group
+        self.pattern = re.compile(rf"{re.escape(group)}(-\d+)?")
+
+    def states(self) -> Dict[str, str]:
+        """State of every worker group, in pool order"""
+        names = [
+            group.name
+            for group in self.client.container_groups.list_by_resource_group(
+                self.resource_group
+            )
+            if self.pattern.fullmatch(group.name)
+        ]
+        names.sort(key=lambda name: (len(name), name))
+        states = {}
+        for name in names:
+            group = self.client.container_groups.get(self.resource_group, name)
+            view = group.instance_view
+            states[name] = view.state if view is not None and view.state else STOPPED
+        return states
+
+    def start(self, name: str):
+        # Not waited for: the worker reports in with its first heartbeat
+        self.client.container_groups.begin_start(self.resource_group, name)
+
+    def stop(self, name: str):
+        self.client.container_groups.stop(self.resource_group, name)
+
+
+class Autoscaler:
+    """
+    Attributes:
+        queues (dict): The queue clients of the lanes.
+        blob_container: Where the workers write their heartbeats.
+        containers: The worker pool, with `states()`, `start(name)` and `stop(name)` (see AciContainerGroups).
+        policy (ScalingPolicy): How many workers to run.
+        heartbeat_timeout (float): Seconds after which a silent worker counts as gone.
+    """
+
+    def __init__(
+        self,
+        queues: Dict[str, Any],
+        blob_container,
+        containers,
+        policy: ScalingPolicy,
+        heartbeat_timeout: float = 90,
+    ):
+        self.queues = queues
+        self.blob_container = blob_container
+        self.containers = containers
+        self.policy = policy
+        self.heartbeat_timeout = heartbeat_timeout
+
+    def tick(
+        self, now: Optional[datetime] = None, clock: Optional[float] = None
+    ) -> Dict[str, Any]:
+        """Resizes the pool once. Returns what it saw and did"""
+        now = now or datetime.now(timezone.utc)
+        clock = time.monotonic() if clock is None else clock
+        heartbeats = Heartbeats.read(self.blob_container, self.heartbeat_timeout, now)
+        states = self.containers.states()
+        active = [name for name, state in states.items() if state in ACTIVE_STATES]
+        busy = [
+            name for name in active if heartbeats.get(name, {}).get("state") == BUSY
+        ]
+        held = sum(heartbeats[name].get("held") or 0 for name in busy)
+        depth = QueueDepth.read(self.queues, now, held)
+        desired = self.policy.desired(depth, len(active), len(busy), clock)
+        started, stopped = [], []
+        if desired > len(active):
+            for name, state in states.items():
+                if len(active) + len(started) >= desired:
+                    break
+                if state not in ACTIVE_STATES:
+                    self.containers.start(name)
+                    started.append(name)
+        elif desired < len(active):
+            # Idle workers go first, the last of the pool first; busy ones are never stopped
+            idle = [name for name in reversed(active) if name not in busy]
+            for name in idle:
+                if len(stopped) == len(active) - desired:
+                    break
+                # It may have taken a job since the heartbeats were read
+                heartbeat = Heartbeats.get(
+                    self.blob_container, name, self.heartbeat_timeout, now
+                )
+                if heartbeat and heartbeat["state"] == BUSY:
+                    continue
+                self.containers.stop(name)
+                stopped.append(name)
+        return {
+            "messages": depth.messages,
+            "oldest_age": round(depth.oldest_age, 1),
+            "active": len(active),
+            "busy": len(busy),
+            "desired": desired,
+            "started": started,
+            "stopped": stopped,
+        }
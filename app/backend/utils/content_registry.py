@@ -0,0 +1,92 @@
+"""
+Content-addressed registry of ingestion results, in the blob container under content-registry/.
+The upload endpoint hashes every file (sha256) and the task worker stores what it computed for the content: the page
+map, the summary and the section embeddings. When the same bytes are uploaded again, under any filename, the worker
+indexes them from the registry instead of paying for Form Recognizer, GPT-4V, summarization and embeddings again.
+Results are kept per ingestion mode ("layout" or "scan") and embedding model.
+"""
+import io
+import json
+import hashlib
+from typing import Any, Dict, List, Optional
+import numpy as np
+from azure.core.exceptions import ResourceNotFoundError
+
+REGISTRY_PREFIX = "content-registry/"
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class IngestionResult:
+    """
+    Attributes:
+        filename (str): The file the content was first ingested as.
+        page_map (list): The extracted pages.
+        summary (dict): Title, category and summary of the document.
+        embeddings (dict): float32 embedding matrices of the "pages" and "summary" sections, in section order.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        page_map: List[Dict[str, Any]],
+        summary: Dict[str, Any],
+        embeddings: Dict[str, np.ndarray],
+    ):
+        self.filename = filename
+        self.page_map = page_map
+        self.summary = summary
+        self.embeddings = embeddings
+
+
+class ContentRegistry:
+    @staticmethod
+    def blob_name(mode: str, content_hash: str) -> str:
+        return f"{REGISTRY_PREFIX}{mode}/{content_hash}"
+
+    @staticmethod
+    def get(
+        blob_container, mode: str, content_hash: str, model: str
+    ) -> Optional[IngestionResult]:
+        name = ContentRegistry.blob_name(mode, content_hash)
+        try:
+            entry = json.loads(blob_container.download_blob(name + ".json").readall())
+            if entry["embedding_model"] != model:
+                return None
+            arrays = np.load(
+                io.BytesIO(blob_container.download_blob(name + ".npz").readall())
+            )
+            embeddings = {key: arrays[key] for key in arrays.files}
+        except ResourceNotFoundError:
+            return None
+        return IngestionResult(
+            entry["filename"], entry["page_map"], entry["summary"], embeddings
+        )
+
+    @staticmethod
+    def put(
+        blob_container,
+        mode: str,
+        content_hash: str,
+        model: str,
+        result: IngestionResult,
+    ):
+        name = ContentRegistry.blob_name(mode, content_hash)
+        arrays = io.BytesIO()
+        np.savez(arrays, **result.embeddings)
+        # The embeddings go first: an entry is only found once its json exists
+        blob_container.upload_blob(name + ".npz", arrays.getvalue(), overwrite=True)
+        blob_container.upload_blob(
+            name + ".json",
+            json.dumps(
+                {
+                    "filename": result.filename,
+                    "embedding_model": model,
+                    "page_map": result.page_map,
+                    "summary": result.summary,
+                }
+            ),
+            overwrite=True,
+        )
@@ -0,0 +1,143 @@
+"""
+Packing of retrieved sources into the prompt of the answer call.
+Consecutive sections of a document overlap by SECTION_OVERLAP characters, so the top results often repeat each other.
+Sources are deduplicated, consecutive sections of the same page are merged into one source without the repeated
+text, and what is left is fitted into a token budget in rank order.
+"""
+import re
+from typing import Dict, List, Optional, Tuple
+from utils.message_builder import count_tokens
+
+SECTION_ID = re.compile(r"^(?P<file_id>.+)-page-(?P<index>\d+)$")
+# Shorter common prefixes/suffixes are treated as coincidences, not as overlaps
+MIN_OVERLAP = 20
+
+
+class Source:
+    """
+    Attributes:
+        sourcepage (str): The page blob the section was cut from, cited by the model.
+        content (str): The section text (or its captions).
+        section_id (str): The search document id, "<file_id>-page-<section index>".
+        sourcefile (str): The source document.
+    """
+
+    __slots__ = ("sourcepage", "content", "section_id", "sourcefile")
+
+    def __init__(
+        self,
+        sourcepage: str,
+        content: str,
+        section_id: Optional[str] = None,
+        sourcefile: Optional[str] = None,
+    ):
+        self.sourcepage = sourcepage
+        self.content = content
+        self.section_id = section_id
+        self.sourcefile = sourcefile
+
+    @property
+    def text(self) -> str:
+        return f"{self.sourcepage}: {self.content}"
+
+    def position(self) -> Optional[Tuple[str, int]]:
+        """(file id, section index) of the section, if its id follows the ingestion naming"""
+        if self.section_id and (match := SECTION_ID.match(self.section_id)):
+            return match["file_id"], int(match["index"])
+        return None
+
+
+def merge_text(first: str, second: str) -> str:
+    """Joins consecutive sections, dropping the longest suffix of `first` that starts `second`"""
+    for size in range(min(len(first), len(second)), MIN_OVERLAP - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:]
+    return first + " " + second
+
+
+def deduplicate(sources: List[Source]) -> Tuple[List[Source], Dict[str, int]]:
+    """
+    Drops sources contained in a better ranked one and merges consecutive sections of the same page.
+    A merged source keeps the rank of its best ranked section.
+    """
+    stats = {"duplicates": 0, "merged": 0}
+    packed: List[Source] = []
+    # (file id, section index) -> packed source covering that section
+    covered: Dict[Tuple[str, int], Source] = {}
+    for source in sources:
+        if any(
+            source.content in kept.content
+            for kept in packed
+            if kept.sourcepage == source.sourcepage
+        ):
+            stats["duplicates"] += 1
+            continue
+        position = source.position()
+        before = after = None
+        if position is not None:
+            file_id, index = position
+            before = covered.get((file_id, index - 1))
+            after = covered.get((file_id, index + 1))
+            before = (
+                before if before and before.sourcepage == source.sourcepage else None
+            )
+            after = after if after and after.sourcepage == source.sourcepage else None
+        if before is None and after is None:
+            kept = Source(
+                source.sourcepage, source.content, source.section_id, source.sourcefile
+            )
+            packed.append(kept)
+            if position is not None:
+                covered[position] = kept
+            continue
+        stats["merged"] += 1
+        if before is not None and after is not None:
+            # The section bridges two packed sources: the lower ranked one is folded into the other
+            content = merge_text(
+                merge_text(before.content, source.content), after.content
+            )
+            keep, drop = (
+                (before, after)
+                if packed.index(before) < packed.index(after)
+                else (after, before)
+            )
+            keep.content = content
+            packed.remove(drop)
+            for key, value in list(covered.items()):
+                if value is drop:
+                    covered[key] = keep
+            covered[position] = keep
+        elif before is not None:
+            before.content = merge_text(before.content, source.content)
+            covered[position] = before
+        else:
+            after.content = merge_text(source.content, after.content)
+            covered[position] = after
+    return packed, stats
+
+
+def pack_sources(
+    sources: List[Source], budget: int, model: str
+) -> Tuple[List[Source], int]:
+    """
+    The sources, in rank order, that fit in `budget` tokens and their token count.
+    A source that does not fit is skipped, so smaller lower ranked ones may still be used.
+    """
+    packed, tokens = [], 0
+    for source in sources:
+        # One more token for the newline joining the sources
+        cost = count_tokens(source.text, model) + 1
+        if tokens + cost > budget:
+            continue
+        packed.append(source)
+        tokens += cost
+    return packed, tokens
+
+
+def parse_budgets(value: str) -> Dict[str, int]:
+    """Parses "gpt-4=6000,gpt-4-1106-preview=24000" into {model: tokens}"""
+    budgets = {}
+    for item in filter(None, (i.strip() for i in value.split(","))):
+        model, tokens = item.split("=")
+        budgets[model.strip()] = int(tokens)
+    return budgets
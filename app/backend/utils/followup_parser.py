@@ -0,0 +1,81 @@
+from typing import List, Tuple
+
+OPEN = "<<"
+CLOSE = ">>"
+
+
+class FollowupParser:
+    """
+    Incremental parser separating the answer from the <<follow-up questions>> in a streamed completion.
+    Everything before the first "<<" is answer text, everything after it belongs to the follow-up questions.
+    Delimiters split across chunks are handled by holding back a trailing "<" or ">" until the next chunk,
+    so each character is scanned once and questions are available as soon as their ">>" arrives.
+    Attributes:
+        in_followups (bool): True once the first "<<" has been seen.
+        questions (list): All follow-up questions completed so far.
+    Methods:
+        feed(self, text: str): Consumes a chunk, returns the answer text and the questions completed by it.
+        close(self): Returns any answer text still held back once the stream has ended.
+    """
+
+    def __init__(self):
+        self.in_followups = False
+        self.in_question = False
+        self.questions: List[str] = []
+        self._pending = ""
+        self._question: List[str] = []
+
+    def feed(self, text: str) -> Tuple[str, List[str]]:
+        text = self._pending + text
+        self._pending = ""
+        answer = ""
+        completed = []
+        pos = 0
+        if not self.in_followups:
+            idx = text.find(OPEN)
+            if idx == -1:
+                if text.endswith(OPEN[0]):
+                    self._pending = OPEN[0]
+                    text = text[:-1]
+                return text, completed
+            answer = text[:idx]
+            self.in_followups = True
+            self.in_question = True
+            pos = idx + len(OPEN)
+
+        length = len(text)
+        while pos < length:
+            if self.in_question:
+                idx = text.find(CLOSE, pos)
+                if idx == -1:
+                    end = length
+                    if text.endswith(CLOSE[0]):
+                        self._pending = CLOSE[0]
+                        end -= 1
+                    self._question.append(text[pos:end])
+                    break
+                self._question.append(text[pos:idx])
+                question = "".join(self._question)
+                self._question = []
+                if question.strip():
+                    completed.append(question)
+                self.in_question = False
+                pos = idx + len(CLOSE)
+            else:
+                idx = text.find(OPEN, pos)
+                if idx == -1:
+                    if text.endswith(OPEN[0]):
+                        self._pending = OPEN[0]
+                    break
+                self.in_question = True
+                pos = idx + len(OPEN)
+
+        self.questions.extend(completed)
+        return answer, completed
+
+    def close(self) -> str:
+        """An unterminated question is dropped, a held back "<" in the answer is returned"""
+        pending = self._pending
+        self._pending = ""
+        self._question = []
+        return "" if self.in_followups else pending
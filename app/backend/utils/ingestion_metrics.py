@@ -0,0 +1,177 @@
+"""
+Per-document ingestion telemetry for the task worker.
+Collects time per stage, pages and sections, API calls and tokens per model, rate limit retries and
+queue lag for one document. `finish` exports them as Prometheus metrics and returns a summary record,
+which the worker stores in blob storage under ingestion-metrics/.
+"""
+import json
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional
+from prometheus_client import Counter, Histogram
+
+STAGE_SECONDS = Histogram(
+    "ingest_stage_seconds",
+    "Time spent per ingestion stage and document",
+    ["mode", "stage"],
+    buckets=(0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1200, 3600),
+)
+DOCUMENT_SECONDS = Histogram(
+    "ingest_document_seconds",
+    "Total ingestion time per document",
+    ["mode", "status"],
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1200, 3600, 7200),
+)
+QUEUE_LAG = Histogram(
+    "ingest_queue_lag_seconds",
+    "Time between enqueueing a document and the worker picking it up",
+    buckets=(1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200, 21600),
+)
+PAGES = Counter("ingest_pages", "Pages ingested", ["mode"])
+PAGE_ROUTES = Counter(
+    "ingest_page_routes", "v-scan pages by extractor (text or vision)", ["route"]
+)
+SECTIONS = Counter("ingest_sections", "Sections indexed", ["mode"])
+API_CALLS = Counter("ingest_api_calls", "OpenAI API calls", ["model", "kind"])
+TOKENS = Counter("ingest_tokens", "OpenAI tokens", ["model", "kind"])
+RATE_LIMIT_RETRIES = Counter(
+    "ingest_rate_limit_retries", "Retries caused by RateLimitError", ["model"]
+)
+
+
+class IngestionMetrics:
+    """
+    Attributes:
+        filename (str): The ingested source file.
+        mode (str): "layout" for Form Recognizer ingestion, "scan" for GPT-4V ingestion.
+        stages (dict): Seconds spent per stage, accumulated over repeated calls.
+        listener (callable): Called with the metrics when a stage starts or reports progress.
+        models (dict): API calls, prompt and completion tokens per model.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        mode: str = "layout",
+        enqueued_at: Optional[datetime] = None,
+        dequeue_count: Optional[int] = None,
+        listener: Optional[Callable[..., None]] = None,
+    ):
+        self.filename = filename
+        self.mode = mode
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.models: Dict[str, Dict[str, int]] = {}
+        self.retries: Dict[str, int] = {}
+        self.pages = 0
+        self.sections = 0
+        self.routes: Dict[str, int] = {}
+        # The file whose content registry entry was reused instead of ingesting the content again
+        self.reused_from: Optional[str] = None
+        self.dequeue_count = dequeue_count
+        self.queue_lag = (
+            (self.started_at - enqueued_at).total_seconds() if enqueued_at else None
+        )
+        # The running stage and its progress, reported to `listener` (see utils/job_status.py)
+        self.listener = listener
+        self.current_stage: Optional[str] = None
+        self.stage_started = self.started
+        self.stage_done = 0
+        self.stage_total = 0
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        self.current_stage, self.stage_started = name, started
+        self.stage_done = self.stage_total = 0
+        if self.listener is not None:
+            self.listener(self, stage_changed=True)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def progress(self, done: int, total: int):
+        """`done` of the `total` units (pages, page ranges, sections) of the running stage are finished"""
+        self.stage_done, self.stage_total = done, total
+        if self.listener is not None:
+            self.listener(self)
+
+    def api_call(self, model: str, kind: str, usage: Any = None):
+        """Counts one API call, and its tokens when the response carries `usage`"""
+        counts = self.models.setdefault(
+            model, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        )
+        counts["calls"] += 1
+        API_CALLS.labels(model, kind).inc()
+        if usage is not None:
+            prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+            completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+            counts["prompt_tokens"] += prompt_tokens
+            counts["completion_tokens"] += completion_tokens
+            TOKENS.labels(model, "prompt").inc(prompt_tokens)
+            TOKENS.labels(model, "completion").inc(completion_tokens)
+
+    def page_route(self, route: str):
+        self.routes[route] = self.routes.get(route, 0) + 1
+        PAGE_ROUTES.labels(route).inc()
+
+    def rate_limited(self, model: str):
+        self.retries[model] = self.retries.get(model, 0) + 1
+        RATE_LIMIT_RETRIES.labels(model).inc()
+
+    def finish(self, status: str = "succeeded") -> Dict[str, Any]:
+        total = time.perf_counter() - self.started
+        for name, seconds in self.stages.items():
+            STAGE_SECONDS.labels(self.mode, name).observe(seconds)
+        DOCUMENT_SECONDS.labels(self.mode, status).observe(total)
+        if self.queue_lag is not None:
+            QUEUE_LAG.observe(self.queue_lag)
+        PAGES.labels(self.mode).inc(self.pages)
+        SECTIONS.labels(self.mode).inc(self.sections)
+        return {
+            "filename": self.filename,
+            "mode": self.mode,
+            "status": status,
+            "started_at": self.started_at.isoformat(),
+            "total_seconds": round(total, 3),
+            "queue_lag_seconds": round(self.queue_lag, 3)
+            if self.queue_lag is not None
+            else None,
+            "dequeue_count": self.dequeue_count,
+            "pages": self.pages,
+            "sections": self.sections,
+            "page_routes": self.routes,
+            "reused_from": self.reused_from,
+            "stages": {k: round(v, 3) for k, v in self.stages.items()},
+            "models": self.models,
+            "rate_limit_retries": self.retries,
+        }
+
+    @staticmethod
+    def upload_summary(blob_container, summary: Dict[str, Any]) -> str:
+        """Stores the summary record as ingestion-metrics/<filename>/<started_at>.json"""
+        started_at = summary["started_at"].replace(":", "").replace("+0000", "Z")
+        blob_name = f"ingestion-metrics/{summary['filename']}/{started_at}.json"
+        blob_container.upload_blob(
+            blob_name, json.dumps(summary, indent=2), overwrite=True
+        )
+        return blob_name
+
+
+def rate_limit_callback(model: str, log_callback):
+    """
+    Builds a tenacity `before_sleep` callback that logs through `log_callback` and counts the retry
+    on `self.metrics` of the retried method's instance.
+    """
+
+    def before_sleep(retry_state):
+        log_callback(retry_state)
+        instance = retry_state.args[0] if retry_state.args else None
+        if (metrics := getattr(instance, "metrics", None)) is not None:
+            metrics.rate_limited(model)
+
+    return before_sleep
@@ -0,0 +1,359 @@
+"""
+Ingestion job scheduling over one storage queue per lane.
+The upload endpoint puts every file into a lane by priority ("interactive" uploads from the UI, "bulk" loads) and
+size ("large" from `large_pages` pages on, estimated from the PDF without parsing it), so a 2-page memo does not wait
+behind a 500-page v-scan. Workers pick the next lane by weighted fair queueing over pages: the lane whose first job
+would finish first in the virtual time of its weight goes next, so interactive lanes get most of the throughput
+while no lane starves. Within a lane, a window of messages is received and the job of the tenant
+served least recently by this worker runs first; the rest are made visible again. The message of a running job is
+kept invisible in the background, so no other worker picks it up however long the job takes. Large jobs also need
+one of `large_slots` slots, blob leases shared by all workers, so at most that many run at once.
+"""
+import re
+import json
+import threading
+from collections import Counter, deque
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from prometheus_client import Histogram
+from utils.rate_limiter import BULK, INTERACTIVE
+
+SMALL = "small"
+LARGE = "large"
+LANES = (
+    f"{INTERACTIVE}-{SMALL}",
+    f"{INTERACTIVE}-{LARGE}",
+    f"{BULK}-{SMALL}",
+    f"{BULK}-{LARGE}",
+)
+DEFAULT_TENANT = "default"
+SLOTS_PREFIX = "job-scheduler/large-slot-"
+
+QUEUE_WAIT = Histogram(
+    "ingest_lane_wait_seconds",
+    "Time between enqueueing a job and a worker picking it up, per scheduling lane",
+    ["lane"],
+    buckets=(1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200, 21600),
+)
+
+PAGE_PATTERN = re.compile(rb"/Type\s*/Page(?![a-zA-Z])")
+COUNT_PATTERN = re.compile(rb"/Type\s*/Pages\b[^>]*?/Count\s+(\d+)")
+
+
+def estimate_pages(data: bytes) -> int:
+    """
+    Page count of a PDF from its page objects, without parsing it (the web tier does not load PyMuPDF).
+    Falls back to the largest page tree count when the objects are compressed, and to 1 for other files.
+    """
+    pages = len(PAGE_PATTERN.findall(data))
+    if not pages:
+        counts = [int(count) for count in COUNT_PATTERN.findall(data)]
+        pages = max(counts, default=0)
+    return max(1, pages)
+
+
+def lane_for(priority: str, pages: int, large_pages: int) -> str:
+    size = LARGE if large_pages and pages >= large_pages else SMALL
+    return f"{BULK if priority == BULK else INTERACTIVE}-{size}"
+
+
+def job_body(
+    filename: str,
+    file_id: str,
+    v_scan: bool,
+    sha256: str,
+    pages: int,
+    lane: str,
+    tenant: str,
+    job_id: Optional[str] = None,
+) -> Dict[str, Any]:
+    """The queue message of an uploaded file"""
+    return {
+        "job_id": job_id,
+        "filename": filename,
+        "sourcefile": f"sourcefiles/{filename}",
+        "id": file_id,
+        "v-scan": v_scan,
+        "sha256": sha256,
+        "pages": pages,
+        "lane": lane,
+        "tenant": tenant,
+    }
+
+
+def job_pages(message) -> int:
+    return json.loads(message["content"]).get("pages") or 1
+
+
+class Job:
+    """
+    Attributes:
+        lane (str): The lane the job was received from.
+        queue: The queue client of the lane, which deletes the message.
+        message: The received queue message.
+        body (dict): The decoded message content.
+        slot: The large job slot held while the job runs.
+        lease (MessageLease): Keeps the message invisible while the job runs.
+    """
+
+    def __init__(self, lane: str, queue, message, slot=None):
+        self.lane = lane
+        self.queue = queue
+        self.message = message
+        self.body: Dict[str, Any] = json.loads(message["content"])
+        self.slot = slot
+        self.lease: Optional[MessageLease] = None
+
+    @property
+    def tenant(self) -> str:
+        return self.body.get("tenant") or DEFAULT_TENANT
+
+    def wait_seconds(self) -> Optional[float]:
+        if not self.message.inserted_on:
+            return None
+        return (datetime.now(timezone.utc) - self.message.inserted_on).total_seconds()
+
+
+class MessageLease:
+    """
+    Extends the visibility timeout of a received message in the background until released.
+    Every update returns a new pop receipt, which is kept on the message so it can still be deleted.
+    """
+
+    def __init__(self, queue, message, visibility_timeout: int):
+        self.queue = queue
+        self.message = message
+        self.visibility_timeout = visibility_timeout
+        self.released = threading.Event()
+        self.renewer = threading.Thread(
+            target=self.renew, args=(visibility_timeout / 3,), daemon=True
+        )
+        self.renewer.start()
+
+    def renew(self, interval: float):
+        while not self.released.wait(interval):
+            try:
+                receipt = self.queue.update_message(
+                    self.message, visibility_timeout=self.visibility_timeout
+                )
+            except HttpResponseError:
+                # Lost the message: another worker may run it too, this job still finishes
+                return
+            self.message.pop_receipt = receipt.pop_receipt
+            self.message.next_visible_on = receipt.next_visible_on
+
+    @property
+    def held(self) -> bool:
+        """False once released, or once a renewal failed"""
+        return not self.released.is_set() and self.renewer.is_alive()
+
+    def release(self):
+        """Stops renewing; waits for an update in flight so the message has its latest pop receipt"""
+        self.released.set()
+        self.renewer.join()
+
+
+class LargeJobSlot:
+    """A leased slot blob, renewed in the background until released"""
+
+    def __init__(self, name: str, lease, lease_seconds: int):
+        self.name = name
+        self.lease = lease
+        self.released = threading.Event()
+        self.renewer = threading.Thread(
+            target=self.renew, args=(lease_seconds / 3,), daemon=True
+        )
+        self.renewer.start()
+
+    def renew(self, interval: float):
+        while not self.released.wait(interval):
+            try:
+                self.lease.renew()
+            except HttpResponseError:
+                # Lost the lease: the slot may be taken by another worker, the job still finishes
+                return
+
+    @property
+    def held(self) -> bool:
+        """False once released, or once a renewal failed"""
+        return not self.released.is_set() and self.renewer.is_alive()
+
+    def release(self):
+        self.released.set()
+        try:
+            self.lease.release()
+        except HttpResponseError:
+            # An expired lease frees the slot anyway
+            pass
+
+
+class LargeJobSlots:
+    """
+    Caps the large jobs running at once across all workers with `slots` blob leases.
+    A worker that dies keeps its slot at most `lease_seconds` (15 to 60).
+    With one slot under another `prefix`, it elects a leader (see utils/autoscaler.py).
+    """
+
+    def __init__(
+        self,
+        blob_container,
+        slots: int,
+        lease_seconds: int = 60,
+        prefix: str = SLOTS_PREFIX,
+    ):
+        self.blob_container = blob_container
+        self.slots = slots
+        self.lease_seconds = lease_seconds
+        self.prefix = prefix
+
+    def acquire(self) -> Optional[LargeJobSlot]:
+        for i in range(self.slots):
+            name = f"{self.prefix}{i}"
+            blob = self.blob_container.get_blob_client(name)
+            try:
+                try:
+                    lease = blob.acquire_lease(lease_duration=self.lease_seconds)
+                except ResourceNotFoundError:
+                    self.blob_container.upload_blob(name, b"", overwrite=True)
+                    lease = blob.acquire_lease(lease_duration=self.lease_seconds)
+            except HttpResponseError:
+                # Leased by another worker
+                continue
+            return LargeJobSlot(name, lease, self.lease_seconds)
+        return None
+
+
+class JobScheduler:
+    """
+    Attributes:
+        queues (dict): Queue client per lane, in LANES order.
+        weights (dict): Share of the pages served per lane while all lanes have jobs.
+        slots (LargeJobSlots): Slots for the jobs of the large lanes (None for no cap).
+        window (int): Messages received at once to choose a tenant from.
+        visibility_timeout (int): Seconds a running job's message stays invisible, renewed every third of it.
+        history (deque): Tenants of the last jobs this worker picked.
+    """
+
+    def __init__(
+        self,
+        queues: Dict[str, Any],
+        weights: Dict[str, int],
+        slots: Optional[LargeJobSlots] = None,
+        window: int = 16,
+        visibility_timeout: int = 300,
+        history: int = 100,
+    ):
+        self.queues = queues
+        self.weights = {lane: max(1, weights.get(lane, 1)) for lane in queues}
+        self.slots = slots
+        self.window = max(1, min(32, window))
+        self.visibility_timeout = visibility_timeout
+        # Weighted fair queueing by pages: `usage` is the virtual time up to which each lane has been served,
+        # `clock` the start of the job served last
+        self.usage = {lane: 0.0 for lane in queues}
+        self.clock = 0.0
+        self.history: deque = deque(maxlen=history)
+
+    def lane_order(self) -> List[str]:
+        """
+        Non-empty lanes by the virtual finish time of their first job: lanes are served in proportion to their
+        weight in pages, and an idle lane does not save up a share for later
+        """
+        finish = {}
+        for lane, queue in self.queues.items():
+            head = list(queue.peek_messages(max_messages=1))
+            if head:
+                start = max(self.usage[lane], self.clock)
+                finish[lane] = start + job_pages(head[0]) / self.weights[lane]
+        return sorted(finish, key=finish.get)
+
+    def charge(self, lane: str, pages: int):
+        start = max(self.usage[lane], self.clock)
+        self.usage[lane] = start + pages / self.weights[lane]
+        self.clock = start
+
+    def choose(self, messages: List[Any]) -> Tuple[Any, List[Any]]:
+        """The message of the tenant served least recently (the oldest on ties), and the others"""
+        served = Counter(self.history)
+        tenants = [
+            json.loads(message["content"]).get("tenant") or DEFAULT_TENANT
+            for message in messages
+        ]
+        index = min(range(len(messages)), key=lambda i: (served[tenants[i]], i))
+        return messages[index], messages[:index] + messages[index + 1 :]
+
+    def next(self) -> Optional[Job]:
+        """The next job to run, or None when every lane is empty (or only large jobs wait for a slot)"""
+        for lane in self.lane_order():
+            slot = None
+            if lane.endswith(LARGE) and self.slots is not None:
+                slot = self.slots.acquire()
+                if slot is None:
+                    continue
+            queue = self.queues[lane]
+            messages = list(
+                queue.receive_messages(
+                    max_messages=self.window,
+                    visibility_timeout=self.visibility_timeout,
+                )
+            )
+            if not messages:
+                # Taken by another worker since the peek
+                if slot is not None:
+                    slot.release()
+                continue
+            message, others = self.choose(messages)
+            for other in others:
+                try:
+                    queue.update_message(other, visibility_timeout=0)
+                except HttpResponseError:
+                    # It reappears when its visibility timeout ends
+                    pass
+            job = Job(lane, queue, message, slot)
+            job.lease = MessageLease(queue, message, self.visibility_timeout)
+            self.charge(lane, job_pages(message))
+            self.history.append(job.tenant)
+            wait = job.wait_seconds()
+            if wait is not None:
+                QUEUE_WAIT.labels(lane).observe(wait)
+            return job
+        return None
+
+    def batch(self, max_messages: int, visibility_timeout: int) -> List[Job]:
+        """Up to `max_messages` jobs from the lanes in priority order, for the backfill mode (no slots needed)"""
+        jobs = []
+        for lane, queue in self.queues.items():
+            while len(jobs) < max_messages:
+                received = list(
+                    queue.receive_messages(
+                        max_messages=min(32, max_messages - len(jobs)),
+                        visibility_timeout=visibility_timeout,
+                    )
+                )
+                if not received:
+                    break
+                for message in received:
+                    job = Job(lane, queue, message)
+                    wait = job.wait_seconds()
+                    if wait is not None:
+                        QUEUE_WAIT.labels(lane).observe(wait)
+                    jobs.append(job)
+        return jobs
+
+    @staticmethod
+    def done(job: Job, succeeded: bool = True):
+        """Frees the slot of the job and deletes its message when it succeeded"""
+        if job.lease is not None:
+            job.lease.release()
+            job.lease = None
+        if job.slot is not None:
+            job.slot.release()
+            job.slot = None
+        if succeeded:
+            try:
+                job.queue.delete_message(job.message)
+            except HttpResponseError:
+                # The pop receipt is stale: the message became visible and was received again,
+                # and is deleted by the worker that holds it now
+                pass
@@ -0,0 +1,192 @@
+"""
+Status of ingestion jobs, shared by the web tier and the task workers through the blob container (job-status/<id>.json).
+The upload endpoint records every job as queued. The worker updates it when a stage starts and, at most every
+`min_interval` seconds, with the progress of the stage. /jobs/<id> reads it, and /jobs/<id>/events streams its changes
+as Server-Sent Events, so clients learn when a file is searchable without searching the index again and again.
+Idle workers delete the statuses that were not updated for a while (see `JobStatusStore.expire`).
+"""
+import re
+import json
+import time
+import uuid
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    HttpResponseError,
+    ResourceModifiedError,
+    ResourceNotModifiedError,
+)
+
+STATUS_PREFIX = "job-status/"
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+FINAL_STATES = (SUCCEEDED, FAILED)
+JOB_ID = re.compile(r"[0-9a-f]{32}")
+
+
+def new_job_id() -> str:
+    return uuid.uuid4().hex
+
+
+def now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def queued_status(job_id: str, filename: str, lane: str, pages: int) -> Dict[str, Any]:
+    return {
+        "id": job_id,
+        "filename": filename,
+        "lane": lane,
+        "state": QUEUED,
+        "stage": None,
+        "pages_done": 0,
+        "pages_total": pages,
+        "eta_seconds": None,
+        "error": None,
+        "enqueued_at": now(),
+        "started_at": None,
+        "updated_at": now(),
+    }
+
+
+class JobStatusStore:
+    @staticmethod
+    def blob_name(job_id: str) -> str:
+        return f"{STATUS_PREFIX}{job_id}.json"
+
+    @staticmethod
+    def put(blob_container, status: Dict[str, Any]):
+        status["updated_at"] = now()
+        blob_container.upload_blob(
+            JobStatusStore.blob_name(status["id"]), json.dumps(status), overwrite=True
+        )
+
+    @staticmethod
+    def get(
+        blob_container, job_id: str, etag: Optional[str] = None
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """
+        The status of the job and its etag. With the `etag` of an earlier read, (None, etag) when it is unchanged,
+        without downloading it again. Raises ResourceNotFoundError for unknown jobs.
+        """
+        blob = blob_container.get_blob_client(JobStatusStore.blob_name(job_id))
+        try:
+            if etag:
+                downloader = blob.download_blob(
+                    etag=etag, match_condition=MatchConditions.IfModified
+                )
+            else:
+                downloader = blob.download_blob()
+        except (ResourceNotModifiedError, ResourceModifiedError):
+            return None, etag
+        return json.loads(downloader.readall()), downloader.properties["etag"]
+
+    @staticmethod
+    def expire(blob_container, max_age: float, now: Optional[float] = None) -> int:
+        """
+        Deletes the statuses not updated for `max_age` seconds: finished jobs, or jobs whose worker died.
+        Returns how many were deleted.
+        """
+        now = now or time.time()
+        deleted = 0
+        for blob in blob_container.list_blobs(name_starts_with=STATUS_PREFIX):
+            if now - blob.last_modified.timestamp() <= max_age:
+                continue
+            try:
+                # Unless the job was picked up again since the listing
+                blob_container.delete_blob(
+                    blob.name,
+                    etag=blob.etag,
+                    match_condition=MatchConditions.IfNotModified,
+                )
+                deleted += 1
+            except HttpResponseError:
+                # Deleted by another worker, or updated again
+                pass
+        return deleted
+
+
+class JobTracker:
+    """
+    Writes the status of the job a worker runs, from the stages and progress reported to its IngestionMetrics
+    (pass the tracker as their `listener`). Progress within a stage is counted in pages of the document.
+    The ETA comes from the seconds per page of the jobs this worker finished before, per ingestion mode,
+    and from the rate of the current stage until there are some.
+    """
+
+    # Moving average of the seconds per page of finished jobs, per ingestion mode
+    seconds_per_page: Dict[str, float] = {}
+
+    def __init__(
+        self, blob_container, status: Dict[str, Any], min_interval: float = 2.0
+    ):
+        self.blob_container = blob_container
+        self.status = status
+        self.min_interval = min_interval
+        self.written = 0.0
+        self.lock = threading.Lock()
+
+    def write(self, force: bool = False):
+        with self.lock:
+            if not force and time.monotonic() - self.written < self.min_interval:
+                return
+            self.written = time.monotonic()
+            try:
+                JobStatusStore.put(self.blob_container, dict(self.status))
+            except Exception:
+                # Progress is best effort: a failed write must not fail the ingestion
+                pass
+
+    def start(self, metrics):
+        self.status.update(
+            state=RUNNING, started_at=metrics.started_at.isoformat(), mode=metrics.mode
+        )
+        self.write(force=True)
+
+    def eta(self, metrics, pages_done: int, pages_total: int) -> Optional[float]:
+        elapsed = time.perf_counter() - metrics.started
+        per_page = self.seconds_per_page.get(metrics.mode)
+        if per_page is not None and pages_total:
+            return round(max(0.0, per_page * pages_total - elapsed), 1)
+        stage_elapsed = time.perf_counter() - metrics.stage_started
+        if pages_done and pages_total:
+            return round(stage_elapsed / pages_done * (pages_total - pages_done), 1)
+        return None
+
+    def __call__(self, metrics, stage_changed: bool = False):
+        pages_total = metrics.pages or self.status.get("pages_total") or 0
+        pages_done = 0
+        if metrics.stage_total:
+            pages_done = round(pages_total * metrics.stage_done / metrics.stage_total)
+        self.status.update(
+            stage=metrics.current_stage,
+            pages_done=pages_done,
+            pages_total=pages_total,
+            eta_seconds=self.eta(metrics, pages_done, pages_total),
+        )
+        self.write(force=stage_changed)
+
+    def finish(self, metrics, state: str, error: Optional[str] = None):
+        total = time.perf_counter() - metrics.started
+        if state == SUCCEEDED and metrics.pages and not metrics.reused_from:
+            per_page = total / metrics.pages
+            previous = self.seconds_per_page.get(metrics.mode)
+            self.seconds_per_page[metrics.mode] = (
+                per_page if previous is None else 0.7 * previous + 0.3 * per_page
+            )
+        self.status.update(
+            state=state,
+            stage=None,
+            pages_done=metrics.pages
+            if state == SUCCEEDED
+            else self.status["pages_done"],
+            pages_total=metrics.pages or self.status.get("pages_total"),
+            eta_seconds=0 if state == SUCCEEDED else None,
+            error=error,
+            finished_at=now(),
+        )
+        self.write(force=True)
@@ -1,7 +1,26 @@
 import unicodedata
+from functools import lru_cache
 import tiktoken
 
 
+@lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(model)
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str, model: str) -> int:
+    """Tokens of `text`, cached as the same sources and history are counted on every turn"""
+    return len(get_encoding(model).encode(text))
+
+
+def count_message_tokens(message: dict[str, str], model: str) -> int:
+    num_tokens = 2  # For "role" and "content" keys
+    for value in message.values():
+        num_tokens += count_tokens(value, model)
+    return num_tokens
+
+
 class MessageBuilder:
     """
     A class for building and managing messages in a chat conversation.
@@ -34,11 +53,7 @@ class MessageBuilder:
             num_tokens_from_messages(message, model)
             output: 11
         """
-        encoding = tiktoken.encoding_for_model(model)
-        num_tokens = 2  # For "role" and "content" keys
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-        return num_tokens
+        return count_message_tokens(message, model)
 
     def insert_message(self, role: str, content: str, index: int = 1):
         """
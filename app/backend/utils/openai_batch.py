@@ -0,0 +1,153 @@
+"""
+OpenAI Batch API client used by the backfill ingestion mode.
+Requests are written as JSONL files ({"custom_id", "method", "url", "body"} per line), split to stay under the
+Batch API limits, uploaded and submitted as batches; results come back as JSONL keyed by `custom_id`.
+Batches run against their own quota, so they don't use the rate limits of the live chat traffic.
+`LocalBatchClient` is a stand-in with the same interface that runs the requests through `gpt.client` right away,
+for tests and the offline benchmarks.
+"""
+import io
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, Optional
+import httpx
+
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def request_inputs(request: Dict[str, Any]) -> int:
+    """Inputs of a request line: the texts of an embeddings request, 1 for anything else"""
+    inputs = request["body"].get("input")
+    return len(inputs) if isinstance(inputs, list) else 1
+
+
+def batch_files(
+    requests: Iterable[Dict[str, Any]],
+    max_requests: int,
+    max_bytes: int,
+    max_inputs: Optional[int] = None,
+) -> Iterator[bytes]:
+    """
+    Splits request lines into JSONL files of at most `max_requests` lines and `max_bytes` bytes,
+    and if given at most `max_inputs` inputs (embeddings batches also cap the total of their inputs)
+    """
+    lines, size, total = [], 0, 0
+    for request in requests:
+        line = (json.dumps(request) + "\n").encode("utf-8")
+        count = request_inputs(request)
+        if lines and (
+            len(lines) >= max_requests
+            or size + len(line) > max_bytes
+            or (max_inputs is not None and total + count > max_inputs)
+        ):
+            yield b"".join(lines)
+            lines, size, total = [], 0, 0
+        lines.append(line)
+        size += len(line)
+        total += count
+    if lines:
+        yield b"".join(lines)
+
+
+def batch_request(custom_id: str, url: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    return {"custom_id": custom_id, "method": "POST", "url": url, "body": body}
+
+
+class OpenAIBatchClient:
+    """
+    Attributes:
+        client: The synchronous OpenAI client.
+        completion_window (str): Time the Batch API has to complete a batch.
+    """
+
+    def __init__(self, client, completion_window: str = "24h"):
+        self.client = client
+        self.completion_window = completion_window
+
+    def submit(self, content: bytes, endpoint: str) -> str:
+        file = self.client.files.create(
+            file=("batch.jsonl", io.BytesIO(content)), purpose="batch"
+        )
+        response = self.client.post(
+            "/batches",
+            cast_to=httpx.Response,
+            body={
+                "input_file_id": file.id,
+                "endpoint": endpoint,
+                "completion_window": self.completion_window,
+            },
+        )
+        return response.json()["id"]
+
+    def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        return self.client.get(f"/batches/{batch_id}", cast_to=httpx.Response).json()
+
+    def results(self, batch: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """Output and error lines of a finished batch"""
+        for key in ("output_file_id", "error_file_id"):
+            if file_id := batch.get(key):
+                content = self.client.files.content(file_id).text
+                for line in content.splitlines():
+                    if line.strip():
+                        yield json.loads(line)
+
+
+class LocalBatchClient:
+    """Runs batches immediately through the regular endpoints of `client`"""
+
+    def __init__(self, client, concurrency: int = 8):
+        self.client = client
+        self.concurrency = concurrency
+        self.batches: Dict[str, Dict[str, Any]] = {}
+
+    def run_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        body = request["body"]
+        try:
+            if request["url"] == "/v1/embeddings":
+                response = self.client.embeddings.create(**body)
+            else:
+                response = self.client.chat.completions.create(**body)
+            return {
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "body": response.model_dump()},
+                "error": None,
+            }
+        except Exception as error:
+            return {
+                "custom_id": request["custom_id"],
+                "response": None,
+                "error": {"message": str(error)},
+            }
+
+    def submit(self, content: bytes, endpoint: str) -> str:
+        requests = [json.loads(line) for line in content.splitlines() if line.strip()]
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            results = list(executor.map(self.run_request, requests))
+        batch_id = f"local-batch-{len(self.batches)}"
+        self.batches[batch_id] = {
+            "id": batch_id,
+            "status": "completed",
+            "created_at": int(time.time()),
+            "request_counts": {
+                "total": len(results),
+                "completed": sum(1 for r in results if r["error"] is None),
+                "failed": sum(1 for r in results if r["error"] is not None),
+            },
+            "results": results,
+        }
+        return batch_id
+
+    def retrieve(self, batch_id: str) -> Dict[str, Any]:
+        return self.batches[batch_id]
+
+    def results(self, batch: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        return iter(batch["results"])
+
+
+def response_body(result: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """The response body of a successful result line, None for failed requests"""
+    response = result.get("response") or {}
+    if result.get("error") or response.get("status_code") != 200:
+        return None
+    return response.get("body")
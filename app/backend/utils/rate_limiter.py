@@ -0,0 +1,286 @@
+"""
+Client-side rate limiting of OpenAI calls.
+Every request made through `gpt.client` and `gpt.aclient` passes the httpx hooks below: before it is sent, it waits
+until its model has enough requests-per-minute and tokens-per-minute budget; when the response arrives, the
+budget is corrected from the `x-ratelimit-*` headers, and a 429 blocks the model until the reported reset.
+The budget lives in a backend shared by all processes of a host (a locked JSON file per model), so gunicorn
+workers and ingestion tasks see each other's consumption.
+Interactive calls may use the whole budget, bulk calls (ingestion) leave `bulk_headroom` of it to interactive ones.
+"""
+import os
+import re
+import json
+import time
+import fcntl
+import random
+import asyncio
+import threading
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional, Tuple
+from prometheus_client import Counter, Histogram
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+priority: ContextVar[str] = ContextVar("openai_priority", default=INTERACTIVE)
+
+# A high detail image costs at most this many prompt tokens
+IMAGE_TOKENS = 1105
+
+WAIT_SECONDS = Histogram(
+    "openai_rate_limit_wait_seconds",
+    "Time OpenAI calls waited for rate limit budget",
+    ["model", "priority"],
+    buckets=(0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60),
+)
+RATE_LIMITED = Counter(
+    "openai_rate_limited", "OpenAI responses with status 429", ["model"]
+)
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Seconds in an `x-ratelimit-reset-*` value such as "20ms", "1s" or "6m0s" (or a plain number)"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def estimate_tokens(body: Dict[str, Any]) -> int:
+    """Rough prompt + completion tokens of a request body, as counted against the TPM limit"""
+    chars, images = 0, 0
+    for message in body.get("messages") or []:
+        content = message.get("content")
+        if isinstance(content, str):
+            chars += len(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    chars += len(part.get("text", ""))
+                else:
+                    images += 1
+    if "input" in body:
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        chars += sum(len(str(i)) for i in inputs)
+    completion = (body.get("max_tokens") or 0) * (body.get("n") or 1)
+    return chars // 4 + images * IMAGE_TOKENS + completion
+
+
+def new_state(rpm: float = 0, tpm: float = 0) -> Dict[str, float]:
+    """A limit of 0 is unknown, and not enforced until the response headers report it"""
+    return {
+        "rpm": rpm,
+        "tpm": tpm,
+        "requests": rpm,
+        "tokens": tpm,
+        "updated": time.time(),
+        "blocked_until": 0.0,
+    }
+
+
+def refill(state: Dict[str, float], now: float):
+    elapsed = max(0.0, now - state["updated"])
+    for budget, limit in (("requests", "rpm"), ("tokens", "tpm")):
+        if state[limit]:
+            state[budget] = min(
+                state[limit], state[budget] + state[limit] * elapsed / 60
+            )
+    state["updated"] = now
+
+
+def try_acquire(
+    state: Dict[str, float], now: float, tokens: int, headroom: float
+) -> float:
+    """Takes one request and `tokens` from the budget, or returns the seconds to wait before trying again"""
+    refill(state, now)
+    if state["blocked_until"] > now:
+        return state["blocked_until"] - now
+    wait = 0.0
+    costs = (("requests", "rpm", 1), ("tokens", "tpm", tokens))
+    for budget, limit, cost in costs:
+        if not state[limit]:
+            continue
+        # A call bigger than the whole budget would wait forever
+        missing = min(cost, state[limit]) + headroom * state[limit] - state[budget]
+        if missing > 0:
+            wait = max(wait, missing / state[limit] * 60)
+    if wait:
+        return wait
+    for budget, limit, cost in costs:
+        if state[limit]:
+            state[budget] -= cost
+    return 0.0
+
+
+def observe(state: Dict[str, float], now: float, headers, status_code: int):
+    """Corrects the budget with the limits and remainders reported by the API"""
+    refill(state, now)
+    for budget, limit, kind in (
+        ("requests", "rpm", "requests"),
+        ("tokens", "tpm", "tokens"),
+    ):
+        if value := headers.get(f"x-ratelimit-limit-{kind}"):
+            state[limit] = float(value)
+        if (value := headers.get(f"x-ratelimit-remaining-{kind}")) is not None:
+            state[budget] = min(state[budget] or float(value), float(value))
+    if status_code == 429:
+        reset = parse_duration(headers.get("retry-after")) or max(
+            parse_duration(headers.get("x-ratelimit-reset-requests")) or 0,
+            parse_duration(headers.get("x-ratelimit-reset-tokens")) or 0,
+            1.0,
+        )
+        state["blocked_until"] = max(state["blocked_until"], now + reset)
+
+
+class MemoryBackend:
+    """Budget of a single process"""
+
+    # Transactions only take a thread lock for a few microseconds, they can run on the event loop
+    blocking = False
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]]):
+        self.limits = limits
+        self.states: Dict[str, Dict[str, float]] = {}
+        self.lock = threading.Lock()
+
+    def transact(self, model: str, fn: Callable[[Dict[str, float]], Any]):
+        with self.lock:
+            if model not in self.states:
+                self.states[model] = new_state(*self.limits.get(model, (0, 0)))
+            return fn(self.states[model])
+
+
+class FileBackend:
+    """Budget shared by all processes of a host, one JSON file per model locked with flock"""
+
+    # Transactions wait for the file lock of other processes, async callers run them in a thread
+    blocking = True
+
+    def __init__(self, directory: str, limits: Dict[str, Tuple[float, float]]):
+        self.directory = directory
+        self.limits = limits
+        os.makedirs(directory, exist_ok=True)
+
+    def transact(self, model: str, fn: Callable[[Dict[str, float]], Any]):
+        name = re.sub(r"[^A-Za-z0-9._-]", "_", model)
+        with open(os.path.join(self.directory, f"{name}.json"), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            content = f.read()
+            state = (
+                json.loads(content)
+                if content
+                else new_state(*self.limits.get(model, (0, 0)))
+            )
+            result = fn(state)
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+            f.flush()
+            return result
+
+
+def parse_limits(value: str) -> Dict[str, Tuple[float, float]]:
+    """Parses "gpt-4=500:80000,text-embedding-ada-002=3000:1000000" into {model: (rpm, tpm)}"""
+    limits = {}
+    for item in filter(None, (i.strip() for i in value.split(","))):
+        model, rpm_tpm = item.split("=")
+        rpm, tpm = rpm_tpm.split(":")
+        limits[model.strip()] = (float(rpm), float(tpm))
+    return limits
+
+
+class RateLimiter:
+    def __init__(self, backend, bulk_headroom: float = 0.2):
+        self.backend = backend
+        self.bulk_headroom = bulk_headroom
+
+    @staticmethod
+    def request_cost(request) -> Tuple[Optional[str], int]:
+        """Model and estimated tokens of an httpx request, (None, 0) for calls without a model"""
+        if request.method != "POST" or not request.content:
+            return None, 0
+        try:
+            body = json.loads(request.content)
+        except ValueError:
+            return None, 0
+        if not isinstance(body, dict) or "model" not in body:
+            return None, 0
+        return body["model"], estimate_tokens(body)
+
+    def try_acquire(self, model: str, tokens: int) -> float:
+        headroom = self.bulk_headroom if priority.get() == BULK else 0.0
+        return self.backend.transact(
+            model, lambda state: try_acquire(state, time.time(), tokens, headroom)
+        )
+
+    def acquire(self, model: str, tokens: int):
+        started = time.perf_counter()
+        while (wait := self.try_acquire(model, tokens)) > 0:
+            time.sleep(wait + random.uniform(0, 0.05))
+        WAIT_SECONDS.labels(model, priority.get()).observe(
+            time.perf_counter() - started
+        )
+
+    async def try_acquire_async(self, model: str, tokens: int) -> float:
+        if self.backend.blocking:
+            # The context, and with it the priority, is copied to the thread
+            return await asyncio.to_thread(self.try_acquire, model, tokens)
+        return self.try_acquire(model, tokens)
+
+    async def acquire_async(self, model: str, tokens: int):
+        started = time.perf_counter()
+        while (wait := await self.try_acquire_async(model, tokens)) > 0:
+            await asyncio.sleep(wait + random.uniform(0, 0.05))
+        WAIT_SECONDS.labels(model, priority.get()).observe(
+            time.perf_counter() - started
+        )
+
+    def observe(self, model: str, headers, status_code: int):
+        if status_code == 429:
+            RATE_LIMITED.labels(model).inc()
+        self.backend.transact(
+            model, lambda state: observe(state, time.time(), headers, status_code)
+        )
+
+    async def observe_async(self, model: str, headers, status_code: int):
+        if self.backend.blocking:
+            await asyncio.to_thread(self.observe, model, headers, status_code)
+        else:
+            self.observe(model, headers, status_code)
+
+    def event_hooks(self) -> Dict[str, list]:
+        """Hooks for httpx.Client"""
+
+        def on_request(request):
+            model, tokens = self.request_cost(request)
+            if model:
+                request.extensions["rate_limit_model"] = model
+                self.acquire(model, tokens)
+
+        def on_response(response):
+            if model := response.request.extensions.get("rate_limit_model"):
+                self.observe(model, response.headers, response.status_code)
+
+        return {"request": [on_request], "response": [on_response]}
+
+    def async_event_hooks(self) -> Dict[str, list]:
+        """Hooks for httpx.AsyncClient"""
+
+        async def on_request(request):
+            model, tokens = self.request_cost(request)
+            if model:
+                request.extensions["rate_limit_model"] = model
+                await self.acquire_async(model, tokens)
+
+        async def on_response(response):
+            if model := response.request.extensions.get("rate_limit_model"):
+                await self.observe_async(model, response.headers, response.status_code)
+
+        return {"request": [on_request], "response": [on_response]}
@@ -0,0 +1,486 @@
+"""
+Pluggable search backends.
+`az.search_client` is either the Azure Cognitive Search `SearchClient` or the `LocalSearchClient` below,
+both exposing the same async `search`, `upload_documents` and `index_documents` calls used by the app.
+The local backend keeps a brute-force NumPy vector index and a BM25 text index on disk (memory-mapped),
+so retrieval and indexing can run offline, in benchmarks, or as an edge cache for small corpora.
+"""
+import os
+import re
+import json
+import math
+import fcntl
+from abc import ABC, abstractmethod
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+RRF_K = 60  # Reciprocal Rank Fusion constant, same default as Azure hybrid search
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+class SearchBackend(ABC):
+    """The subset of the Azure `SearchClient` (aio) interface the app relies on"""
+
+    @abstractmethod
+    async def search(
+        self,
+        search_text: Optional[str] = None,
+        *,
+        filter: Optional[str] = None,
+        select: Optional[str | List[str]] = None,
+        top: Optional[int] = None,
+        vector_queries: Optional[List[Any]] = None,
+        **kwargs,
+    ):
+        ...
+
+    @abstractmethod
+    async def upload_documents(self, documents: List[Dict[str, Any]]):
+        ...
+
+    @abstractmethod
+    async def index_documents(self, batch):
+        ...
+
+    async def flush(self):
+        """Makes the uploaded documents durable. Azure indexes them on upload"""
+        pass
+
+    async def close(self):
+        pass
+
+
+class LocalCaption:
+    """Mimics `QueryCaptionResult`, so captions can be read with `c.text`"""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.highlights = None
+
+
+class LocalIndexingResult:
+    """Mimics `IndexingResult` returned by `upload_documents` and `index_documents`"""
+
+    def __init__(self, key: str, succeeded: bool = True, status_code: int = 200):
+        self.key = key
+        self.succeeded = succeeded
+        self.status_code = status_code
+        self.error_message = None
+
+
+class LocalSearchResults:
+    """Async iterator over search hits, like `AsyncSearchItemPaged`"""
+
+    def __init__(self, hits: List[Dict[str, Any]]):
+        self.hits = hits
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for hit in self.hits:
+            yield hit
+
+    async def get_count(self) -> int:
+        return len(self.hits)
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def _split_outside_quotes(expression: str, separator: str) -> List[str]:
+    parts, current, in_quotes, i = [], "", False, 0
+    while i < len(expression):
+        if expression[i] == "'":
+            in_quotes = not in_quotes
+        if not in_quotes and expression.startswith(separator, i):
+            parts.append(current)
+            current = ""
+            i += len(separator)
+            continue
+        current += expression[i]
+        i += 1
+    parts.append(current)
+    return [p.strip() for p in parts if p.strip()]
+
+
+def _literal(value: str) -> Any:
+    value = value.strip()
+    if value.startswith("'") and value.endswith("'"):
+        return value[1:-1].replace("''", "'")
+    if value in ("true", "false"):
+        return value == "true"
+    if value == "null":
+        return None
+    return float(value) if "." in value else int(value)
+
+
+def parse_filter(filter: Optional[str]) -> Callable[[Dict[str, Any]], bool]:
+    """
+    Compiles the OData subset produced by `build_filters` and used across the app:
+    `field eq|ne <literal>` and `search.in(field, 'a,b', ',')` clauses joined with `and`.
+    """
+    if not filter:
+        return lambda doc: True
+    predicates = []
+    for clause in _split_outside_quotes(filter, " and "):
+        if match := re.fullmatch(
+            r"search\.in\(\s*(\w+)\s*,\s*'((?:[^']|'')*)'\s*(?:,\s*'([^']*)'\s*)?\)",
+            clause,
+        ):
+            field, values, delimiter = match.groups()
+            allowed = set(values.replace("''", "'").split(delimiter or ","))
+            predicates.append(lambda doc, f=field, a=allowed: doc.get(f) in a)
+        elif match := re.fullmatch(r"(\w+)\s+(eq|ne)\s+(.+)", clause):
+            field, op, value = match.groups()
+            value = _literal(value)
+            if op == "eq":
+                predicates.append(lambda doc, f=field, v=value: doc.get(f) == v)
+            else:
+                predicates.append(lambda doc, f=field, v=value: doc.get(f) != v)
+        else:
+            raise ValueError(f"Unsupported filter clause for local search: {clause}")
+    return lambda doc: all(p(doc) for p in predicates)
+
+
+class LocalSearchClient(SearchBackend):
+    """
+    In-process search index.
+    Documents (without vectors) are stored in `documents.json`, vectors in `embeddings.npy`,
+    which is opened memory-mapped so a restart doesn't need to load the whole matrix into RAM.
+    Vectors are stored L2-normalized, so cosine similarity is a single matrix-vector product.
+    Writes go to an in-memory buffer that grows by doubling, and uploads reach the files on `flush()`,
+    so a document uploaded batch by batch does not rewrite the index for every batch.
+    Several processes can share the directory (the web workers and the task worker): every write
+    holds an flock on `index.lock` and merges into the current files, and searches load the files again
+    once another process replaced them.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        key_field: str = "id",
+        vector_field: str = "embedding",
+        text_field: str = "content",
+    ):
+        self.directory = directory
+        self.key_field = key_field
+        self.vector_field = vector_field
+        self.text_field = text_field
+        self.documents: List[Dict[str, Any]] = []
+        self.embeddings: Optional[np.ndarray] = None
+        # Writable embeddings with room to append; `embeddings` is a view of its first rows
+        self._buffer: Optional[np.ndarray] = None
+        self._rows: Dict[str, int] = {}
+        self._postings: Optional[Dict[str, Dict[int, int]]] = None
+        self._doc_lengths: Optional[np.ndarray] = None
+        # Uploads not flushed yet, replayed over the files when they are loaded again
+        self._pending: List[Tuple[List[Dict[str, Any]], List[str]]] = []
+        # (mtime, size, inode) of the files as loaded
+        self._loaded: Optional[tuple] = None
+        self.load()
+
+    @property
+    def documents_path(self):
+        return os.path.join(self.directory, "documents.json")
+
+    @property
+    def embeddings_path(self):
+        return os.path.join(self.directory, "embeddings.npy")
+
+    @property
+    def lock_path(self):
+        return os.path.join(self.directory, "index.lock")
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._pending)
+
+    @contextmanager
+    def _lock(self, exclusive: bool):
+        """flock shared by all processes using the directory: shared to read the files, exclusive to write them"""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _stamp(self) -> tuple:
+        stamp = []
+        for path in (self.documents_path, self.embeddings_path):
+            try:
+                stat = os.stat(path)
+                stamp.append((stat.st_mtime_ns, stat.st_size, stat.st_ino))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _read(self):
+        """Reads the files (under the lock) and replays the pending uploads over them"""
+        self._loaded = self._stamp()
+        self.documents = []
+        self.embeddings = None
+        if os.path.exists(self.documents_path):
+            with open(self.documents_path, "r") as f:
+                self.documents = json.load(f)
+        if os.path.exists(self.embeddings_path):
+            self.embeddings = np.load(self.embeddings_path, mmap_mode="r")
+        self._buffer = None
+        self._rows = {d[self.key_field]: i for i, d in enumerate(self.documents)}
+        self._postings = None
+        for upserts, deletes in self._pending:
+            self._apply(upserts, deletes)
+
+    def load(self):
+        with self._lock(exclusive=False):
+            self._read()
+
+    def refresh(self):
+        """Loads the files again if another process (or client) changed them since"""
+        if self._stamp() != self._loaded:
+            self.load()
+
+    def persist(self):
+        """Writes the files, under the exclusive lock"""
+        # Write aside and swap, so readers never see a truncated file (or lose the old memory map)
+        tmp_path = self.documents_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.documents, f, ensure_ascii=False)
+        os.replace(tmp_path, self.documents_path)
+        if self.embeddings is not None:
+            tmp_path = self.embeddings_path + ".tmp.npy"
+            np.save(tmp_path, self.embeddings)
+            os.replace(tmp_path, self.embeddings_path)
+        elif os.path.exists(self.embeddings_path):
+            os.remove(self.embeddings_path)
+        self._pending = []
+        self._loaded = self._stamp()
+
+    def _write(self, upserts: Callable[[], List[Dict[str, Any]]], deletes: List[str]):
+        """
+        Applies the changes to the current files and writes them, with the pending uploads.
+        `upserts` is called once the files are loaded, so merges see the documents of other processes.
+        """
+        with self._lock(exclusive=True):
+            if self._stamp() != self._loaded:
+                self._read()
+            self._apply(upserts(), deletes)
+            self.persist()
+
+    async def flush(self):
+        if self.dirty:
+            self._write(lambda: [], [])
+
+    async def close(self):
+        await self.flush()
+
+    # ! Indexing
+    def _reserve(self, rows: int, dims: int):
+        """Room for `rows` embeddings in the buffer, doubling it when it is full"""
+        if self._buffer is not None and len(self._buffer) >= rows:
+            return
+        previous = 0 if self._buffer is None else len(self._buffer)
+        buffer = np.zeros((max(rows, 64, 2 * previous), dims), dtype=np.float32)
+        if self.embeddings is not None:
+            buffer[: len(self.embeddings)] = self.embeddings
+        self._buffer = buffer
+
+    def _delete(self, keys: Iterable[str]):
+        deleted = {self._rows[key] for key in keys if key in self._rows}
+        if not deleted:
+            return
+        kept = [i for i in range(len(self.documents)) if i not in deleted]
+        self.documents = [self.documents[i] for i in kept]
+        if self.embeddings is not None:
+            self._buffer = np.array(self.embeddings[kept], dtype=np.float32)
+            self.embeddings = self._buffer
+        self._rows = {d[self.key_field]: i for i, d in enumerate(self.documents)}
+        self._postings = None
+
+    def _apply(self, upserts: List[Dict[str, Any]], deletes: Iterable[str]):
+        self._delete(deletes)
+        first_new = len(self.documents)
+        for doc in upserts:
+            doc = dict(doc)
+            vector = doc.pop(self.vector_field, None)
+            key = doc[self.key_field]
+            row = self._rows.get(key)
+            if row is None:
+                row = self._rows[key] = len(self.documents)
+                self.documents.append(doc)
+            else:
+                self.documents[row] = doc
+                # The text of a row changed: the text index is rebuilt by the next search
+                self._postings = None
+            if vector is not None:
+                vector = np.asarray(vector, dtype=np.float32)
+                norm = np.linalg.norm(vector)
+                self._reserve(len(self.documents), len(vector))
+                self._buffer[row] = vector / norm if norm > 0 else vector
+        matrix = self._buffer if self._buffer is not None else self.embeddings
+        if matrix is not None:
+            # Rows without a vector stay zero
+            self._reserve(len(self.documents), matrix.shape[1])
+            self.embeddings = self._buffer[: len(self.documents)]
+        if self._postings is not None:
+            self._index_text(first_new)
+
+    async def upload_documents(self, documents: List[Dict[str, Any]]):
+        self.refresh()
+        self._pending.append((list(documents), []))
+        self._apply(documents, [])
+        return [LocalIndexingResult(d[self.key_field]) for d in documents]
+
+    def _merged(self, doc: Dict[str, Any]) -> Dict[str, Any]:
+        row = self._rows.get(doc[self.key_field])
+        return doc if row is None else {**self.documents[row], **doc}
+
+    async def merge_or_upload_documents(self, documents: List[Dict[str, Any]]):
+        self.refresh()
+        return await self.upload_documents([self._merged(d) for d in documents])
+
+    async def delete_documents(self, documents: List[Dict[str, Any]]):
+        keys = [d[self.key_field] for d in documents]
+        self._write(lambda: [], keys)
+        return [LocalIndexingResult(k) for k in keys]
+
+    async def index_documents(self, batch):
+        actions, deletes, results = [], [], []
+        for action in batch.actions:
+            doc = action.additional_properties
+            if action.action_type == "delete":
+                deletes.append(doc[self.key_field])
+            else:
+                actions.append((action.action_type, doc))
+            results.append(LocalIndexingResult(doc[self.key_field]))
+        self._write(
+            lambda: [
+                self._merged(doc) if action_type == "merge" else doc
+                for action_type, doc in actions
+            ],
+            deletes,
+        )
+        return results
+
+    # ! Retrieval
+    def _build_text_index(self):
+        self._postings = defaultdict(dict)
+        self._doc_lengths = np.zeros(0, dtype=np.float32)
+        self._index_text(0)
+
+    def _index_text(self, first: int):
+        """Adds the documents from row `first` on to the text index"""
+        lengths = np.zeros(len(self.documents) - first, dtype=np.float32)
+        for row in range(first, len(self.documents)):
+            tokens = tokenize(self.documents[row].get(self.text_field) or "")
+            lengths[row - first] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                self._postings[term][row] = tf
+        self._doc_lengths = np.concatenate([self._doc_lengths[:first], lengths])
+
+    def bm25(self, query: str, mask: np.ndarray) -> np.ndarray:
+        if self._postings is None:
+            self._build_text_index()
+        count = len(self.documents)
+        scores = np.zeros(count, dtype=np.float32)
+        avg_length = float(self._doc_lengths.mean()) if count else 0.0
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            rows = np.fromiter(postings.keys(), dtype=np.int64)
+            tf = np.fromiter(postings.values(), dtype=np.float32)
+            norm = BM25_K1 * (
+                1 - BM25_B + BM25_B * self._doc_lengths[rows] / avg_length
+            )
+            scores[rows] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        scores[~mask] = 0
+        return scores
+
+    def knn(self, vector: List[float], k: int, mask: np.ndarray) -> List[int]:
+        if self.embeddings is None or k <= 0:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        similarities = self.embeddings @ query
+        similarities[~mask] = -np.inf
+        k = min(k, int(mask.sum()))
+        if k == 0:
+            return []
+        candidates = np.argpartition(-similarities, k - 1)[:k]
+        return candidates[np.argsort(-similarities[candidates])].tolist()
+
+    @staticmethod
+    def _select(doc: Dict[str, Any], select: Optional[str | List[str]]):
+        if not select:
+            return dict(doc)
+        if isinstance(select, str):
+            select = [s.strip() for s in select.split(",")]
+        return {field: doc.get(field) for field in select}
+
+    async def search(
+        self,
+        search_text: Optional[str] = None,
+        *,
+        filter: Optional[str] = None,
+        select: Optional[str | List[str]] = None,
+        top: Optional[int] = None,
+        vector_queries: Optional[List[Any]] = None,
+        query_caption: Optional[str] = None,
+        **kwargs,
+    ) -> LocalSearchResults:
+        """
+        Text and vector queries are fused with Reciprocal Rank Fusion, like Azure hybrid search.
+        `query_type="semantic"` has no local equivalent and is ignored; captions are approximated
+        with the leading part of the content.
+        """
+        self.refresh()
+        predicate = parse_filter(filter)
+        mask = np.fromiter(
+            (predicate(d) for d in self.documents),
+            dtype=bool,
+            count=len(self.documents),
+        )
+        top = top or 50
+        rankings = []
+        if search_text and search_text.strip() != "*":
+            scores = self.bm25(search_text, mask)
+            matched = np.flatnonzero(scores > 0)
+            rankings.append(matched[np.argsort(-scores[matched])].tolist())
+        elif search_text or not vector_queries:
+            rankings.append(np.flatnonzero(mask).tolist())
+        for vector_query in vector_queries or []:
+            rankings.append(
+                self.knn(vector_query.vector, vector_query.k_nearest_neighbors, mask)
+            )
+
+        if len(rankings) == 1:
+            ranked = [
+                (row, 1.0 / (RRF_K + rank + 1)) for rank, row in enumerate(rankings[0])
+            ]
+        else:
+            fused = defaultdict(float)
+            for ranking in rankings:
+                for rank, row in enumerate(ranking):
+                    fused[row] += 1.0 / (RRF_K + rank + 1)
+            ranked = sorted(fused.items(), key=lambda x: -x[1])
+
+        hits = []
+        for row, score in ranked[:top]:
+            hit = self._select(self.documents[row], select)
+            if not select and self.embeddings is not None:
+                hit[self.vector_field] = self.embeddings[row].tolist()
+            hit["@search.score"] = score
+            if query_caption:
+                content = self.documents[row].get(self.text_field) or ""
+                hit["@search.captions"] = [LocalCaption(content[:300])]
+            hits.append(hit)
+        return LocalSearchResults(hits)
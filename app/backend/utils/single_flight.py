@@ -0,0 +1,62 @@
+"""
+In-process request coalescing. Concurrent calls with the same key await one in-flight call instead of each making
+their own upstream request, e.g. when many users click the same suggested follow-up at once.
+A flight takes at most `max_waiters` joiners; the next identical call starts a new flight that later ones join,
+so a burst costs one upstream call per `max_waiters + 1` requests instead of one per request.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Tuple
+from utils.telemetry import COALESCED
+
+LEADER = "leader"
+JOINED = "joined"
+
+
+class Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Attributes:
+        name (str): The coalesced step, used as the metric label.
+        max_waiters (int): Calls that may join one flight (0 disables coalescing).
+    """
+
+    def __init__(self, name: str, max_waiters: int = 100):
+        self.name = name
+        self.max_waiters = max_waiters
+        self.flights: Dict[str, Flight] = {}
+
+    async def do(
+        self, key: str, call: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        """The result of `call()`, and whether it was shared with an identical call in flight"""
+        if not self.max_waiters:
+            return await call(), False
+        flight = self.flights.get(key)
+        if flight is not None and flight.waiters < self.max_waiters:
+            flight.waiters += 1
+            COALESCED.labels(self.name, JOINED).inc()
+            return await asyncio.shield(flight.task), True
+        flight = Flight(asyncio.ensure_future(call()))
+        self.flights[key] = flight
+        flight.task.add_done_callback(lambda task: self.land(key, flight))
+        COALESCED.labels(self.name, LEADER).inc()
+        # Shielded: a cancelled leader (client gone) must not fail the calls that joined it
+        return await asyncio.shield(flight.task), False
+
+    def land(self, key: str, flight: Flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+        # Retrieve the error, which the waiters may all have stopped awaiting
+        if not flight.task.cancelled():
+            flight.task.exception()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "flights": len(self.flights),
+            "waiters": sum(flight.waiters for flight in self.flights.values()),
+        }
@@ -0,0 +1,145 @@
+"""
+Encoders for the /chat response stream.
+Events are reduced to the fields the frontend reads, optionally coalesced over a small time/byte window,
+and serialized either as NDJSON (default) or as Server-Sent Events.
+"""
+import time
+import asyncio
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, Optional
+
+try:
+    import orjson
+
+    def dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+
+except ImportError:  # pragma: no cover
+    import json
+
+    def dumps(obj: Any) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+NDJSON = "ndjson"
+SSE = "sse"
+MIMETYPES = {NDJSON: "application/x-ndjson", SSE: "text/event-stream"}
+
+
+def compact_event(event: Any) -> Dict[str, Any]:
+    """
+    Reduces a streamed event to what the frontend reads: the delta, the context and the session state.
+    Works on both the dicts built in `Chat` and the OpenAI `ChatCompletionChunk` objects,
+    reading attributes directly instead of converting every nested model to a dict.
+    """
+    if isinstance(event, dict):
+        return event
+    choices = []
+    for choice in event.choices:
+        delta = {}
+        if choice.delta.role:
+            delta["role"] = choice.delta.role
+        if choice.delta.content is not None:
+            delta["content"] = choice.delta.content
+        compact = {"delta": delta, "index": choice.index}
+        if choice.finish_reason:
+            compact["finish_reason"] = choice.finish_reason
+        choices.append(compact)
+    return {"choices": choices}
+
+
+def content_of(event: Dict[str, Any]) -> Optional[str]:
+    """Returns the content of a plain content delta, or None for any other event"""
+    choices = event.get("choices")
+    if not choices or len(choices) != 1:
+        return None
+    choice = choices[0]
+    if choice.keys() - {"delta", "index"} or choice["delta"].keys() != {"content"}:
+        return None
+    return choice["delta"]["content"]
+
+
+def content_event(content: str) -> Dict[str, Any]:
+    return {"choices": [{"delta": {"content": content}, "index": 0}]}
+
+
+async def coalesce_deltas(
+    events: AsyncIterator[Dict[str, Any]],
+    max_delay: Optional[float],
+    max_bytes: int,
+) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    Merges consecutive content deltas until `max_delay` seconds (None: no time limit) have passed
+    since the first buffered delta or the buffer reaches `max_bytes`. Any other event flushes the buffer first,
+    so ordering is preserved. A stalled upstream never holds buffered text longer than `max_delay`.
+    """
+    iterator = events.__aiter__()
+    buffer, size, started = [], 0, 0.0
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            if buffer and max_delay is not None:
+                timeout = max(0.0, max_delay - (time.monotonic() - started))
+                done, _ = await asyncio.wait({pending}, timeout=timeout)
+                if not done:
+                    yield content_event("".join(buffer))
+                    buffer, size = [], 0
+                    continue
+            try:
+                event = await pending
+            except StopAsyncIteration:
+                break
+            finally:
+                if pending.done():
+                    pending = None
+            content = content_of(event)
+            if content is None:
+                if buffer:
+                    yield content_event("".join(buffer))
+                    buffer, size = [], 0
+                yield event
+                continue
+            if not buffer:
+                started = time.monotonic()
+            buffer.append(content)
+            size += len(content.encode("utf-8"))
+            if size >= max_bytes or (
+                max_delay is not None and time.monotonic() - started >= max_delay
+            ):
+                yield content_event("".join(buffer))
+                buffer, size = [], 0
+        if buffer:
+            yield content_event("".join(buffer))
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+
+
+def encode(event: Dict[str, Any], transport: str = NDJSON) -> str:
+    if transport == SSE:
+        return f"data: {dumps(event)}\n\n"
+    return dumps(event) + "\n"
+
+
+async def encode_stream(
+    events: AsyncIterator[Any],
+    transport: str = NDJSON,
+    coalesce_ms: int = 0,
+    coalesce_bytes: int = 0,
+) -> AsyncGenerator[str, None]:
+    """Compacts, optionally coalesces, and serializes a stream of chat events"""
+
+    async def compacted():
+        async for event in events:
+            yield compact_event(event)
+
+    stream = compacted()
+    if coalesce_ms > 0 or coalesce_bytes > 0:
+        stream = coalesce_deltas(
+            stream,
+            max_delay=coalesce_ms / 1000 if coalesce_ms > 0 else None,
+            max_bytes=coalesce_bytes or 2**31,
+        )
+    async for event in stream:
+        yield encode(event, transport)
@@ -0,0 +1,161 @@
+"""
+Hot-path instrumentation for /chat.
+Every stage is timed into Prometheus histograms (served on /metrics) and, when the OpenTelemetry API
+is installed and configured (e.g. through `opentelemetry-instrument` or the Azure Monitor distro),
+recorded as a span. Without OpenTelemetry the spans are no-ops, so the overhead is a couple of
+`perf_counter` calls and a histogram observation per stage.
+With gunicorn, set PROMETHEUS_MULTIPROC_DIR so /metrics aggregates all workers.
+"""
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+try:
+    from opentelemetry import trace
+
+    tracer = trace.get_tracer("azure-llm-base")
+except ImportError:  # pragma: no cover
+    trace = None
+    tracer = None
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+
+STAGE_SECONDS = Histogram(
+    "chat_stage_seconds",
+    "Latency of each /chat stage",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "chat_time_to_first_token_seconds",
+    "Time from the /chat request to the first answer token",
+    buckets=LATENCY_BUCKETS,
+)
+TOKENS_PER_SECOND = Histogram(
+    "chat_generation_tokens_per_second",
+    "Streamed answer chunks per second after the first token",
+    buckets=(1, 5, 10, 20, 40, 80, 160, 320),
+)
+RETRIEVAL_HITS = Histogram(
+    "chat_retrieval_hits",
+    "Number of sources returned by the search index",
+    ["profile"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50),
+)
+PROMPT_TOKENS = Histogram(
+    "chat_prompt_tokens",
+    "Prompt tokens counted by MessageBuilder",
+    ["call"],
+    buckets=TOKEN_BUCKETS,
+)
+CHAT_REQUESTS = Counter("chat_requests", "/chat requests by outcome", ["status"])
+REWRITES = Counter("chat_rewrite", "Query rewrites by path taken", ["path"])
+ANSWER_CACHE = Counter(
+    "chat_answer_cache", "Answer cache lookups by result", ["result"]
+)
+COALESCED = Counter(
+    "chat_single_flight",
+    "Coalesced /chat steps: upstream calls made (leader) and calls that joined one in flight (joined)",
+    ["step", "result"],
+)
+
+
+class NoopSpan:
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def set_attributes(self, attributes: Dict[str, Any]):
+        pass
+
+    def record_exception(self, exception: BaseException):
+        pass
+
+    def end(self):
+        pass
+
+
+@contextmanager
+def stage(name: str, **attributes):
+    """Times a /chat stage into `chat_stage_seconds` and records it as the current span"""
+    started = time.perf_counter()
+    if tracer is None:
+        try:
+            yield NoopSpan()
+        finally:
+            STAGE_SECONDS.labels(name).observe(time.perf_counter() - started)
+        return
+    with tracer.start_as_current_span(f"chat.{name}", attributes=attributes) as span:
+        try:
+            yield span
+        finally:
+            STAGE_SECONDS.labels(name).observe(time.perf_counter() - started)
+
+
+def start_span(name: str, **attributes):
+    """
+    A span that is not attached to the current context.
+    Used around async generators, where the context can't be safely detached across yields.
+    """
+    if tracer is None:
+        return NoopSpan()
+    return tracer.start_span(f"chat.{name}", attributes=attributes)
+
+
+@contextmanager
+def use_span(span):
+    """Makes `span` the parent of the stages run inside the block (must not contain a yield)"""
+    if tracer is None or isinstance(span, NoopSpan):
+        yield span
+        return
+    with trace.use_span(span, end_on_exit=False):
+        yield span
+
+
+class GenerationTimer:
+    """Tracks time to first token and tokens per second of a streamed answer"""
+
+    def __init__(self, request_started: float):
+        self.request_started = request_started
+        self.started = time.perf_counter()
+        self.first_token: Optional[float] = None
+        self.tokens = 0
+
+    def token(self):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+            TIME_TO_FIRST_TOKEN.observe(self.first_token - self.request_started)
+        self.tokens += 1
+
+    def finish(self) -> Dict[str, Any]:
+        finished = time.perf_counter()
+        STAGE_SECONDS.labels("generation").observe(finished - self.started)
+        stats = {"generation_tokens": self.tokens}
+        if self.first_token is not None:
+            stats["time_to_first_token_ms"] = round(
+                (self.first_token - self.request_started) * 1000, 1
+            )
+            if finished > self.first_token and self.tokens > 1:
+                stats["tokens_per_second"] = round(
+                    (self.tokens - 1) / (finished - self.first_token), 1
+                )
+                TOKENS_PER_SECOND.observe(stats["tokens_per_second"])
+        return stats
+
+
+def metrics_response():
+    """Body and content type for the /metrics endpoint"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
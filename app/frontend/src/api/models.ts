@@ -4,12 +4,16 @@ export const enum RetrievalMode {
     Text = "text"
 }
 
+export type RetrievalProfile = "text" | "vector" | "hybrid" | "hybrid+semantic";
+
 export type ChatAppRequestOverrides = {
+    retrieval_profile?: RetrievalProfile;
     retrieval_mode?: RetrievalMode;
     semantic_ranker?: boolean;
     semantic_captions?: boolean;
     exclude_category?: string;
     top?: number;
+    k_nearest_neighbors?: number;
     document_sourcefiles?: string[];
     temperature?: number;
     prompt_template?: string;
@@ -51,6 +55,24 @@ export type DocumentUploadResponse = {
     filename: string;
     error?: string;
     success?: boolean;
+    lane?: string;
+    job_id?: string;
+};
+
+export type JobStatus = {
+    id: string;
+    filename: string;
+    lane: string;
+    state: "queued" | "running" | "succeeded" | "failed";
+    stage: string | null;
+    pages_done: number;
+    pages_total: number;
+    eta_seconds: number | null;
+    error: string | null;
+    enqueued_at: string;
+    started_at: string | null;
+    updated_at: string;
+    finished_at?: string;
 };
 
 export type DocumentMetaData = {
@@ -75,6 +97,7 @@ export type ChatAppRequest = {
     messages: ResponseMessage[];
     context?: ChatAppRequestContext;
     stream?: boolean;
+    stream_format?: "ndjson" | "sse";
     session_state: any;
 };
 